@@ -0,0 +1,92 @@
+# usage: parse_datetime.py [-h] [-f FILE] [-n ROWS]
+#
+# Time parse_datetime against the original strptime-based parser on the
+# timestamps of a 1M-row 'terse' file.
+#
+# Copyright (c) 2014, Jana E. Beck
+# Contact: jana.eliz.beck@gmail.com
+# License: GPLv3 (http://www.gnu.org/licenses/gpl-3.0.txt)
+
+from __future__ import print_function
+
+import argparse
+import csv
+from datetime import datetime as dt, timedelta as td
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from dexcom.convert_to_JSON import DEX_FORMAT, parse_datetime, parse_datetimes
+
+def strptime_parse_datetime(dt_str):
+  """The original parser, for comparison."""
+
+  try:
+    return dt.strptime(dt_str, DEX_FORMAT)
+  except ValueError:
+    return dt.strptime(dt_str[:-4], DEX_FORMAT)
+
+def synthetic_times(n):
+  """Return n internal times five minutes apart, the second half with SevenPlus milliseconds."""
+
+  start = dt(2012, 1, 1)
+  times = []
+  for i in range(n):
+    dt_str = (start + td(minutes=5 * i)).strftime(DEX_FORMAT)
+    times.append(dt_str + '.000' if i >= n // 2 else dt_str)
+  return times
+
+def file_times(path):
+  """Return the GlucoseInternalTime and GlucoseDisplayTime columns of a 'terse' file."""
+
+  times = []
+  with open(path, 'r') as f:
+    rdr = csv.reader(f)
+    next(rdr)
+    for row in rdr:
+      times += row[0:2]
+  return times
+
+def timed(label, fn, times, repeat = 1):
+  """Print and return how long it takes to call fn on every time (repeat times each, like bloodhound does)."""
+
+  start = time.time()
+  for dt_str in times:
+    for _ in range(repeat):
+      fn(dt_str)
+  elapsed = time.time() - start
+  print('%-36s %8.3f s' %(label, elapsed))
+  return elapsed
+
+def main():
+
+  parser = argparse.ArgumentParser(description="Time parse_datetime against the original strptime-based parser on the timestamps of a 1M-row 'terse' file.")
+
+  parser.add_argument('-f', '--file', action='store', help="a 'terse' file to take timestamps from (default: synthetic)")
+  parser.add_argument('-n', '--rows', action='store', type=int, default=1000000, help='number of synthetic timestamps')
+
+  args = parser.parse_args()
+
+  times = file_times(args.file) if args.file else synthetic_times(args.rows)
+  print('%i timestamps (%i distinct)' %(len(times), len(set(times))))
+  print()
+
+  # bloodhound, enlighten_datetime and as_tidepool parse each string three times
+  baseline = timed('strptime, 3 calls per string', strptime_parse_datetime, times, 3)
+  parse_datetime.cache_clear()
+  timed('parse_datetime, uncached', parse_datetime.__wrapped__, times, 3)
+  parse_datetime.cache_clear()
+  cached = timed('parse_datetime, 3 calls per string', parse_datetime, times, 3)
+  parse_datetime.cache_clear()
+
+  start = time.time()
+  parse_datetimes(times)
+  batch = time.time() - start
+  print('%-36s %8.3f s' %('parse_datetimes, whole column', batch))
+  print()
+  print('speedup: %.1fx (cached), %.1fx (batch vs. one strptime per string)' %(baseline / cached, baseline / 3 / batch))
+
+if __name__ == '__main__':
+  main()
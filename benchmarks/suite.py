@@ -0,0 +1,175 @@
+# usage: suite.py [-h] [-n SIZES [SIZES ...]] [-s SAVE] [-c COMPARE]
+#                 [--no-memory]
+#
+# Time the stages of the Dexcom pipeline on synthetic Dexcom Studio exports
+# (see dexcom/synthetic.py) and record peak memory, optionally saving the
+# results or comparing them against saved ones.
+#
+# optional arguments:
+#   -h, --help            show this help message and exit
+#   -n SIZES [SIZES ...], --sizes SIZES [SIZES ...]
+#                         numbers of readings to benchmark with
+#   -s SAVE, --save SAVE  save the results to this JSON file
+#   -c COMPARE, --compare COMPARE
+#                         compare the results against this JSON file
+#   --no-memory           skip the (slower) pass that measures peak memory
+#
+# Copyright (c) 2014, Jana E. Beck
+# Contact: jana.eliz.beck@gmail.com
+# License: GPLv3 (http://www.gnu.org/licenses/gpl-3.0.txt)
+
+from __future__ import print_function
+
+import argparse
+from contextlib import redirect_stdout
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from dexcom import merge_csv, synthetic
+from dexcom.convert_to_JSON import DexcomJSON
+from dexcom.store import DexcomStore
+from dexcom.timezones import TimezoneResolver
+
+SIZES = [10000, 100000, 1000000]
+
+STAGES = ['DexcomSet', 'print_set', 'DexcomJSON', 'bloodhound', 'print_JSON', 'DexcomStore']
+
+# stands in for the answers a user would type at bloodhound's prompts
+TIMEZONE = 'US/Pacific'
+
+def run_stages(dir_path, work_dir, measure):
+  """Run each stage of the pipeline in turn; return what measure(stage, fn) returns for each."""
+
+  files = [{
+    'add_generation_info': True,
+    'add_sn_info': True,
+    'file': f
+  } for f in merge_csv.get_file_list(dir_path)]
+  header = merge_csv.TERSE_HEADER + ['DeviceGeneration', 'SerialNumber']
+  merged = os.path.join(work_dir, 'merged.csv')
+
+  results = {}
+  state = {}
+
+  results['DexcomSet'] = measure(lambda: state.update(dex=merge_csv.DexcomSet(files)))
+  results['print_set'] = measure(lambda: state['dex'].print_set(header, ',', merged))
+  del state['dex']
+
+  def convert():
+    with open(merged, 'r') as f:
+      state['json'] = DexcomJSON(f, {
+        'bloodhound_dir': work_dir,
+        'file': os.path.join(work_dir, 'dexcom.json'),
+        'format': 'tidepool',
+        'resolver': TimezoneResolver([], TIMEZONE)
+      })
+
+  results['DexcomJSON'] = measure(convert)
+  results['bloodhound'] = measure(lambda: state['json'].bloodhound(''))
+  results['print_JSON'] = measure(lambda: state['json'].print_JSON())
+
+  def store():
+    # a fresh database for each pass, so every pass times inserts rather than updates
+    db = DexcomStore(os.path.join(work_dir, 'dexcom-%s.sqlite' %(measure.__name__)))
+    db.add_readings(state['json'].all)
+    db.close()
+
+  results['DexcomStore'] = measure(store)
+
+  return results
+
+def timed(fn):
+  """Return how long it takes to call fn, in seconds."""
+
+  start = time.time()
+  fn()
+  return time.time() - start
+
+def traced(fn):
+  """Return the peak memory allocated while calling fn, in MB."""
+
+  tracemalloc.start()
+  try:
+    fn()
+    return tracemalloc.get_traced_memory()[1] / float(1 << 20)
+  finally:
+    tracemalloc.stop()
+
+def benchmark(size, memory = True):
+  """Benchmark every stage on freshly generated exports with the given number of readings."""
+
+  work_dir = tempfile.mkdtemp(prefix='dexcom-bench-')
+  try:
+    dir_path = os.path.join(work_dir, 'exports')
+    synthetic.generate(dir_path, size)
+
+    # progress messages aren't part of the benchmark
+    with open(os.devnull, 'w') as devnull:
+      with redirect_stdout(devnull):
+        seconds = run_stages(dir_path, work_dir, timed)
+        peaks = run_stages(dir_path, work_dir, traced) if memory else {}
+  finally:
+    shutil.rmtree(work_dir)
+
+  return dict([(stage, {
+    'peak_mb': peaks.get(stage),
+    'seconds': seconds[stage]
+  }) for stage in STAGES])
+
+def print_results(results, baseline = None):
+  """Print a table of results, with the ratio to a baseline's times if there is one."""
+
+  for size in sorted(results, key=int):
+    print('### %s readings' %(size))
+    for stage in STAGES:
+      result = results[size][stage]
+      line = '%-12s %9.3f s' %(stage, result['seconds'])
+      if result['peak_mb'] is not None:
+        line += ' %9.1f MB' %(result['peak_mb'])
+      if baseline and size in baseline and stage in baseline[size]:
+        before = baseline[size][stage]
+        line += '   %.2fx time' %(result['seconds'] / before['seconds'])
+        if result['peak_mb'] is not None and before.get('peak_mb'):
+          line += ', %.2fx memory' %(result['peak_mb'] / before['peak_mb'])
+      print(line)
+    print()
+
+def main():
+
+  parser = argparse.ArgumentParser(description='Time the stages of the Dexcom pipeline on synthetic Dexcom Studio exports and record peak memory.')
+
+  parser.add_argument('-n', '--sizes', action='store', type=int, nargs='+', default=SIZES, help='numbers of readings to benchmark with')
+  parser.add_argument('-s', '--save', action='store', help='save the results to this JSON file')
+  parser.add_argument('-c', '--compare', action='store', help='compare the results against this JSON file')
+  parser.add_argument('--no-memory', action='store_false', dest='memory', help='skip the (slower) pass that measures peak memory')
+
+  args = parser.parse_args()
+
+  results = {}
+  for size in args.sizes:
+    results[str(size)] = benchmark(size, args.memory)
+
+  baseline = None
+  if args.compare:
+    with open(args.compare, 'r') as f:
+      baseline = json.load(f)['results']
+
+  print_results(results, baseline)
+
+  if args.save:
+    with open(args.save, 'w') as f:
+      print(json.dumps({
+        'python': platform.python_version(),
+        'results': results
+      }, indent=2, separators=(',', ': '), sort_keys=True), file=f)
+
+if __name__ == '__main__':
+  main()
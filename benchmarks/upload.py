@@ -0,0 +1,110 @@
+# usage: upload.py [-h] [-n SIZE] [-b BATCH_SIZES [BATCH_SIZES ...]]
+#                  [-c CONNECTIONS [CONNECTIONS ...]] [--latency LATENCY]
+#                  [--failure-rate FAILURE_RATE]
+#
+# Time uploading the Tidepool records for synthetic Dexcom Studio exports (see
+# dexcom/synthetic.py) to a local stand-in for the data platform (see
+# dexcom/standin.py), for each combination of batch size and number of
+# connections.
+#
+# optional arguments:
+#   -h, --help            show this help message and exit
+#   -n SIZE, --size SIZE  number of readings to benchmark with
+#   -b BATCH_SIZES [BATCH_SIZES ...], --batch-sizes BATCH_SIZES [BATCH_SIZES ...]
+#                         numbers of records per request
+#   -c CONNECTIONS [CONNECTIONS ...], --connections CONNECTIONS [CONNECTIONS ...]
+#                         numbers of keep-alive connections
+#   --latency LATENCY     seconds the stand-in waits before answering each
+#                         request, as a stand-in for the network
+#   --failure-rate FAILURE_RATE
+#                         fraction of requests the stand-in fails with a 503
+#
+# Copyright (c) 2014, Jana E. Beck
+# Contact: jana.eliz.beck@gmail.com
+# License: GPLv3 (http://www.gnu.org/licenses/gpl-3.0.txt)
+
+from __future__ import print_function
+
+import argparse
+import asyncio
+from contextlib import redirect_stdout
+import os
+import shutil
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from dexcom import merge_csv, synthetic
+from dexcom.convert_to_JSON import DexcomJSON
+from dexcom.standin import StandInServer
+from dexcom.timezones import TimezoneResolver
+from dexcom.upload import TidepoolUploader
+
+SIZE = 100000
+
+BATCH_SIZES = [100, 500, 2000]
+
+CONNECTIONS = [1, 4, 16]
+
+# stands in for the answers a user would type at bloodhound's prompts
+TIMEZONE = 'US/Pacific'
+
+def readings(size):
+  """Return the Dexcom objects for freshly generated exports with the given number of readings, oldest first."""
+
+  work_dir = tempfile.mkdtemp(prefix='dexcom-bench-')
+  try:
+    dir_path = os.path.join(work_dir, 'exports')
+    synthetic.generate(dir_path, size)
+
+    # progress messages aren't part of the benchmark
+    with open(os.devnull, 'w') as devnull:
+      with redirect_stdout(devnull):
+        dex = DexcomJSON(None, {
+          'bloodhound_dir': work_dir,
+          'columnar': True,
+          'format': 'tidepool',
+          'resolver': TimezoneResolver([], TIMEZONE),
+          'rows': merge_csv.merged_rows(dir_path)
+        })
+        dex.bloodhound('')
+  finally:
+    shutil.rmtree(work_dir)
+
+  return list(reversed([obj for obj in dex.all if obj.time]))
+
+async def benchmark(records, args):
+  """Upload the records once for each batch size and number of connections; return the summaries."""
+
+  results = {}
+  async with StandInServer(failure_rate=args['failure_rate'], latency=args['latency']) as server:
+    for batch_size in args['batch_sizes']:
+      for connections in args['connections']:
+        uploader = TidepoolUploader(server.url, batch_size=batch_size, connections=connections, backoff=0.01)
+        results[(batch_size, connections)] = await uploader.upload(records)
+  return results
+
+def main():
+
+  parser = argparse.ArgumentParser(description='Time uploading the Tidepool records for synthetic Dexcom Studio exports to a local stand-in for the data platform.')
+
+  parser.add_argument('-n', '--size', action='store', type=int, default=SIZE, help='number of readings to benchmark with')
+  parser.add_argument('-b', '--batch-sizes', action='store', type=int, nargs='+', dest='batch_sizes', default=BATCH_SIZES, help='numbers of records per request')
+  parser.add_argument('-c', '--connections', action='store', type=int, nargs='+', default=CONNECTIONS, help='numbers of keep-alive connections')
+  parser.add_argument('--latency', action='store', type=float, default=0, help='seconds the stand-in waits before answering each request, as a stand-in for the network')
+  parser.add_argument('--failure-rate', action='store', type=float, default=0, dest='failure_rate', help='fraction of requests the stand-in fails with a 503')
+
+  args = parser.parse_args()
+
+  records = readings(args.size)
+  results = asyncio.run(benchmark(records, args.__dict__))
+
+  print('### %i records' %(len(records)))
+  print('%10s %11s %9s %12s %8s' %('batch size', 'connections', 'seconds', 'records/s', 'retries'))
+  for (batch_size, connections), summary in sorted(results.items()):
+    print('%10i %11i %9.3f %12.0f %8i' %(batch_size, connections, summary['seconds'], summary['records'] / summary['seconds'], summary['retries']))
+  print()
+
+if __name__ == '__main__':
+  main()
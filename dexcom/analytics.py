@@ -0,0 +1,221 @@
+# Copyright (c) 2014, Jana E. Beck
+# Contact: jana.eliz.beck@gmail.com
+# License: GPLv3 (http://www.gnu.org/licenses/gpl-3.0.txt)
+
+from __future__ import print_function
+
+import numpy as np
+
+from dexcom.readings import DexcomReadings
+
+# time-in-range buckets in mg/dL: very low, low, in range, high, very high
+# 'Low' and 'High' readings (39 and 401, see Dexcom._set_value) fall in the outermost buckets
+RANGE_EDGES = [54, 70, 181, 251]
+
+RANGE_NAMES = ['very_low', 'low', 'in_range', 'high', 'very_high']
+
+AGP_PERCENTILES = [5, 25, 50, 75, 95]
+
+MINUTES_IN_DAY = 24 * 60
+
+def readings(dex, subtype = 'sensor'):
+  """Return the display times (datetime64[s]) and values (mg/dL) of a DexcomJSON's sensor readings or calibrations, oldest first."""
+
+  objs = dex.sensors() if subtype == 'sensor' else dex.calibrations()
+
+  if isinstance(objs, DexcomReadings):
+    # no need to go through the objects at all
+    times = objs.columns['display'][objs.index].astype('datetime64[s]')
+    values = objs.columns['value'][objs.index].astype(np.float64)
+  else:
+    # display times are local to wherever the user was, which is what days and times of day should be
+    times = np.array([obj.user_time[:19] for obj in objs], dtype='datetime64[s]')
+    values = np.array([obj.value for obj in objs], dtype=np.float64)
+
+  order = np.argsort(times, kind='mergesort')
+  return times[order], values[order]
+
+def gmi(mean):
+  """Return the glucose management indicator (%) for a mean glucose in mg/dL."""
+
+  return 3.31 + 0.02392 * mean
+
+def _range_buckets(values):
+  """Return the time-in-range bucket of each value, as an index into RANGE_NAMES."""
+
+  return np.searchsorted(RANGE_EDGES, values, side='right')
+
+def summary(values):
+  """Return mean, SD, CV, GMI and time-in-range fractions over a set of values."""
+
+  if not len(values):
+    return None
+
+  mean = values.mean()
+  sd = values.std()
+  stats = {
+    'count': len(values),
+    'cv': sd / mean,
+    'gmi': gmi(mean),
+    'mage': mage(values),
+    'mean': mean,
+    'sd': sd
+  }
+  buckets = np.bincount(_range_buckets(values), minlength=len(RANGE_NAMES)) / float(len(values))
+  for name, fraction in zip(RANGE_NAMES, buckets):
+    stats[name] = fraction
+  return stats
+
+def _turning_points(values):
+  """Return the indices of the local peaks and nadirs in a series (plus its ends)."""
+
+  # ignore flat stretches when looking for changes of direction
+  steps = np.diff(values)
+  moving = np.flatnonzero(steps)
+  if not len(moving):
+    return np.array([0], dtype=np.intp)
+  direction = np.sign(steps[moving])
+  turns = moving[1:][direction[1:] != direction[:-1]]
+  return np.concatenate([[0], turns, [len(values) - 1]])
+
+def _excursions(values):
+  """Return the start index and amplitude of each excursion between turning points."""
+
+  points = _turning_points(values)
+  return points[:-1], np.abs(np.diff(values[points]))
+
+def _day_excursions(day, values):
+  """Return the day (as an index) each excursion over the whole series starts on, and its amplitude."""
+
+  if len(values) < 2:
+    return np.array([], dtype=np.int64), np.array([])
+  starts, amplitudes = _excursions(values)
+  return day[starts], amplitudes
+
+def mage(values, sd = None):
+  """Return the mean amplitude of glycemic excursions larger than one SD.
+
+  This is the simplified, direction-agnostic form: every peak-to-nadir or
+  nadir-to-peak swing larger than the SD counts.
+  """
+
+  if len(values) < 2:
+    return np.nan
+  sd = values.std() if sd is None else sd
+  amplitudes = _excursions(values)[1]
+  amplitudes = amplitudes[amplitudes > sd]
+  return amplitudes.mean() if len(amplitudes) else np.nan
+
+def daily(times, values):
+  """Return per-day mean, SD, CV, GMI, MAGE and time-in-range fractions, one entry per calendar day with data."""
+
+  days = times.astype('datetime64[D]')
+  unique_days, day = np.unique(days, return_inverse=True)
+  n = len(unique_days)
+
+  count = np.bincount(day, minlength=n).astype(np.float64)
+  mean = np.bincount(day, weights=values, minlength=n) / count
+  sd = np.sqrt(np.maximum(np.bincount(day, weights=values ** 2, minlength=n) / count - mean ** 2, 0))
+
+  stats = {
+    'count': count.astype(np.int64),
+    'cv': sd / mean,
+    'day': unique_days,
+    'gmi': gmi(mean),
+    'mean': mean,
+    'sd': sd
+  }
+
+  # excursions are credited to the day they start on and compared with that day's SD
+  excursion_days, amplitudes = _day_excursions(day, values)
+  big = amplitudes > sd[excursion_days]
+  excursion_days = excursion_days[big]
+  with np.errstate(invalid='ignore', divide='ignore'):
+    stats['mage'] = np.bincount(excursion_days, weights=amplitudes[big], minlength=n) / np.bincount(excursion_days, minlength=n)
+
+  buckets = np.zeros((n, len(RANGE_NAMES)))
+  np.add.at(buckets, (day, _range_buckets(values)), 1)
+  for i, name in enumerate(RANGE_NAMES):
+    stats[name] = buckets[:, i] / count
+
+  return stats
+
+def rolling(times, values, window = 14):
+  """Return mean, SD, CV, GMI, MAGE and time-in-range fractions over the window days ending on each calendar day."""
+
+  if not len(values):
+    return None
+
+  days = times.astype('datetime64[D]')
+  first = days[0]
+  day = (days - first).astype(np.int64)
+  n = day[-1] + 1
+
+  def window_sum(weights):
+    # windowed sums from the differences of running totals over every calendar day
+    totals = np.concatenate([[0], np.cumsum(np.bincount(day, weights=weights, minlength=n))])
+    return totals[1:] - totals[np.maximum(np.arange(1, n + 1) - window, 0)]
+
+  count = window_sum(None)
+  with np.errstate(invalid='ignore', divide='ignore'):
+    mean = window_sum(values) / count
+    sd = np.sqrt(np.maximum(window_sum(values ** 2) / count - mean ** 2, 0))
+    stats = {
+      'count': count.astype(np.int64),
+      'cv': sd / mean,
+      'day': first + np.arange(n),
+      'gmi': gmi(mean),
+      'mean': mean,
+      'sd': sd
+    }
+    buckets = _range_buckets(values)
+    for i, name in enumerate(RANGE_NAMES):
+      stats[name] = window_sum((buckets == i).astype(np.float64)) / count
+
+  # as in daily, excursions are credited to the day they start on, but compared with each window's SD,
+  # so they can't be summed from running totals; this loops over days (not readings), since vectorizing
+  # it means sorting every excursion by amplitude, which alone takes longer (for 20 years of readings,
+  # 0.14 s to sort 1.35M excursions against 0.13 s for the whole loop)
+  excursion_days, amplitudes = _day_excursions(day, values)
+  ends = np.arange(n)
+  lo = np.searchsorted(excursion_days, ends - window + 1, side='left')
+  hi = np.searchsorted(excursion_days, ends, side='right')
+  stats['mage'] = np.full(n, np.nan)
+  for end in ends:
+    swings = amplitudes[lo[end]:hi[end]]
+    swings = swings[swings > sd[end]]
+    if len(swings):
+      stats['mage'][end] = swings.mean()
+
+  return stats
+
+def agp(times, values, bin_minutes = 15, percentiles = AGP_PERCENTILES):
+  """Return ambulatory glucose profile percentile bands by time of day.
+
+  The result has the start of each time-of-day bin in minutes after midnight
+  and, for each percentile, an array of values (NaN for bins without data).
+  """
+
+  minutes = (times - times.astype('datetime64[D]')).astype('timedelta64[m]').astype(np.int64)
+  bins = minutes // bin_minutes
+  n = MINUTES_IN_DAY // bin_minutes
+
+  # sort by bin, then by value within each bin, so each bin's percentiles can be read off by position
+  order = np.lexsort((values, bins))
+  sorted_values = values[order]
+  count = np.bincount(bins, minlength=n)
+  start = np.concatenate([[0], np.cumsum(count)[:-1]])
+
+  bands = {'minute': np.arange(n) * bin_minutes}
+  has_data = count > 0
+  for p in percentiles:
+    # linear interpolation between the closest ranks, like np.percentile
+    position = start + (count - 1) * (p / 100.0)
+    lower = np.floor(position).astype(np.int64)
+    upper = np.minimum(lower + 1, start + count - 1)
+    fraction = position - lower
+    band = np.full(n, np.nan)
+    band[has_data] = (sorted_values[lower[has_data]] * (1 - fraction[has_data]) + sorted_values[upper[has_data]] * fraction[has_data])
+    bands[p] = band
+
+  return bands
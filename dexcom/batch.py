@@ -0,0 +1,208 @@
+# usage: python -m dexcom.batch [-h] [-o OUTPUT_DIR] [-j JOBS] [-z TIMEZONE]
+#                               [--dst {never,always,infer}] [--columnar]
+#                               [--compact] [--ndjson] [--deterministic-guids]
+#                               [--compress {gz,bz2,xz}] [--sqlite]
+#                               [--metrics METRICS]
+#                               root
+#
+# Run the whole Dexcom pipeline (merge_csv, DexcomJSON, bloodhound, print_JSON)
+# for every patient under a root directory, one subdirectory per patient.
+# Merged rows are passed along in memory, and everything a patient's run
+# writes (JSON, bloodhound.log/bloodhound.json, pipeline.log and, with
+# --sqlite, dexcom.sqlite) goes to OUTPUT_DIR/<patient>/. A bloodhound.json
+# already there is reused.
+#
+# positional arguments:
+#   root                  directory with one subdirectory of Dexcom Studio
+#                         exports per patient
+#
+# optional arguments:
+#   -h, --help            show this help message and exit
+#   -o OUTPUT_DIR, --output-dir OUTPUT_DIR
+#                         directory to write one output subdirectory per patient
+#                         to
+#   -j JOBS, --jobs JOBS  number of patients to process at once
+#   -z TIMEZONE, --timezone TIMEZONE
+#                         timezone to assume where a patient has no
+#                         timezones.json schedule
+#   --dst {never,always,infer}
+#                         whether to treat offset changes as shifts to/from DST
+#                         when the schedule doesn't say
+#   --columnar            hold readings in typed arrays instead of one object
+#                         each
+#   --compact             write JSON without indentation
+#   --ndjson              write newline-delimited JSON
+#   --deterministic-guids
+#                         derive each record's GUID from its device serial
+#                         number and internal time, so rerunning gives the same
+#                         GUIDs
+#   --compress {gz,bz2,xz}
+#                         compress each patient's JSON as it's written
+#   --sqlite              also upsert each patient's readings, with their
+#                         offsets and UTC times, and bloodhound's offset
+#                         segments into a SQLite database (see dexcom.store)
+#   --metrics METRICS     write timings and counts for each stage, summed over
+#                         all patients, to this JSON file
+#
+# Copyright (c) 2014, Jana E. Beck
+# Contact: jana.eliz.beck@gmail.com
+# License: GPLv3 (http://www.gnu.org/licenses/gpl-3.0.txt)
+
+from __future__ import print_function
+
+import argparse
+from contextlib import redirect_stdout
+import multiprocessing
+import os
+import time
+
+from dexcom import merge_csv
+from dexcom.convert_to_JSON import DexcomJSON
+from dexcom.instrument import metrics, set_verbose
+from dexcom.timezones import DST_POLICIES, TimezoneResolver
+
+# optional per-patient timezone schedule, in the patient's input directory (see TimezoneResolver)
+SCHEDULE_FILE = 'timezones.json'
+
+# per-patient SQLite store written with --sqlite, in the patient's output directory (see dexcom.store)
+STORE_FILE = 'dexcom.sqlite'
+
+def get_patients(root):
+  """Return the names of the patient subdirectories of a root directory."""
+
+  return sorted([d for d in os.listdir(root) if os.path.isdir(os.path.join(root, d)) and not d.startswith('.')])
+
+def run_patient(task):
+  """Run the full pipeline for one patient; return a summary of how it went."""
+
+  # workers are reused, so only count this patient's run
+  metrics.reset()
+  # progress messages go to the patient's pipeline.log
+  set_verbose(True)
+
+  start = time.time()
+  summary = {
+    'error': None,
+    'patient': task['patient'],
+    'readings': 0,
+    'unresolved': 0
+  }
+
+  try:
+    if not os.path.isdir(task['output']):
+      os.makedirs(task['output'])
+
+    # each patient gets its own log instead of interleaving everyone's progress messages
+    with open(os.path.join(task['output'], 'pipeline.log'), 'w') as log:
+      with redirect_stdout(log):
+        rows = merge_csv.merged_rows(task['input'])
+
+        schedule = os.path.join(task['input'], SCHEDULE_FILE)
+        resolver = TimezoneResolver(schedule if os.path.exists(schedule) else [], task['timezone'], task['dst'])
+
+        dex = DexcomJSON(None, {
+          # reuse the offset changes from last time
+          'bloodhound': os.path.join(task['output'], 'bloodhound.json'),
+          'bloodhound_dir': task['output'],
+          'columnar': task['columnar'],
+          'deterministic_guids': task['deterministic_guids'],
+          'file': os.path.join(task['output'], task['output_file']),
+          'format': 'tidepool',
+          'layout': task['layout'],
+          'pretty': task['pretty'],
+          'resolver': resolver,
+          'rows': rows,
+          'sqlite': os.path.join(task['output'], STORE_FILE) if task.get('sqlite') else None
+        })
+        dex.bloodhound('').print_JSON()
+
+    summary['readings'] = len(dex.all)
+    summary['unresolved'] = len(resolver.unresolved)
+  except Exception as e:
+    summary['error'] = '%s: %s' %(type(e).__name__, e)
+
+  summary['seconds'] = time.time() - start
+  summary['metrics'] = metrics.report()
+  return summary
+
+def process(args):
+  """Run the pipeline for every patient in parallel and print a summary."""
+
+  patients = get_patients(args['root'])
+
+  tasks = [{
+    'columnar': args['columnar'],
+    'deterministic_guids': args['deterministic_guids'],
+    'dst': args['dst'],
+    'input': os.path.join(args['root'], patient),
+    'layout': 'ndjson' if args['ndjson'] else 'array',
+    'output': os.path.join(args['output_dir'], patient),
+    'output_file': ('dexcom.ndjson' if args['ndjson'] else 'dexcom.json') + ('.' + args['compress'] if args.get('compress') else ''),
+    'patient': patient,
+    'pretty': not (args['ndjson'] or args['compact']),
+    'sqlite': args.get('sqlite'),
+    'timezone': args['timezone']
+  } for patient in patients]
+
+  print()
+  print('### Processing %i patients with %i workers...' %(len(tasks), args['jobs']))
+  print()
+
+  start = time.time()
+  summaries = []
+
+  pool = multiprocessing.Pool(args['jobs'])
+  try:
+    for summary in pool.imap_unordered(run_patient, tasks):
+      if summary['error']:
+        print('!!! %s failed after %.1f s: %s' %(summary['patient'], summary['seconds'], summary['error']))
+      else:
+        print('%s: %i readings in %.1f s.' %(summary['patient'], summary['readings'], summary['seconds']))
+        if summary['unresolved']:
+          print("!!! %s: %i offset changes couldn't be resolved." %(summary['patient'], summary['unresolved']))
+      summaries.append(summary)
+      metrics.add(summary['metrics'])
+  finally:
+    pool.close()
+    pool.join()
+
+  elapsed = time.time() - start
+  failed = [s for s in summaries if s['error']]
+  readings = sum([s['readings'] for s in summaries])
+
+  print()
+  print('### %i patients processed, %i failed.' %(len(summaries) - len(failed), len(failed)))
+  print('%i readings in %.1f s (%.0f readings/s).' %(readings, elapsed, readings / elapsed if elapsed else 0))
+  print()
+
+  # stage timings are summed over all the workers
+  if args.get('metrics'):
+    metrics.count('patients', len(summaries))
+    metrics.count('patients_failed', len(failed))
+    metrics.write(args['metrics'])
+
+  return summaries
+
+def main():
+
+  parser = argparse.ArgumentParser(description='Run the whole Dexcom pipeline for every patient under a root directory, one subdirectory per patient.')
+
+  parser.add_argument('root', action='store', help='directory with one subdirectory of Dexcom Studio exports per patient')
+  parser.add_argument('-o', '--output-dir', action='store', dest='output_dir', default='output', help='directory to write one output subdirectory per patient to')
+  parser.add_argument('-j', '--jobs', action='store', type=int, default=multiprocessing.cpu_count(), help='number of patients to process at once')
+  parser.add_argument('-z', '--timezone', action='store', help='timezone to assume where a patient has no %s schedule' %(SCHEDULE_FILE))
+  parser.add_argument('--dst', action='store', choices=DST_POLICIES, default='never', help='whether to treat offset changes as shifts to/from DST when the schedule doesn\'t say')
+  parser.add_argument('--columnar', action='store_true', help='hold readings in typed arrays instead of one object each')
+  parser.add_argument('--compact', action='store_true', help='write JSON without indentation')
+  parser.add_argument('--ndjson', action='store_true', help='write newline-delimited JSON')
+  parser.add_argument('--deterministic-guids', action='store_true', dest='deterministic_guids', help='derive each record\'s GUID from its device serial number and internal time, so rerunning gives the same GUIDs')
+  parser.add_argument('--compress', action='store', choices=['gz', 'bz2', 'xz'], help='compress each patient\'s JSON as it\'s written')
+  parser.add_argument('--sqlite', action='store_true', help='also upsert each patient\'s readings, with their offsets and UTC times, and bloodhound\'s offset segments into a SQLite database (see dexcom.store)')
+  parser.add_argument('--metrics', action='store', help='write timings and counts for each stage, summed over all patients, to this JSON file')
+
+  args = parser.parse_args()
+
+  process(args.__dict__)
+
+if __name__ == '__main__':
+  main()
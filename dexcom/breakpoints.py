@@ -0,0 +1,153 @@
+# Copyright (c) 2014, Jana E. Beck
+# Contact: jana.eliz.beck@gmail.com
+# License: GPLv3 (http://www.gnu.org/licenses/gpl-3.0.txt)
+
+from __future__ import print_function
+
+from datetime import datetime as dt
+
+import numpy as np
+
+from dexcom.convert_to_JSON import parse_datetime, parse_datetimes, DexcomTZ, SECONDS_IN_HOUR
+from dexcom.readings import parse_times, DexcomReadings
+
+SECONDS_IN_DAY = 24 * SECONDS_IN_HOUR
+
+# why bloodhound needs an offset where a segment starts, in order of precedence
+INPUT_BY_USER = 'input by user'
+CHANGED_G4 = 'changed G4 Platinum device'
+CHANGED_GENERATION = 'changed to Seven Plus device'
+INFERRED = 'inferred via bloodhound protocol'
+
+REASONS = [INPUT_BY_USER, CHANGED_G4, CHANGED_GENERATION, INFERRED]
+
+def _seconds(dt_strs):
+  """Parse Dexcom time and date strings into int64 epoch seconds (milliseconds ignored, as by parse_datetime)."""
+
+  try:
+    seconds = parse_times(dt_strs)[0]
+  except ValueError:
+    # numpy only takes ISO-like strings; parse_datetime is more forgiving
+    seconds = np.array(parse_datetimes(dt_strs), dtype='datetime64[s]').astype(np.int64)
+
+  bad = np.flatnonzero(seconds == np.datetime64('NaT').astype(np.int64))
+  if len(bad):
+    # fail like parse_datetime would
+    parse_datetime(dt_strs[bad[0]])
+  return seconds
+
+def reading_arrays(readings):
+  """Return the internal and display times (epoch seconds), generations and serials of readings, in order."""
+
+  if isinstance(readings, DexcomReadings):
+    columns = readings.columns
+    index = readings.index
+    return {
+      'display': columns['display'][index],
+      'generation': columns['generation'][index],
+      'generations': readings.generations,
+      'internal': columns['internal'][index],
+      'serial': columns['serial'][index]
+    }
+
+  generations, gen_codes = np.unique(np.array([obj.device_gen for obj in readings], dtype=str), return_inverse=True)
+  serial_codes = np.unique(np.array([obj.serial for obj in readings], dtype=str), return_inverse=True)[1]
+  return {
+    'display': _seconds([obj.user_time for obj in readings]),
+    'generation': gen_codes,
+    'generations': list(generations),
+    'internal': _seconds([obj.internal_time for obj in readings]),
+    'serial': serial_codes
+  }
+
+def find_segments(arrays, known_keys):
+  """Split readings (most recent first) into runs that each take a single display offset.
+
+  known_keys are the sorted ISO-format internal times of previously known offset
+  changes (see OffsetIndex); a reading at or before one of them takes the
+  earliest such change. Every other reading is sniffed, bloodhound-style: a
+  new run starts with the first of them, at a G4 Platinum serial switch, at a
+  generation switch, or where the display time's offset from the internal time
+  (in whole hours) changes. Returns a list of dicts with the 'start' and 'end'
+  positions of each run and either the index of its known 'change' or the
+  'reason' it needs an offset.
+  """
+
+  n = len(arrays['internal'])
+  if not n:
+    return []
+
+  internal = arrays['internal']
+  keys = np.array(known_keys, dtype='datetime64[s]').astype(np.int64)
+  change = np.searchsorted(keys, internal, side='left')
+  covered = change < len(keys)
+
+  # like round(-(internal - display).seconds / SECONDS_IN_HOUR), with timedelta's normalized seconds
+  hours = np.round(-np.mod(internal - arrays['display'], SECONDS_IN_DAY) / float(SECONDS_IN_HOUR))
+
+  gen = arrays['generation']
+  serial = arrays['serial']
+  g4 = arrays['generations'].index('G4Platinum') if 'G4Platinum' in arrays['generations'] else -1
+
+  # compared with the reading before, whether or not that one was sniffed
+  changed_g4 = np.zeros(n, dtype=bool)
+  changed_g4[1:] = (serial[1:] != serial[:-1]) & (gen[1:] == g4)
+  changed_gen = np.zeros(n, dtype=bool)
+  changed_gen[1:] = gen[1:] != gen[:-1]
+
+  # but offsets only change between one sniffed reading and the next
+  sniffed = np.flatnonzero(~covered)
+  inferred = np.zeros(n, dtype=bool)
+  inferred[sniffed[1:]] = hours[sniffed[1:]] != hours[sniffed[:-1]]
+
+  # indices into REASONS, or -1 where the offset carries on from the reading before
+  reasons = np.select([changed_g4, changed_gen, inferred], [1, 2, 3], -1)
+  reasons[covered] = -1
+  if len(sniffed):
+    reasons[sniffed[0]] = 0
+
+  # known changes start a run wherever the change that applies changes
+  starts = reasons >= 0
+  starts[0] = True
+  starts[1:] |= covered[1:] & ((change[1:] != change[:-1]) | ~covered[:-1])
+
+  starts = np.flatnonzero(starts)
+  ends = np.append(starts[1:], n)
+  last_times = np.datetime_as_string(internal[starts].astype('datetime64[s]')).tolist()
+  first_times = np.datetime_as_string(internal[ends - 1].astype('datetime64[s]')).tolist()
+  segments = []
+  for i, (start, end) in enumerate(zip(starts.tolist(), ends.tolist())):
+    segment = {
+      'end': end,
+      # ISO-format internal times of the oldest and most recent readings in the run
+      'first_internal_time': first_times[i],
+      'hours': int(hours[start]),
+      'last_internal_time': last_times[i],
+      'start': start
+    }
+    if covered[start]:
+      segment['change'] = int(change[start])
+    else:
+      segment['reason'] = REASONS[reasons[start]]
+    segments.append(segment)
+  return segments
+
+def apply_offsets(readings, arrays, start, end, offsets):
+  """Give a run of readings a display offset and timezone, making them timezone-aware (see enlighten_datetime)."""
+
+  offset, timezone = offsets
+  # every reading in the run gets the same UTC offset suffix
+  suffix = dt(2000, 1, 1, tzinfo=DexcomTZ(offset)).isoformat()[19:]
+  times = np.char.add(np.datetime_as_string(arrays['display'][start:end].astype('datetime64[s]')), suffix).tolist()
+
+  if isinstance(readings, DexcomReadings):
+    index = readings.index[start:end]
+    readings.columns['display_offset'][index] = offset
+    readings.columns['timezone'][index] = timezone
+    readings.columns['time'][index] = times
+    return
+
+  for obj, time in zip(readings[start:end], times):
+    obj.display_offset = offset
+    obj.timezone = timezone
+    obj.time = time
@@ -0,0 +1,40 @@
+# Copyright (c) 2014, Jana E. Beck
+# Contact: jana.eliz.beck@gmail.com
+# License: GPLv3 (http://www.gnu.org/licenses/gpl-3.0.txt)
+
+from __future__ import print_function
+
+import bz2
+import gzip
+import lzma
+import os
+
+# compressed files are recognized by extension, e.g. export.txt.gz
+OPENERS = {
+  '.bz2': bz2.open,
+  '.gz': gzip.open,
+  '.xz': lzma.open
+}
+
+def compression(path):
+  """Return the compression extension of a path (e.g., '.gz'), or '' if it isn't compressed."""
+
+  ext = os.path.splitext(path)[1]
+  return ext if ext in OPENERS else ''
+
+def strip_compression(path):
+  """Return a path without its compression extension, if it has one."""
+
+  return path[:-len(compression(path))] if compression(path) else path
+
+def open_file(path, mode = 'r', newline = None):
+  """Open a file in text mode, (de)compressing it on the fly if it's compressed.
+
+  Appending to a compressed file adds another compressed stream, which reads
+  back as one file.
+  """
+
+  ext = compression(path)
+  if ext:
+    return OPENERS[ext](path, mode.replace('U', '') + 't', newline=newline)
+  return open(path, mode, newline=newline)
@@ -9,19 +9,42 @@ try:
 except NameError:
   pass
 
+from bisect import bisect_left, bisect_right
 import csv
 from datetime import datetime as dt, timedelta as td, tzinfo
+from functools import lru_cache
+from itertools import islice
 import json
+from json.encoder import encode_basestring_ascii
+import os
 from pytz import timezone as tz, UnknownTimeZoneError
 import pytz
+import re
 import uuid
 
+from dexcom.compressed import compression, open_file
+from dexcom.instrument import metrics
+
 DEX_FORMAT = '%Y-%m-%d %H:%M:%S'
 
 SECONDS_IN_HOUR = 3600
 
 GLUCOSE_MOLAR_MASS = 18.01559
 
+# number of records serialized before each write to file
+JSON_CHUNK_SIZE = 1000
+
+# namespace for deterministic (name-based) GUIDs, see Dexcom.tidepool_guid
+GUID_NAMESPACE = uuid.uuid5(uuid.NAMESPACE_URL, 'https://github.com/jebeck/iPancreas-dexcom')
+
+# fields of a Tidepool record (see Dexcom.as_tidepool) that TidepoolSerializer fills in for each reading
+TIDEPOOL_FIELDS = ['deviceTime', 'guid', 'time', 'timezoneOffset', 'value']
+TIDEPOOL_PAYLOAD_FIELDS = ['deviceValue', 'internalTime']
+TIDEPOOL_PLACEHOLDER = '@@%s@@'
+
+# number of distinct time and date strings parse_datetime remembers
+PARSE_CACHE_SIZE = 1 << 16
+
 class DexcomTZ(tzinfo):
 
   def __init__(self, offset):
@@ -40,15 +63,151 @@ def enlighten_datetime(obj):
 
   obj.time = parse_datetime(obj.user_time).replace(tzinfo=DexcomTZ(obj.display_offset)).isoformat()
 
+def _fixed_width(dt_str):
+  """Return whether a Dexcom time and date string is laid out 'YYYY-mm-dd HH:MM:SS', with or without milliseconds."""
+
+  return (len(dt_str) == 19 or (len(dt_str) == 23 and dt_str[19] == '.')) and \
+    dt_str[4] == '-' and dt_str[7] == '-' and dt_str[10] == ' ' and dt_str[13] == ':' and dt_str[16] == ':'
+
+@lru_cache(maxsize=PARSE_CACHE_SIZE)
 def parse_datetime(dt_str):
   """Parse a Dexcom time and date string into a datetime object."""
 
-  try:
-    return dt.strptime(dt_str, DEX_FORMAT)
-  except ValueError:
-    # gen 'SevenPlus' date and time info includes milliseconds
-    # so we truncate to index -4
-    return dt.strptime(dt_str[:-4], DEX_FORMAT)
+  # gen 'SevenPlus' date and time info includes milliseconds, which we ignore
+  # so both generations are fixed-width 'YYYY-mm-dd HH:MM:SS' up to index 19
+  if _fixed_width(dt_str):
+    return dt(int(dt_str[0:4]), int(dt_str[5:7]), int(dt_str[8:10]),
+      int(dt_str[11:13]), int(dt_str[14:16]), int(dt_str[17:19]))
+
+  # anything else gets the slow (and strict) treatment
+  if len(dt_str) > 19 and dt_str[-4] == '.':
+    dt_str = dt_str[:-4]
+  return dt.strptime(dt_str, DEX_FORMAT)
+
+@lru_cache(maxsize=None)
+def _day_utcoffsets(timezone, day):
+  """Return the offsets from UTC of a timezone at the start and end of a day."""
+
+  start = dt(day.year, day.month, day.day)
+  return (tz(timezone).utcoffset(start), tz(timezone).utcoffset(start + td(days=1, seconds=-1)))
+
+def get_utc_offset(timezone, when):
+  """Return the offset from UTC in hours of a timezone at a (naive) datetime, memoized per timezone and date."""
+
+  start, end = _day_utcoffsets(timezone, when.date())
+  # only days with a DST transition need the exact time
+  td_offset = start if start == end else tz(timezone).utcoffset(when)
+  return td_offset.days * 24 + td_offset.seconds/SECONDS_IN_HOUR
+
+def timezone_offset(user_time, change_type, timezone, dst):
+  """Return the timezone, offset from UTC and type of change for a Dexcom display time in a timezone."""
+
+  offset = get_utc_offset(timezone, parse_datetime(user_time))
+  if dst:
+    change_type += '; shift to/from DST'
+    # fall back is -1; reverse it to undo change
+    if parse_datetime(user_time).month > 6:
+      offset += 1
+    # spring forward is +1; reverse it to undo change
+    else:
+      offset -= 1
+
+  return {
+    'timezone': timezone,
+    'offset': offset,
+    'type': change_type
+  }
+
+def parse_datetimes(dt_strs):
+  """Parse a column of Dexcom time and date strings into datetime objects, parsing each distinct string once."""
+
+  parsed = {}
+  for dt_str in dt_strs:
+    if dt_str not in parsed:
+      parsed[dt_str] = parse_datetime(dt_str)
+  return [parsed[dt_str] for dt_str in dt_strs]
+
+def json_format(layout = 'array', pretty = True):
+  """Return how write_JSON dumps each record, and what goes before, between and after them (or instead, if there are none)."""
+
+  # pretty output is the same as dumping the whole array with indent=2
+  if pretty and layout == 'array':
+    dumps = lambda r: '  ' + json.dumps(r, separators=(',', ': '), indent=2, sort_keys=True).replace('\n', '\n  ')
+    return dumps, '[\n', ',\n', '\n]\n', '[]\n'
+  elif pretty:
+    raise ValueError('Newline-delimited JSON can\'t be pretty-printed.')
+
+  dumps = lambda r: json.dumps(r, separators=(',', ':'), sort_keys=True)
+  if layout == 'array':
+    return dumps, '[', ',', ']\n', '[]\n'
+  elif layout == 'ndjson':
+    return dumps, '', '\n', '\n', ''
+  raise ValueError('Unknown JSON layout: %s' %(layout))
+
+def write_JSON(records, f, layout = 'array', pretty = True, serializer = None, append = False, jobs = 1):
+  """Stream records to an open file as a JSON array or as newline-delimited JSON ('ndjson').
+
+  With a serializer (e.g., TidepoolSerializer), records are objects it turns straight into JSON text,
+  in chunks spread over a number of worker processes if jobs > 1 (see dexcom.export).
+  With append, the records carry on an array whose closing bracket has been cut off (see append_JSON).
+  """
+
+  dumps, start, sep, end, empty = json_format(layout, pretty)
+
+  if serializer is not None and jobs > 1:
+    from dexcom.export import serialize_chunks
+    chunks = serialize_chunks(records, layout, pretty, serializer.deterministic, jobs)
+  else:
+    if serializer is not None:
+      dumps = serializer.dumper(dumps)
+    records = iter(records)
+    chunks = ((len(chunk), sep.join(map(dumps, chunk))) for chunk in iter(lambda: list(islice(records, JSON_CHUNK_SIZE)), []))
+
+  # each chunk is the text of its records, separated but not started or ended
+  count = 0
+  for n, text in chunks:
+    f.write((sep if count or append else start) + text)
+    count += n
+  f.write(end if count or append else empty)
+
+  return count
+
+def append_JSON(records, path, layout = 'array', pretty = True, serializer = None, jobs = 1):
+  """Add records to the end of a JSON file written by write_JSON with the same options; return the count.
+
+  A missing or empty file is just written. Newline-delimited JSON is appended to
+  as is (compressed or not), but an array has its closing bracket cut off first,
+  so it can't be compressed.
+  """
+
+  if not os.path.exists(path) or not os.path.getsize(path):
+    with open_file(path, 'w') as f:
+      return write_JSON(records, f, layout, pretty, serializer, jobs=jobs)
+
+  if layout == 'ndjson':
+    with open_file(path, 'a') as f:
+      return write_JSON(records, f, layout, pretty, serializer, jobs=jobs)
+
+  if compression(path):
+    raise ValueError('Can\'t append to a compressed JSON array: %s' %(path))
+
+  end = b'\n]\n' if pretty else b']\n'
+  with open(path, 'r+b') as f:
+    f.seek(0, os.SEEK_END)
+    size = f.tell()
+    f.seek(max(size - len(b'[]\n'), 0))
+    tail = f.read()
+    if size == len(b'[]\n') and tail == b'[]\n':
+      # nothing to carry on from
+      f.seek(0)
+    elif tail.endswith(end):
+      f.seek(size - len(end))
+    else:
+      raise ValueError('%s doesn\'t end like a JSON array written with these options.' %(path))
+    f.truncate()
+
+  with open(path, 'a') as f:
+    return write_JSON(records, f, layout, pretty, serializer, size > len(b'[]\n'), jobs)
 
 class Dexcom:
   # NB: despite what one might think, this doesn't actually want to be a general CGM data model
@@ -98,7 +257,15 @@ class Dexcom:
 
     return float(value/GLUCOSE_MOLAR_MASS)
 
-  def as_tidepool(self):
+  def tidepool_guid(self, deterministic = False):
+    """Return a random GUID, or one derived from the serial number, subtype and internal time."""
+
+    if deterministic:
+      # so exporting the same data again gives the same GUIDs
+      return str(uuid.uuid5(GUID_NAMESPACE, '-=-'.join([self.serial, self.subtype, self.internal_time])))
+    return str(uuid.uuid4())
+
+  def as_tidepool(self, deterministic = False):
     """Return a dict of the object conforming to Tidepool's data model."""
 
     tidepool_obj = {
@@ -106,7 +273,7 @@ class Dexcom:
         'conversionOffset': 0,
         'deviceId': self.device_gen + '-=-' + self.serial,
         'deviceTime': parse_datetime(self.user_time).strftime('%Y-%m-%dT%H:%M:%S'),
-        'guid': str(uuid.uuid4()),
+        'guid': self.tidepool_guid(deterministic),
         'time': self.time,
         'timezoneOffset': int(self.display_offset * 60),
         'units': 'mmol/L',
@@ -146,6 +313,165 @@ class DexcomCalibration(Dexcom):
     Dexcom.__init__(self, dct)
     self.subtype = 'calibration'
 
+class TidepoolSerializer:
+  """Write Dexcom objects as Tidepool JSON text, the same as dumping as_tidepool's dicts but without making them.
+
+  Apart from a few fields, a record's text is the same for every reading of a
+  subtype from one device in one timezone, so that text is worked out once
+  (from as_tidepool, with placeholders) and each reading just fills it in.
+  """
+
+  def __init__(self, deterministic = False):
+
+    self.deterministic = deterministic
+    self.dumps = None
+    self.templates = {}
+    # value text by mg/dL value, of which there are only a few hundred
+    self.values = {}
+
+  def dumper(self, dumps):
+    """Return a function that serializes an object like dumps(obj.as_tidepool()) would."""
+
+    self.dumps = dumps
+    self.templates = {}
+    return self.serialize
+
+  def _template(self, obj):
+    """Return a %-format string of obj's record, with a placeholder for each field that varies from reading to reading."""
+
+    # (a deterministic GUID just so as not to use up a random one)
+    record = obj.as_tidepool(deterministic=True)
+    for name in TIDEPOOL_FIELDS:
+      record[name] = TIDEPOOL_PLACEHOLDER %(name)
+    for name in TIDEPOOL_PAYLOAD_FIELDS:
+      record['payload'][name] = TIDEPOOL_PLACEHOLDER %(name)
+
+    text = self.dumps(record).replace('%', '%%')
+    return re.sub('"' + TIDEPOOL_PLACEHOLDER %('(\\w+)') + '"', r'%(\1)s', text)
+
+  def serialize(self, obj):
+    """Return the JSON text of an object's Tidepool record."""
+
+    annotations = obj.annotations
+    key = (obj.device_gen, obj.serial, obj.timezone, obj.subtype, json.dumps(annotations, sort_keys=True) if annotations else None)
+    template = self.templates.get(key)
+    if template is None:
+      template = self.templates[key] = self._template(obj)
+
+    value = obj.value
+    value_text = self.values.get(value)
+    if value_text is None:
+      value_text = self.values[value] = json.dumps(obj._convert_mgdl_to_mmoll(value))
+
+    user_time = obj.user_time
+    if _fixed_width(user_time):
+      device_time = user_time[:10] + 'T' + user_time[11:19]
+    else:
+      device_time = parse_datetime(user_time).strftime('%Y-%m-%dT%H:%M:%S')
+
+    return template %{
+      'deviceTime': '"' + device_time + '"',
+      'deviceValue': '"%d"' %(value),
+      'guid': '"' + obj.tidepool_guid(self.deterministic) + '"',
+      'internalTime': encode_basestring_ascii(obj.internal_time.replace(' ', 'T')),
+      'time': '"' + obj.time + '"',
+      'timezoneOffset': '%d' %(int(obj.display_offset * 60)),
+      'value': value_text
+    }
+
+def _row_device(row):
+  """Return the device generation and serial number at the end of a CSV row, if any."""
+
+  # all rows should have a device generation
+  try:
+    gen = row[6]
+  except IndexError:
+    gen = ''
+
+  # and a serial
+  try:
+    serial = row[7]
+  except IndexError:
+    serial = ''
+
+  return gen, serial
+
+def sensor_from_row(row):
+  """Make a DexcomSensor from the first three columns of a 'terse' CSV row."""
+
+  gen, serial = _row_device(row)
+  return DexcomSensor({
+    'generation': gen,
+    'serial': serial,
+    'internal': row[0],
+    'user': row[1],
+    'value': row[2]
+  })
+
+def calibration_from_row(row):
+  """Make a DexcomCalibration from the meter columns of a 'terse' CSV row."""
+
+  gen, serial = _row_device(row)
+  return DexcomCalibration({
+    'generation': gen,
+    'serial': serial,
+    'internal': row[3],
+    'user': row[4],
+    'value': row[5]
+  })
+
+def effective_at(obj):
+  """Return the ISO-format internal and display times of a reading, as an offset change's effective_at."""
+
+  return {
+    'internal_time': parse_datetime(obj.internal_time).isoformat(),
+    'display_time': parse_datetime(obj.user_time).isoformat()
+  }
+
+class OffsetIndex:
+  """Offset changes sorted by the internal time they're effective at, for lookup by binary search."""
+
+  def __init__(self, changes = []):
+
+    # ISO-format internal times, which sort chronologically as strings
+    self.keys = []
+    self.changes = []
+
+    for change in changes:
+      self.add(change)
+
+  def __iter__(self):
+
+    return iter(self.changes)
+
+  def __len__(self):
+
+    return len(self.changes)
+
+  def add(self, change):
+    """Add an offset change, keeping the index sorted."""
+
+    key = change['effective_at']['internal_time']
+    i = bisect_right(self.keys, key)
+    self.keys.insert(i, key)
+    self.changes.insert(i, change)
+
+  def remove(self, change):
+    """Remove an offset change (e.g., to add it back effective at a different time)."""
+
+    i = bisect_left(self.keys, change['effective_at']['internal_time'])
+    while self.changes[i] is not change:
+      i += 1
+    del self.keys[i]
+    del self.changes[i]
+
+  def get(self, internal_time):
+    """Return the change effective at exactly the given ISO-format internal time, if there is one."""
+
+    i = bisect_left(self.keys, internal_time)
+    if i < len(self.keys) and self.keys[i] == internal_time:
+      return self.changes[i]
+
 class DexcomJSON:
   """Convert input 'terse' CSV to JSON."""
 
@@ -154,37 +480,76 @@ class DexcomJSON:
 
     self.output = output_opts
 
-    reader = csv.reader(csv_file)
-    # skip the header
-    next(reader)
-    self.all = []
-    for row in reader:
-      self.all += self._parse_row(row)
+    # rows may be passed in directly (e.g., from merge_csv.merged_rows) instead of read from file
+    if 'rows' in output_opts:
+      reader = iter(output_opts['rows'])
+    else:
+      reader = csv.reader(csv_file)
+      # skip the header
+      next(reader)
+
+    with metrics.stage('construction'):
+      if output_opts.get('columnar'):
+        # typed arrays instead of one Python object per reading; already sorted
+        from dexcom.readings import DexcomReadings
+        # saved next to the CSV by merge_csv --columns, and used as is unless the CSV has changed since
+        source = getattr(csv_file, 'name', None)
+        self.all = DexcomReadings.load(source) if isinstance(source, str) else None
+        if self.all is None:
+          self.all = DexcomReadings.from_rows(reader)
+      elif output_opts.get('lazy'):
+        # rows kept as read, with objects only made for the readings actually iterated over
+        from dexcom.lazy import LazyReadings
+        self.all = LazyReadings.from_rows(reader)
+      else:
+        self.all = []
+        for row in reader:
+          self.all += self._parse_row(row)
 
-    # make sure all is sorted!
-    self.all.sort(key=lambda x: x.internal_time, reverse=True)
+        # make sure all is sorted!
+        self.all.sort(key=lambda x: x.internal_time, reverse=True)
+
+    metrics.count('objects', len(self.all))
 
     self.offsets = {'SevenPlus': 0}
 
     try:
-      with open(output_opts['bloodhound'], 'rU') as f:
+      with open(output_opts['bloodhound'], 'r') as f:
         changes = json.load(f)
         dated_changes = []
         for change in changes:
           if change['effective_at']['internal_time'] != '':
             dated_changes.append(change)
         self.offset_changes = dated_changes
-    except (FileNotFoundError, KeyError, ValueError):
+    except (FileNotFoundError, KeyError, json.JSONDecodeError):
       self.offset_changes = []
 
+    self.offset_index = OffsetIndex(self.offset_changes)
+
+    # a TimezoneResolver (see dexcom.timezones) answers _get_timezone without prompting
+    self.resolver = output_opts.get('resolver')
+
+    # runs of readings sharing a display offset, most recent first, set by bloodhound
+    self.segments = []
+    # once bloodhound has run, appended readings are sniffed as they're added
+    self.sniffed = False
+    # positions of the readings added by the last append
+    self.appended = []
+
   def sensors(self):
     """Return all and only sensor readings."""
 
+    if self.output.get('columnar') or self.output.get('lazy'):
+      return self.all.sensors()
+
     return [i for i in self.all if i.subtype == 'sensor']
 
   def calibrations(self):
     """Return all and only calibration readings."""
 
+    if self.output.get('columnar') or self.output.get('lazy'):
+      return self.all.calibrations()
+
     return [i for i in self.all if i.subtype == 'calibration']
 
   def _add_offset_change(self, diff_in_hours, obj, change_type, notstart = False):
@@ -197,158 +562,297 @@ class DexcomJSON:
       return
 
     if notstart:
-      self.offset_changes.append({
+      change = {
         'display_offset': offset,
         # timestamp of last (most recent) datum to which this offset is to be applied
-        'effective_at': {
-          'internal_time': parse_datetime(obj.internal_time).isoformat(),
-          'display_time': parse_datetime(obj.user_time).isoformat()
-        },
+        'effective_at': effective_at(obj),
         'reason': tz_res['type'],
         'subtype': 'timezone offset',
         'timezone': timezone,
         'type': 'meta'
-      })
+      }
+      self.offset_changes.append(change)
+      self.offset_index.add(change)
 
     return (offset, timezone)
 
-  def _get_offset_change(self, effective_at):
-    """Retrieve the correct offset change from the internal time effective at."""
-
-    for change in self.offset_changes:
-      if change['effective_at']['internal_time'] == parse_datetime(effective_at).isoformat():
-        return change
-
   def _get_timezone(self, obj, change_type):
     """Ask the user to input an offset for a particular Dexcom G4 Platinum CGM device."""
 
-    res = input('What timezone were you in at %s? ' %(obj.user_time))
-    dst = input('Do you think this was a shift to/from DST? (y/n) ')
-    td_offset = tz(res).utcoffset(parse_datetime(obj.user_time))
-    offset = td_offset.days * 24 + td_offset.seconds/SECONDS_IN_HOUR
-    timezone = res
-    if dst == 'y':
-      change_type += '; shift to/from DST'
-      # fall back is -1; reverse it to undo change
-      if parse_datetime(obj.user_time).month > 6:
-        offset += 1
-      # spring forward is +1; reverse it to undo change
-      else:
-        offset -= 1
+    metrics.count('timezone_questions')
+
+    with metrics.stage('timezone_resolution'):
+      # batch runs answer from a schedule or policy instead of prompting
+      if self.resolver:
+        return self.resolver.resolve(obj, change_type)
 
-    print('Offset from UTC is %d.' %offset)
+      res = input('What timezone were you in at %s? ' %(obj.user_time))
+      dst = input('Do you think this was a shift to/from DST? (y/n) ')
+      tz_res = timezone_offset(obj.user_time, change_type, res, dst == 'y')
+
+    print('Offset from UTC is %d.' %tz_res['offset'])
     print()
-    return {
-      'timezone': timezone,
-      'offset': offset,
-      'type': change_type
-    }
+    return tz_res
 
   def _parse_row(self, row):
     """Parse a CSV row into DexcomSensor and DexcomCalibration readings as appropriate."""
 
-    # all rows should have a device generation
-    try:
-      gen = row[6]
-    except IndexError:
-      gen = ''
-
-    # and a serial
-    try:
-      serial = row[7]
-    except IndexError:
-      serial = ''
-
-    # but definitely a sensor reading
-    sensor = self._parse_sensor(row)
-    sensor['generation'] = gen
-    sensor['serial'] = serial
-
-    objs = [DexcomSensor(sensor)]
+    # every row has a sensor reading
+    objs = [sensor_from_row(row)]
 
     # check first if calibration before trying to create one
     if row[3] != '':
-      objs.append(DexcomCalibration({
-        'generation': gen,
-        'serial': serial,
-        'internal': row[3],
-        'user': row[4],
-        'value': row[5]
-      }))
+      objs.append(calibration_from_row(row))
 
     return objs
 
-  def _parse_sensor(self, row):
-    """Parse just the first three columns of a Dexcom CSV row as a sensor reading."""
-
-    return {
-      'user': row[1],
-      'internal': row[0],
-      'value': row[2]
-    }
-
   def bloodhound(self, tz_str):
     """Sniff out changes to Dexcom time and date settings."""
 
-    initial_difference = ''
+    from dexcom.breakpoints import apply_offsets, find_segments, reading_arrays, INPUT_BY_USER
+
+    # only previously-known changes cover data without sniffing
+    # changes found during this run mark where sniffing found them, but sniffing carries on below them
+    known = OffsetIndex(self.offset_changes)
+
+    # includes the time spent resolving timezones (also timed separately)
+    with metrics.stage('bloodhound'):
+      readings = self.all if self.output.get('columnar') else list(self.all)
+
+      # find every point where the offset might change before asking about any of them
+      arrays = reading_arrays(readings)
+      segments = find_segments(arrays, known.keys)
+      metrics.count('segments', len(segments))
+
+      self.segments = []
+      for segment in segments:
+        if 'change' in segment:
+          change = known.changes[segment['change']]
+          offsets = (change['display_offset'], change['timezone'])
+          reason = change['reason']
+        else:
+          # the first is the most recent data, for which the user knows the timezone
+          offsets = self._add_offset_change(segment['hours'], readings[segment['start']], segment['reason'], segment['reason'] != INPUT_BY_USER)
+          reason = segment['reason']
+
+        self.segments.append({
+          'display_offset': offsets[0] if offsets else None,
+          'first_internal_time': segment['first_internal_time'],
+          'last_internal_time': segment['last_internal_time'],
+          'reason': reason,
+          'timezone': offsets[1] if offsets else None
+        })
+
+        # add offsets to each Dexcom object in the segment, making them timezone-aware
+        if offsets:
+          apply_offsets(readings, arrays, segment['start'], segment['end'], offsets)
+
+    self.sniffed = True
+    self._write_bloodhound()
+
+    if self.output.get('sqlite'):
+      self._store(readings)
 
-    effective_ats = [offset['effective_at']['internal_time'] for offset in self.offset_changes]
-    current_effective_at = ''
+    return self
 
-    for obj in self.all:
-      if parse_datetime(obj.internal_time).isoformat() in effective_ats:
-        current_effective_at = obj.internal_time
-        change = self._get_offset_change(obj.internal_time)
-        offsets = (change['display_offset'], change['timezone'])
-      elif obj.internal_time < current_effective_at:
-        change = self._get_offset_change(current_effective_at)
-        offsets = (change['display_offset'], change['timezone'])
-      else:
-        user_time = parse_datetime(obj.user_time)
-        internal_time = parse_datetime(obj.internal_time)
-
-        diff = {'timedelta': datetime_difference(user_time, internal_time)}
-
-        diff['hours'] = round(-diff['timedelta'].seconds/SECONDS_IN_HOUR)
-
-        # bootstrap from most recent data known timezone and difference to internal timestamp offset from UTC
-        if not initial_difference:
-          offsets = self._add_offset_change(diff['hours'], obj, 'input by user')
-          initial_difference = diff
-          current_difference = initial_difference
-        # offset from UTC of internal timestamps isn't consistent across G4 receivers
-        elif obj.serial != last_obj.serial and obj.device_gen == 'G4Platinum':
-          offsets = self._add_offset_change(diff['hours'], obj, 'changed G4 Platinum device', True)
-          current_difference = diff
-        # offset from UTC of internal timestamps isn't consistent across device generations
-        elif obj.device_gen != last_obj.device_gen:
-          offsets = self._add_offset_change(diff['hours'], obj, 'changed to Seven Plus device', True)
-          current_difference = diff
-        # and sometimes the user actually changed the device's settings
-        # fancy that!
-        elif diff['hours'] != current_difference['hours']:
-          offsets = self._add_offset_change(diff['hours'], obj, 'inferred via bloodhound protocol', True)
-          current_difference = diff
-
-      # add offsets to Dexcom object
-      if offsets:
-        obj.display_offset = offsets[0]
-        obj.timezone = offsets[1]
-        # make each Dexcom object timezone-aware
-        enlighten_datetime(obj)
-
-      last_obj = obj
-
-    with open('bloodhound.log', 'w') as f:
+  def _write_bloodhound(self):
+    """Write the offset changes found so far to bloodhound.log and bloodhound.json."""
+
+    with open(os.path.join(self.output.get('bloodhound_dir', ''), 'bloodhound.log'), 'w') as f:
       [print(self._printable_timezone_change(change), file=f) for change in self.offset_changes]
+      if self.resolver and self.resolver.unresolved:
+        [print(self.resolver.printable_unresolved(change), file=f) for change in self.resolver.unresolved]
+
+    if self.resolver and self.resolver.unresolved:
+      print("!!! %i offset changes couldn't be resolved; see %s." %(len(self.resolver.unresolved), os.path.join(self.output.get('bloodhound_dir', ''), 'bloodhound.log')))
+      print()
 
-    with open('bloodhound.json', 'w') as f:
-      sorted_changes = sorted(self.offset_changes, key=lambda x: x['effective_at']['internal_time'])
-      sorted_changes.reverse()
+    with open(os.path.join(self.output.get('bloodhound_dir', ''), 'bloodhound.json'), 'w') as f:
+      sorted_changes = list(reversed(self.offset_index.changes))
       print(json.dumps(sorted_changes, indent=2, separators=(',', ': '), sort_keys=True), file=f)
 
+  def append(self, rows):
+    """Add 'terse' CSV rows (without header), inserting their readings in order.
+
+    Once bloodhound has run, only the new readings are sniffed. A run of them that
+    carries on from the reading before or after it (same offset from internal time,
+    generation and serial number) takes that reading's offset, extending its
+    segment; only true new breakpoints are resolved and recorded, and
+    bloodhound.log/bloodhound.json are only rewritten if there are any. The
+    positions the new readings end up at are kept in appended (most recent first).
+    """
+
+    if self.output.get('lazy'):
+      raise ValueError('Can\'t append to lazy readings.')
+
+    with metrics.stage('append'):
+      positions = self._insert(rows)
+      self.appended = positions
+      metrics.count('objects_appended', len(positions))
+
+      if not self.sniffed:
+        return self
+
+      # each run of new readings is sniffed along with the readings either side of it
+      changed = False
+      i = 0
+      while i < len(positions):
+        j = i + 1
+        while j < len(positions) and positions[j] == positions[j - 1] + 1:
+          j += 1
+        changed = self._sniff_run(positions[i], positions[j - 1] + 1) or changed
+        i = j
+
+      self.segments.sort(key=lambda segment: segment['last_internal_time'], reverse=True)
+
+    if changed:
+      self._write_bloodhound()
+
+    if self.output.get('sqlite'):
+      self._store([self.all[i] for i in self.appended])
+
     return self
 
+  def _store(self, readings):
+    """Upsert readings, with their offsets and UTC times, and the offset segments into the SQLite store (see dexcom.store)."""
+
+    from dexcom.store import DexcomStore
+
+    store = DexcomStore(self.output['sqlite'])
+    try:
+      with metrics.stage('store'):
+        count = store.add_readings(readings)
+        store.add_segments(self.segments)
+    finally:
+      store.close()
+
+    metrics.count('readings_stored', count)
+
+  def _insert(self, rows):
+    """Insert the readings in rows in order; return the positions they end up at, in order."""
+
+    if self.output.get('columnar'):
+      from dexcom.readings import DexcomReadings
+      return self.all.insert(DexcomReadings.from_rows(rows)).tolist()
+
+    new = []
+    for row in rows:
+      new += self._parse_row(row)
+    new.sort(key=lambda x: x.internal_time, reverse=True)
+
+    # after any readings already here at the same time, as in the sort in __init__
+    at = []
+    for obj in new:
+      lo, hi = at[-1] if at else 0, len(self.all)
+      while lo < hi:
+        mid = (lo + hi) // 2
+        if self.all[mid].internal_time < obj.internal_time:
+          hi = mid
+        else:
+          lo = mid + 1
+      at.append(lo)
+
+    # from the end, so the insertion points before each splice stay put
+    j = len(new)
+    while j:
+      i = j - 1
+      while i and at[i - 1] == at[j - 1]:
+        i -= 1
+      self.all[at[i]:at[i]] = new[i:j]
+      j = i
+
+    return [position + i for i, position in enumerate(at)]
+
+  def _segment_at(self, internal_time):
+    """Return the segment an ISO-format internal time falls in, if any."""
+
+    for segment in self.segments:
+      if segment['first_internal_time'] <= internal_time <= segment['last_internal_time']:
+        return segment
+
+  def _sniff_run(self, start, end):
+    """Give a run of newly inserted readings offsets; return whether any offset changes were found or moved."""
+
+    from dexcom.breakpoints import apply_offsets, find_segments, reading_arrays, INPUT_BY_USER
+
+    readings = self.all
+    # the readings either side, if there are any (most recent first, so the one before is newer)
+    before = start > 0
+    after = end < len(readings)
+    first = start - 1 if before else start
+    window = readings[first:end + 1]
+    # splits wherever the offset from internal time, generation or serial number changes
+    runs = find_segments(reading_arrays(window), [])
+
+    def timed(obj):
+      return (obj.display_offset, obj.timezone) if obj.time else None
+
+    def apply(lo, hi, offsets):
+      if offsets and lo < hi:
+        run = readings[lo:hi]
+        apply_offsets(run, reading_arrays(run), 0, hi - lo, offsets)
+
+    changed = False
+    for j, run in enumerate(runs):
+      lo, hi = first + run['start'], first + run['end']
+      # the new readings in the run
+      new_lo, new_hi = max(lo, start), min(hi, end)
+
+      if before and j == 0:
+        # carries on from the reading before, extending its segment
+        neighbour = readings[start - 1]
+        apply(new_lo, new_hi, timed(neighbour))
+        segment = self._segment_at(parse_datetime(neighbour.internal_time).isoformat())
+        if segment and new_lo < new_hi:
+          segment['first_internal_time'] = min(segment['first_internal_time'], parse_datetime(readings[new_hi - 1].internal_time).isoformat())
+
+      elif after and j == len(runs) - 1:
+        # carries on to the reading after, whose segment now reaches up to the run
+        neighbour = readings[end]
+        offsets = timed(neighbour)
+        apply(new_lo, new_hi, offsets)
+        newest = parse_datetime(readings[lo].internal_time).isoformat()
+        key = parse_datetime(neighbour.internal_time).isoformat()
+
+        change = self.offset_index.get(key)
+        if change is not None and lo < end:
+          self.offset_index.remove(change)
+          change['effective_at'] = effective_at(readings[lo])
+          if j:
+            change['reason'] = run['reason']
+          self.offset_index.add(change)
+          changed = True
+        elif change is None and j and offsets:
+          # e.g., the most recent segment, which has new readings after it now
+          self._add_offset_change(run['hours'], readings[lo], run['reason'], True)
+          changed = True
+
+        segment = self._segment_at(key)
+        if segment:
+          if before and j and segment['last_internal_time'] != key:
+            # the run splits the segment; the part after it carries on from the reading before
+            upper = dict(segment)
+            upper['first_internal_time'] = parse_datetime(readings[first + runs[0]['end'] - 1].internal_time).isoformat()
+            self.segments.append(upper)
+          segment['last_internal_time'] = newest
+          if j:
+            segment['reason'] = run['reason']
+
+      else:
+        # a true new breakpoint (or, for the most recent readings, the timezone the user is in now)
+        offsets = self._add_offset_change(run['hours'], readings[lo], run['reason'], run['reason'] != INPUT_BY_USER)
+        changed = changed or run['reason'] != INPUT_BY_USER
+        apply(lo, hi, offsets)
+        self.segments.append({
+          'display_offset': offsets[0] if offsets else None,
+          'first_internal_time': parse_datetime(readings[hi - 1].internal_time).isoformat(),
+          'last_internal_time': parse_datetime(readings[lo].internal_time).isoformat(),
+          'reason': run['reason'],
+          'timezone': offsets[1] if offsets else None
+        })
+
+    return changed
+
   def _printable_timezone_change(self, change):
     """Return a multiline string reflecting a timezone change in human-readable format for printing."""
 
@@ -361,11 +865,44 @@ class DexcomJSON:
   def print_JSON(self):
     """Print as JSON to specified output file in specified format."""
 
-    to_print = {
-      'tidepool': [obj.as_tidepool() for obj in self.all]
+    # only data whose timezone bloodhound could work out (see enlighten_datetime) is printed
+    if self.output.get('columnar'):
+      # a view of the columns, which can be handed to worker processes in slices
+      timed = self.all._select(self.all.columns['time'] != '')
+    else:
+      timed = (obj for obj in self.all if obj.time)
+
+    # records are serialized in chunks as they're produced, never all at once
+    to_print, serializer = {
+      'tidepool': (timed, TidepoolSerializer(self.output.get('deterministic_guids', False)))
     }[self.output['format']]
 
-    with open(self.output['file'], 'w') as f:
-      print(json.dumps(to_print, separators=(',', ': '), indent=2, sort_keys=True), file=f)
+    # serializing is split over this many worker processes
+    jobs = self.output.get('jobs') or 1
+
+    with metrics.stage('serialization'):
+      # e.g., records for newly arrived readings (see dexcom.watch)
+      if self.output.get('append'):
+        count = append_JSON(to_print, self.output['file'], self.output.get('layout', 'array'), self.output.get('pretty', True), serializer, jobs)
+      else:
+        # compressed on the fly if the file name ends in .gz, .bz2 or .xz
+        with open_file(self.output['file'], 'w') as f:
+          count = write_JSON(to_print, f, self.output.get('layout', 'array'), self.output.get('pretty', True), serializer, jobs=jobs)
+
+    metrics.count('records_written', count)
+    return self
+
+  def upload(self, uploader):
+    """Post the records print_JSON would print with an uploader (see dexcom.upload.TidepoolUploader), oldest first."""
+
+    # oldest first, each record made as the uploader gets to it
+    if self.output.get('columnar'):
+      timed = reversed(self.all._select(self.all.columns['time'] != ''))
+    else:
+      timed = (obj for obj in reversed(self.all) if obj.time)
+
+    with metrics.stage('upload'):
+      self.upload_summary = uploader.run(timed)
 
+    metrics.count('records_uploaded', self.upload_summary['records'])
     return self
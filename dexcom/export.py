@@ -0,0 +1,97 @@
+# Copyright (c) 2014, Jana E. Beck
+# Contact: jana.eliz.beck@gmail.com
+# License: GPLv3 (http://www.gnu.org/licenses/gpl-3.0.txt)
+
+from __future__ import print_function
+
+from collections import deque
+from itertools import islice
+import multiprocessing
+
+from dexcom.convert_to_JSON import json_format, DexcomCalibration, DexcomSensor, TidepoolSerializer
+
+# number of readings handed to a worker process at a time
+EXPORT_CHUNK_SIZE = 10000
+
+# number of chunks handed out per worker process ahead of the one being written, so only a few are in memory at once
+CHUNKS_PER_JOB = 2
+
+def compact(obj):
+  """Return what a Dexcom object's Tidepool record is made from, as a tuple of strings and numbers."""
+
+  # 'Low' and 'High' are stored as out-of-range values with an annotation
+  value = obj.annotations[0]['value'].capitalize() if obj.annotations else str(obj.value)
+  return (obj.subtype, obj.internal_time, obj.user_time, obj.device_gen, obj.serial, value, obj.display_offset, obj.timezone, obj.time)
+
+def from_compact(record):
+  """Make a Dexcom object, with the offset and time bloodhound gave it, from a compact tuple."""
+
+  subtype, internal, user, gen, serial, value, display_offset, timezone, time = record
+  obj = {'calibration': DexcomCalibration, 'sensor': DexcomSensor}[subtype]({
+    'generation': gen,
+    'internal': internal,
+    'serial': serial,
+    'user': user,
+    'value': value
+  })
+  obj.display_offset = display_offset
+  obj.timezone = timezone
+  obj.time = time
+  return obj
+
+def _chunks(records, size):
+  """Yield chunks of readings, in order, small enough to pickle cheaply: column slices of a DexcomReadings, or compact tuples."""
+
+  from dexcom.readings import DexcomReadings
+
+  if isinstance(records, DexcomReadings):
+    for i in range(0, len(records.index), size):
+      rows = records.index[i:i + size]
+      yield {
+        'columns': dict([(name, column[rows]) for name, column in records.columns.items()]),
+        'generations': records.generations,
+        'serials': records.serials
+      }
+    return
+
+  records = iter(records)
+  for chunk in iter(lambda: list(map(compact, islice(records, size))), []):
+    yield {'records': chunk}
+
+def serialize_chunk(task):
+  """Return the number of readings in a chunk and their Tidepool JSON text, separated as by write_JSON."""
+
+  from dexcom.readings import DexcomReadings
+
+  chunk = task['chunk']
+  if 'columns' in chunk:
+    readings = DexcomReadings(chunk['columns'], chunk['generations'], chunk['serials'])
+  else:
+    readings = map(from_compact, chunk['records'])
+
+  dumps, start, sep, end, empty = json_format(task['layout'], task['pretty'])
+  dumps = TidepoolSerializer(task['deterministic']).dumper(dumps)
+  texts = list(map(dumps, readings))
+  return len(texts), sep.join(texts)
+
+def serialize_chunks(records, layout, pretty, deterministic, jobs):
+  """Serialize readings as Tidepool JSON in a pool of worker processes; yield each chunk's count and text, in order."""
+
+  pool = multiprocessing.Pool(jobs)
+  try:
+    # pool.imap would read every chunk out of records ahead of the workers
+    pending = deque()
+    for chunk in _chunks(records, EXPORT_CHUNK_SIZE):
+      if len(pending) == jobs * CHUNKS_PER_JOB:
+        yield pending.popleft().get()
+      pending.append(pool.apply_async(serialize_chunk, ({
+        'chunk': chunk,
+        'deterministic': deterministic,
+        'layout': layout,
+        'pretty': pretty
+      },)))
+    while pending:
+      yield pending.popleft().get()
+  finally:
+    pool.close()
+    pool.join()
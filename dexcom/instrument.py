@@ -0,0 +1,106 @@
+# Copyright (c) 2014, Jana E. Beck
+# Contact: jana.eliz.beck@gmail.com
+# License: GPLv3 (http://www.gnu.org/licenses/gpl-3.0.txt)
+
+from __future__ import print_function
+
+from contextlib import contextmanager
+import cProfile
+import json
+import time
+
+class Metrics:
+  """Per-stage timers and counters for a run, reported as JSON at the end."""
+
+  def __init__(self):
+
+    self.verbose = False
+    self.reset()
+
+  def reset(self):
+    """Forget everything timed and counted so far."""
+
+    self.stages = {}
+    self.counters = {}
+    # stage name -> path to dump cProfile stats to (see dump_profiles)
+    self.profiles = {}
+    # stage name -> a cProfile.Profile that's on whenever that stage runs
+    self.profilers = {}
+    # only one profiler can be on at a time, so a profiled stage nested in another is covered by the outer one's
+    self.profiling = None
+
+  @contextmanager
+  def stage(self, name):
+    """Time a stage of the run; stages can be nested, and each is timed separately."""
+
+    profiler = None
+    if name in self.profiles and self.profiling is None:
+      profiler = self.profilers.setdefault(name, cProfile.Profile())
+      self.profiling = name
+      profiler.enable()
+
+    start = time.time()
+    try:
+      yield
+    finally:
+      elapsed = time.time() - start
+      if profiler:
+        profiler.disable()
+        self.profiling = None
+      stage = self.stages.setdefault(name, {'calls': 0, 'seconds': 0.0})
+      stage['calls'] += 1
+      stage['seconds'] += elapsed
+
+  def count(self, name, n = 1):
+    """Add n to a counter."""
+
+    self.counters[name] = self.counters.get(name, 0) + n
+
+  def profile(self, name, path):
+    """Run cProfile whenever the named stage runs, for dump_profiles to save the stats (see pstats) to path."""
+
+    self.profiles[name] = path
+
+  def dump_profiles(self):
+    """Save the stats profiled over every run of each stage."""
+
+    for name, profiler in self.profilers.items():
+      profiler.dump_stats(self.profiles[name])
+
+  def add(self, report):
+    """Add the timings and counts from another run's report (e.g., from a worker process)."""
+
+    for name, n in report['counters'].items():
+      self.count(name, n)
+    for name, other in report['stages'].items():
+      stage = self.stages.setdefault(name, {'calls': 0, 'seconds': 0.0})
+      stage['calls'] += other['calls']
+      stage['seconds'] += other['seconds']
+
+  def report(self):
+    """Return everything timed and counted as a dict."""
+
+    return {
+      'counters': dict(self.counters),
+      'stages': dict([(name, dict(stage)) for name, stage in self.stages.items()])
+    }
+
+  def write(self, path):
+    """Write the report to file as JSON."""
+
+    with open(path, 'w') as f:
+      print(json.dumps(self.report(), indent=2, separators=(',', ': '), sort_keys=True), file=f)
+
+# shared by all the modules in the package
+metrics = Metrics()
+
+def set_verbose(verbose):
+  """Turn progress messages on or off."""
+
+  metrics.verbose = bool(verbose)
+
+def log(*args, **kwargs):
+  """Print a progress message, but only if progress messages are turned on."""
+
+  if metrics.verbose:
+    print(*args, **kwargs)
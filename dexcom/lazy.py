@@ -0,0 +1,101 @@
+# Copyright (c) 2014, Jana E. Beck
+# Contact: jana.eliz.beck@gmail.com
+# License: GPLv3 (http://www.gnu.org/licenses/gpl-3.0.txt)
+
+from __future__ import print_function
+
+import csv
+from datetime import timedelta as td
+from heapq import merge
+from itertools import takewhile
+
+from dexcom.convert_to_JSON import calibration_from_row, sensor_from_row, parse_datetime, DEX_FORMAT
+
+class LazyReadings:
+  """Readings kept as the 'terse' CSV rows they came from, made into Dexcom objects only when iterated over.
+
+  Views (sensors, calibrations, recent) share the rows and the objects made so
+  far, so each object is made at most once and changes to it (e.g., by
+  bloodhound) show up in every view.
+  """
+
+  def __init__(self, rows, objs, sensor_order, calibration_order):
+
+    self.rows = rows
+    # keyed by 2 * row for sensor readings and 2 * row + 1 for calibrations,
+    # which is also the order the eager DexcomJSON makes them in
+    self.objs = objs
+    # row numbers, most recent first
+    self.sensor_order = sensor_order
+    self.calibration_order = calibration_order
+
+  @classmethod
+  def from_csv(cls, csv_file):
+    """Read a 'terse' CSV file (with header)."""
+
+    reader = csv.reader(csv_file)
+    next(reader)
+    return cls.from_rows(reader)
+
+  @classmethod
+  def from_rows(cls, reader):
+    """Keep 'terse' CSV rows (without header) and put them in order, without making any objects."""
+
+    rows = [tuple(row) for row in reader]
+    # stable, so equal times stay in row order, as in DexcomJSON's sort
+    sensor_order = sorted(range(len(rows)), key=lambda i: rows[i][0], reverse=True)
+    calibration_order = sorted([i for i in range(len(rows)) if rows[i][3] != ''], key=lambda i: rows[i][3], reverse=True)
+    return cls(rows, {}, sensor_order, calibration_order)
+
+  def __len__(self):
+
+    return len(self.sensor_order) + len(self.calibration_order)
+
+  def __iter__(self):
+    """Yield sensor readings and calibrations together, most recent first."""
+
+    sensors = ((self.rows[i][0], -2 * i) for i in self.sensor_order)
+    calibrations = ((self.rows[i][3], -2 * i - 1) for i in self.calibration_order)
+    for time, key in merge(sensors, calibrations, reverse=True):
+      yield self._get(-key)
+
+  def __reversed__(self):
+    """Yield sensor readings and calibrations together, oldest first."""
+
+    sensors = ((self.rows[i][0], -2 * i) for i in reversed(self.sensor_order))
+    calibrations = ((self.rows[i][3], -2 * i - 1) for i in reversed(self.calibration_order))
+    for time, key in merge(sensors, calibrations):
+      yield self._get(-key)
+
+  def _get(self, key):
+    """Return the object for a key, making it if it hasn't been made yet."""
+
+    obj = self.objs.get(key)
+    if obj is None:
+      row = self.rows[key >> 1]
+      obj = calibration_from_row(row) if key & 1 else sensor_from_row(row)
+      self.objs[key] = obj
+    return obj
+
+  def sensors(self):
+    """Return a view of all and only sensor readings."""
+
+    return LazyReadings(self.rows, self.objs, self.sensor_order, [])
+
+  def calibrations(self):
+    """Return a view of all and only calibration readings."""
+
+    return LazyReadings(self.rows, self.objs, [], self.calibration_order)
+
+  def recent(self, days):
+    """Return a view of the readings within a number of days (by internal time) of the most recent one."""
+
+    latest = [self.rows[order[0]][column] for order, column in [(self.sensor_order, 0), (self.calibration_order, 3)] if order]
+    latest = max(latest) if latest else ''
+    if latest == '':
+      return self
+
+    cutoff = (parse_datetime(latest) - td(days=days)).strftime(DEX_FORMAT)
+    return LazyReadings(self.rows, self.objs,
+      list(takewhile(lambda i: self.rows[i][0] >= cutoff, self.sensor_order)),
+      list(takewhile(lambda i: self.rows[i][3] >= cutoff, self.calibration_order)))
@@ -1,4 +1,6 @@
 # usage: merge_csv.py [-h] [-c] [-d] [-o OUTPUT_FILE] [-p DIR_PATH] [-s] [-t]
+#                     [-j JOBS] [-i] [-v] [--metrics METRICS] [--profile STAGE]
+#                     [--stream] [--sqlite SQLITE] [--memory MB] [--columns]
 #
 # Merge a set of Dexcom .csv exports (from Dexcom Studio) into one .csv file.
 #
@@ -7,12 +9,32 @@
 #   -c, --csv             comma- (instead of tab-)delimited output
 #   -d, --device-gen      include a column for device generation information
 #   -o OUTPUT_FILE, --output-file OUTPUT_FILE
-#                         path and/or name of output file
+#                         path and/or name of output file (compressed if it
+#                         ends in .gz, .bz2 or .xz)
 #   -p DIR_PATH, --path DIR_PATH
 #                         path to the directory where all your Dexcom Studio
-#                         .csv exports are stored
+#                         .csv exports are stored (optionally compressed with
+#                         gzip, bzip2 or xz)
 #   -s, --serial-number   include a column for device serial number
 #   -t, --terse           output only glucose and timestamps columns
+#   -j JOBS, --jobs JOBS  number of worker processes to parse the files with
+#   -i, --incremental     only merge new or changed files into an existing output
+#                         file, using a manifest stored next to it
+#   -v, --verbose         print progress messages
+#   --metrics METRICS     write timings and counts for each stage of the run to
+#                         this JSON file
+#   --profile STAGE       run cProfile around a stage (e.g. parse, dedup, sort,
+#                         write), saving the stats to STAGE.prof
+#   --stream              merge the files as sorted streams instead of in memory
+#                         (peak memory bounded by the number of files); can't
+#                         be combined with -i, -j, --sqlite or --memory
+#   --sqlite SQLITE       also upsert the merged readings into this SQLite
+#                         database (implies -s)
+#   --memory MB           memory budget for deduplicating records, past which
+#                         they spill to sorted temporary files
+#   --columns             also save the merged readings as typed columns in
+#                         OUTPUT_FILE.columns, which DexcomJSON's columnar mode
+#                         loads instead of parsing the CSV (implies -c and -t)
 #
 # Copyright (c) 2014, Jana E. Beck
 # Contact: jana.eliz.beck@gmail.com
@@ -22,167 +44,777 @@ from __future__ import print_function
 
 import argparse
 import csv
+import hashlib
+import heapq
+import io
+from itertools import islice, repeat
+import json
+import locale
+import mmap
+import multiprocessing
 import os
+import pickle
 import re
+import tempfile
+
+# run as a script from within dexcom/, or imported as part of the package
+try:
+  from dexcom.compressed import compression, open_file, strip_compression
+  from dexcom.instrument import log, metrics, set_verbose
+  from dexcom.store import DexcomStore
+except ImportError:
+  from compressed import compression, open_file, strip_compression
+  from instrument import log, metrics, set_verbose
+  from store import DexcomStore
+
+# compile regexes for Dexcom Seven Plus vs. G4 Platinum device serial numbers
+SEVEN_PLUS = re.compile('\d.+')
+G4_PLATINUM = re.compile('SM\d.+')
+
+# header of a Dexcom Studio export
+EXPECTED_HEADER = ['PatientInfoField', 'PatientInfoValue', 'GlucoseInternalTime', 'GlucoseDisplayTime', 'GlucoseValue', 'MeterInternalTime', 'MeterDisplayTime', 'MeterValue', 'EventLoggedInternalTime', 'EventLoggedDisplayTime', 'EventTime', 'EventType', 'EventDescription']
+
+# header of 'terse' output, before device generation and serial number columns
+TERSE_HEADER = ['GlucoseInternalTime', 'GlucoseDisplayTime', 'GlucoseValue', 'MeterInternalTime', 'MeterDisplayTime', 'MeterValue']
+
+# size in bytes of each record's entry in the incremental dedup index (SHA-1)
+DIGEST_SIZE = 20
+
+# between the fields of a packed record (see pack_row)
+PACK_SEPARATOR = '\x00'
+
+# rough size in bytes of a packed record in a DexcomSet, besides its contents
+ROW_OVERHEAD = 64
+
+# number of records pickled at a time to a spilled run
+SPILL_CHUNK_SIZE = 10000
+
+# number of records upserted into a --sqlite store at a time, as they're written out
+STORE_CHUNK_SIZE = 10000
 
 class DexcomSet:
   """Construct a set of non-duplicate Dexcom records from a group of Dexcom files."""
 
-  def __init__(self, files):
-    """Call _add_rows_from_file(f) to fill the set with non-duplicate records."""
+  def __init__(self, files, jobs = 1, memory = None):
+    """Call _add_rows_from_file(f) to fill the set with non-duplicate records.
 
+    With a memory budget (in bytes), records past it are spilled to disk in sorted
+    runs, which are merged (and any duplicates between them dropped) by _sort.
+    """
+
+    # packed records (see pack_row)
     self.set = set([])
 
+    self.memory = memory
+    # rough size of the records in the set
+    self.size = 0
+    # temporary files, each with a sorted run of the records that were in the set
+    self.runs = []
+    self.spilled = 0
+    # duplicates between runs, once _sort has merged them
+    self.merged_duplicates = None
+
     self.files = files
 
     self.serials = []
 
+    # number of readings in each file, by file name
+    self.counts = {}
+
+    # files that turned out not to be Dexcom files
+    self.skipped = []
+
     # only used for terminal logging
     self.total_so_far = 0
 
-    for f in self.files:
-      self._add_rows_from_file(f)
+    if jobs > 1:
+      # parse the files in worker processes, but add them to the set in the original order
+      # so that the per-file logging is the same as when parsing one file at a time
+      pool = multiprocessing.Pool(jobs)
+      try:
+        batches = pool.imap(read_file, [f['file'] for f in self.files])
+        for f in self.files:
+          # time spent waiting on the workers
+          with metrics.stage('parse'):
+            batch = next(batches)
+          self._add_batch(f, batch)
+      finally:
+        pool.close()
+        pool.join()
+    else:
+      for f in self.files:
+        self._add_rows_from_file(f)
 
   def _add_rows_from_file(self, this_file):
     """Add the records from a file to the DexcomSet."""
 
-    # compile regexes for Dexcom Seven Plus vs. G4 Platinum device serial numbers
-    seven_plus = re.compile('\d.+')
-    g4_platinum = re.compile('SM\d.+')
+    with metrics.stage('parse'):
+      batch = read_file(this_file['file'])
+    self._add_batch(this_file, batch)
 
-    count = 0
-    missing = 0
-
-    # have to fill a list with items to add to the set first
-    # in case we need to append the serial number, which doesn't appear until the 3rd row
-    add_to_set = []
-
-    with open(this_file['file'], 'rU') as f:
-      rdr = csv.reader(f, delimiter='\t')
-      # exclude header
-      next(rdr)
-      for row in rdr:
-        # sniff out serial number, which occurs in column to the right of label 'SerialNumber'
-        if row[0] == 'SerialNumber':
-          this_SN = row[1]
-        # replace first two cols with '' because want to avoid duplicates with rows that have ID info
-        row[0] = ''
-        row[1] = ''
-        add_to_set.append(row)
-        count += 1
+  def _add_batch(self, this_file, batch):
+    """Add the records parsed from a file by read_file to the DexcomSet."""
 
-    # search for a match between the serial number and one of the pre-compiled regexes
-    if seven_plus.match(this_SN):
-      generation = 'SevenPlus'
-    elif g4_platinum.match(this_SN):
-      generation = 'G4Platinum'
-    else:
-      generation = 'Unknown'
-
-    for item in add_to_set:
-      # if adding device generation info is desire, append it to saved rows
-      if this_file['add_generation_info']:
-        item.append(generation)
-      if this_file['add_sn_info']:
-        item.append(this_SN)
-      # set uses a hash internally and hash keys must be immutable types
-      # i.e., tuple, not list
-      self.set.add(tuple(item))
+    if batch is None:
+      print()
+      print("!!! This file doesn't look like a Dexcom file: \n%s \nI'm skipping it. :(" %(this_file['file']))
+      print()
+      metrics.count('files_skipped')
+      self.skipped.append(this_file['file'])
+      return
+
+    count = len(batch['rows'])
+    self.counts[this_file['file']] = count
+
+    extra = ''
+    # if adding device generation info is desired, append it to saved rows
+    if this_file['add_generation_info']:
+      extra += PACK_SEPARATOR + batch['generation']
+    if this_file['add_sn_info']:
+      extra += PACK_SEPARATOR + batch['serial']
+    extra = extra.encode('utf-8')
+
+    with metrics.stage('dedup'):
+      before = len(self.set)
+      self.set.update([row + extra for row in batch['rows']] if extra else batch['rows'])
+      if count:
+        # each packed record also costs a bytes object header and a slot in the set
+        self.size += (len(self.set) - before) * (sum(map(len, batch['rows'])) // count + len(extra) + ROW_OVERHEAD)
+
+    metrics.count('rows_parsed', count)
+    metrics.count('duplicates', self.total_so_far + count - len(self))
 
     # give the command-line user some insight into what's going on
-    print("%i readings in %s." %(count, this_file['file']))
-    print("%i items in DexcomSet." %(len(self.set)))
-    if len(self.set) - self.total_so_far != count:
-      duplicates = ((self.total_so_far + count) - len(self.set))
-      print("%i duplicate records in this file." %(duplicates))
-    print()
-    self.total_so_far = len(self.set)
+    log("%i readings in %s." %(count, this_file['file']))
+    log("%i items in DexcomSet." %(len(self)))
+    if len(self) - self.total_so_far != count:
+      duplicates = ((self.total_so_far + count) - len(self))
+      log("%i duplicate records in this file." %(duplicates))
+    log()
+    self.total_so_far = len(self)
+
+    if self.memory and self.size > self.memory:
+      self._spill()
+
+  def __len__(self):
+    """Return the number of records, counting any duplicates between spilled runs until _sort drops them."""
+
+    return self.spilled + len(self.set)
+
+  def _spill(self):
+    """Write the records in memory to a temporary file as a sorted run, and start the set over."""
+
+    with metrics.stage('spill'):
+      rows = sorted(self.set)
+      run = tempfile.TemporaryFile()
+      for i in range(0, len(rows), SPILL_CHUNK_SIZE):
+        pickle.dump(rows[i:i + SPILL_CHUNK_SIZE], run, pickle.HIGHEST_PROTOCOL)
+
+    self.runs.append(run)
+    self.spilled += len(rows)
+    self.set = set([])
+    self.size = 0
+    metrics.count('runs_spilled')
+
+    log("%i records spilled to disk (%i runs so far)." %(len(rows), len(self.runs)))
+    log()
+
+  def _read_run(self, run):
+    """Yield the packed records of a spilled run, in order."""
+
+    run.seek(0)
+    while True:
+      try:
+        rows = pickle.load(run)
+      except EOFError:
+        return
+      for row in rows:
+        yield row
+
+  def _merge_runs(self, rows):
+    """Yield non-duplicate packed records from the spilled runs and the (sorted) ones in memory, in order."""
+
+    last = None
+    duplicates = 0
+    for row in heapq.merge(*[self._read_run(run) for run in self.runs] + [rows]):
+      # identical records from different runs end up next to each other
+      if row == last:
+        duplicates += 1
+        continue
+      last = row
+      yield row
+
+    if self.merged_duplicates is None:
+      self.merged_duplicates = duplicates
+      metrics.count('duplicates', duplicates)
+      log("%i duplicate records between spilled runs." %(duplicates))
+      log()
 
   def _sort(self):
-    """Sort the DexcomSet by GlucoseInternalTime."""
+    """Sort the DexcomSet by GlucoseInternalTime; return an iterator over the records as tuples."""
+
+    # the first two columns are always blank, so sorting on the whole record sorts by GlucoseInternalTime
+    # and breaks ties between different records deterministically
+    with metrics.stage('sort'):
+      rows = sorted(self.set)
+
+    # unpacked only as they're used
+    return unpack_rows(self._merge_runs(rows) if self.runs else rows)
 
-    return sorted(self.set, key=lambda t: t[2])
+  def print_set(self, header, delimiter, output_file = 'merged-dexcom.csv', rows = None):
+    """Print the DexcomSet row-by-row to file; rows, if given, are its records as _sort returns them."""
+
+    count = write_rows(self._sort() if rows is None else rows, header, delimiter, output_file)
+
+    log("%i non-duplicate records printed to %s." %(count, output_file))
+    log()
+
+class DexcomStream:
+  """Merge a group of Dexcom files into non-duplicate records without loading them all into memory."""
+
+  def __init__(self, files):
+
+    self.files = files
+
+    # only used for terminal logging
+    self.duplicates = 0
+
+  def _rows_from_file(self, this_file):
+    """Return an iterator over the records of a file in the same order as DexcomSet._sort."""
+
+    this_SN = get_serial_number(this_file['file'])
+
+    extra = []
+    if this_file['add_generation_info']:
+      extra.append(get_generation(this_SN))
+    if this_file['add_sn_info']:
+      extra.append(this_SN)
+
+    def rows():
+      with open_file(this_file['file'], 'r') as f:
+        rdr = csv.reader(f, delimiter='\t')
+        # exclude header
+        next(rdr)
+        for row in rdr:
+          yield tuple(['', ''] + row[2:] + extra)
+
+    # exports are (nearly always) already in order, so check that first without holding on to anything
+    last = None
+    in_order = True
+    for item in rows():
+      if last is not None and item < last:
+        in_order = False
+        break
+      last = item
+
+    if in_order:
+      return rows()
+
+    # otherwise only this one file has to be sorted in memory
+    log("%s isn't sorted by GlucoseInternalTime; sorting it in memory." %(this_file['file']))
+    log()
+    return iter(sorted(rows()))
+
+  def _merge(self):
+    """Yield non-duplicate records from all files in sorted order via a k-way merge."""
+
+    last = None
+    for item in heapq.merge(*[self._rows_from_file(f) for f in self.files]):
+      # identical records from overlapping files end up next to each other
+      if item == last:
+        self.duplicates += 1
+        metrics.count('duplicates')
+        continue
+      last = item
+      yield item
 
   def print_set(self, header, delimiter, output_file = 'merged-dexcom.csv'):
-    """Print the DexcomSet row-by-row to file."""
+    """Print the merged records row-by-row to file as they are produced."""
+
+    count = write_rows(self._merge(), header, delimiter, output_file)
+
+    log("%i duplicate records skipped." %(self.duplicates))
+    log("%i non-duplicate records printed to %s." %(count, output_file))
+    log()
+
+class DexcomManifest:
+  """Keep track of which files and records have already been merged into an output file."""
+
+  def __init__(self, output_file, options):
+    """Load the manifest and dedup index stored next to the output file, if they're still valid."""
+
+    self.output_file = output_file
+    self.path = output_file + '.manifest.json'
+    self.index_path = output_file + '.index'
+
+    # files checked during this run, added to the manifest once they've been merged
+    self.pending = {}
 
+    try:
+      with open(self.path, 'r') as f:
+        manifest = json.load(f)
+      with open(self.index_path, 'rb') as f:
+        index = f.read()
+      # the manifest is only good for the same output options and an output file nobody else has rewritten
+      fresh = manifest['options'] == options and manifest['output'] == self._stat(output_file)
+      files, last = manifest['files'], manifest['last']
+    except (FileNotFoundError, KeyError, json.JSONDecodeError):
+      fresh = False
+
+    if fresh:
+      self.files = files
+      self.last = last
+      self.index = set([index[i:i + DIGEST_SIZE] for i in range(0, len(index), DIGEST_SIZE)])
+      self.index_mode = 'ab'
+    else:
+      self.files = {}
+      self.last = None
+      self.index = set([])
+      # start the dedup index over along with the output file
+      self.index_mode = 'wb'
+
+    self.options = options
+
+  def _stat(self, this_file):
+    """Return the size and modification time of a file."""
+
+    try:
+      st = os.stat(this_file)
+    except FileNotFoundError:
+      return None
+    return [st.st_size, st.st_mtime]
+
+  def _hash(self, this_file):
+    """Return the SHA-1 hash of a file's contents."""
+
+    sha = hashlib.sha1()
+    with open(this_file, 'rb') as f:
+      for chunk in iter(lambda: f.read(1 << 20), b''):
+        sha.update(chunk)
+    return sha.hexdigest()
+
+  def changed_files(self, files):
+    """Return only the files that are new or have changed since they were last merged."""
+
+    changed = []
+
+    for f in files:
+      key = os.path.abspath(f)
+      size, mtime = self._stat(f)
+      known = self.files.get(key)
+      if known and known['size'] == size and known['mtime'] == mtime:
+        continue
+      sha = self._hash(f)
+      # touched but not actually changed
+      if known and known['sha1'] == sha:
+        known['mtime'] = mtime
+        continue
+      self.pending[key] = {
+        'mtime': mtime,
+        'rows': None,
+        'sha1': sha,
+        'size': size
+      }
+      changed.append(f)
+
+    return changed
+
+  def print_set(self, dex, header, delimiter, rows = None):
+    """Merge the records in a DexcomSet that haven't been merged before into the output file; return them.
+
+    rows, if given, are the set's records as its _sort returns them.
+    """
+
+    new = []
+    digests = []
+    for item in dex._sort() if rows is None else rows:
+      digest = row_digest(item)
+      if digest not in self.index:
+        new.append(item)
+        digests.append(digest)
+
+    log("%i new non-duplicate records." %(len(new)))
+    log()
+
+    if new and (self.last is None or not os.path.exists(self.output_file)):
+      write_rows(new, header, delimiter, self.output_file)
+    # the usual case: everything new is more recent than what's already there
+    elif new and list(new[0]) >= self.last:
+      write_rows(new, header, delimiter, self.output_file, 'a')
+    elif new:
+      self._merge_into_output(new, header, delimiter)
+
+    if new:
+      with open(self.index_path, self.index_mode) as f:
+        f.write(b''.join(digests))
+      self.index_mode = 'ab'
+      self.index.update(digests)
+      if self.last is None or list(new[-1]) > self.last:
+        self.last = list(new[-1])
+
+    self.save(dex.counts)
+    return new
+
+  def skip(self, this_file):
+    """Record a file that isn't a Dexcom file so it won't be checked again until it changes."""
+
+    self.pending[os.path.abspath(this_file)]['rows'] = None
+
+  def _merge_into_output(self, new, header, delimiter):
+    """Rewrite the output file with new records merged into their sorted positions."""
+
+    # keeping any compression extension, so the temporary file is compressed the same way
+    base = strip_compression(self.output_file)
+    tmp = base + '.tmp' + self.output_file[len(base):]
     count = 0
 
-    with open(output_file, 'w') as f:
+    log("### Merging new records into %s..." %(self.output_file))
+    log()
+
+    with open_file(self.output_file, 'r', newline='') as f_in:
+      with open_file(tmp, 'w') as f_out:
+        rdr = csv.reader(f_in, delimiter=delimiter)
+        wrtr = csv.writer(f_out, delimiter=delimiter)
+        wrtr.writerow(next(rdr))
+        for row in heapq.merge(rdr, [project_row(item, header) for item in new]):
+          wrtr.writerow(row)
+          count += 1
+
+    os.replace(tmp, self.output_file)
+
+    log("%i records now in %s." %(count, self.output_file))
+    log()
+
+  def save(self, counts = {}):
+    """Add the files checked during this run to the manifest and write it next to the output file."""
+
+    counts = dict([(os.path.abspath(f), count) for f, count in counts.items()])
+
+    for key, entry in self.pending.items():
+      # files that were skipped (i.e., not Dexcom files) stay in the manifest with no rows
+      # so that they aren't checked again until they change
+      entry['rows'] = counts.get(key, entry['rows'])
+      self.files[key] = entry
+    self.pending = {}
+
+    with open(self.path, 'w') as f:
+      print(json.dumps({
+        'files': self.files,
+        'last': self.last,
+        'options': self.options,
+        'output': self._stat(self.output_file)
+      }, indent=2, separators=(',', ': '), sort_keys=True), file=f)
+
+def _read_text(this_file):
+  """Return the whole text of a file, with universal newlines, read through a memory map unless it's compressed."""
+
+  if compression(this_file):
+    with open_file(this_file, 'r', newline='') as f:
+      text = f.read()
+  else:
+    with open(this_file, 'rb') as f:
+      try:
+        m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+      except ValueError:
+        # an empty file can't be mapped
+        return ''
+      try:
+        # decoded straight out of the map, without reading into a buffer first
+        text = str(m, locale.getpreferredencoding(False))
+      finally:
+        m.close()
+
+  if '\r' in text:
+    text = text.replace('\r\n', '\n').replace('\r', '\n')
+  return text
+
+def read_file(this_file):
+  """Check the header of, parse and find the serial number in a Dexcom file, all in a single pass.
+
+  Returns a batch of records (with the patient info columns blanked) plus the
+  file's device info, or None if it doesn't look like a Dexcom file.
+  """
+
+  text = _read_text(this_file)
+
+  # fields are never quoted in Dexcom Studio exports, so lines can just be split on tabs
+  quoted = '"' in text
+  if quoted:
+    lines = list(csv.reader(io.StringIO(text), delimiter='\t'))
+    split = lambda row: row
+  else:
+    lines = text.split('\n')
+    if lines[-1] == '':
+      lines.pop()
+    split = lambda line: line.split('\t')
+
+  if not lines or split(lines[0]) != EXPECTED_HEADER:
+    return None
+
+  this_SN = ''
+  rows = []
+
+  # first two cols of every record are blank because want to avoid duplicates with rows that have ID info
+  # records are packed into bytes (see pack_row), which are compact, hashable and sort like the rows do
+  i = 1
+  while i < len(lines):
+    row = split(lines[i])
+    # patient info only appears in the first few rows
+    if len(row) < 2 or (row[0] == '' and row[1] == ''):
+      break
+    # sniff out serial number, which occurs in column to the right of label 'SerialNumber'
+    if row[0] == 'SerialNumber':
+      this_SN = row[1]
+    rows.append(pack_row(('', '') + tuple(row[2:])))
+    i += 1
+
+  data = islice(lines, i, None)
+  if not quoted and text.count('\n\t\t') == len(lines) - i:
+    # the rest already have them blank, so each line is already a packed record, once encoded
+    if i < len(lines):
+      rows += '\n'.join(data).replace('\t', PACK_SEPARATOR).encode('utf-8').split(b'\n')
+  else:
+    for row in map(split, data):
+      if row and row[0] == 'SerialNumber':
+        this_SN = row[1]
+      rows.append(pack_row(('', '') + tuple(row[2:])))
+
+  return {
+    'generation': get_generation(this_SN),
+    'rows': rows,
+    'serial': this_SN
+  }
+
+def pack_row(row):
+  """Pack a record (a tuple of strings) into bytes, which compare and sort the same way the tuples do."""
+
+  # the separator sorts before any character that can be in a field, so a shorter field sorts first either way
+  return PACK_SEPARATOR.join(row).encode('utf-8')
+
+def unpack_rows(rows):
+  """Return packed records as tuples of strings."""
+
+  return map(tuple, map(str.split, map(bytes.decode, rows), repeat(PACK_SEPARATOR)))
+
+def get_generation(this_SN):
+  """Return the device generation for a Dexcom serial number."""
+
+  # search for a match between the serial number and one of the pre-compiled regexes
+  if SEVEN_PLUS.match(this_SN):
+    return 'SevenPlus'
+  elif G4_PLATINUM.match(this_SN):
+    return 'G4Platinum'
+  else:
+    return 'Unknown'
+
+def get_serial_number(this_file):
+  """Get the device serial number from the patient info rows at the top of a Dexcom file."""
+
+  with open_file(this_file, 'r', newline='') as f:
+    rdr = csv.reader(f, delimiter='\t')
+    # exclude header
+    next(rdr)
+    for row in rdr:
+      # sniff out serial number, which occurs in column to the right of label 'SerialNumber'
+      if row[0] == 'SerialNumber':
+        return row[1]
+      # patient info only appears in the first few rows
+      if row[0] == '':
+        break
+
+  return ''
+
+def project_row(item, header):
+  """Return the columns of a merged record that are named in the header."""
+
+  # header for terse can be 6 if no device gen, 7 if device gen
+  if len(header) == 6:
+    return list(item)[2:8]
+  elif len(header) == 7:
+    # device gen is in very last column
+    return list(item)[2:8] + [list(item)[-1]]
+  elif len(header) == 8:
+    # serial number is in very last column
+    return list(item)[2:8] + list(item)[-2:]
+  else:
+    return list(item)
+
+def row_digest(item):
+  """Return a fixed-size digest of a merged record for the persistent dedup index."""
+
+  return hashlib.sha1('\t'.join(item).encode('utf-8')).digest()
+
+def write_rows(items, header, delimiter, output_file, mode = 'w'):
+  """Write merged records to file, keeping only the columns named in the header; return the count."""
+
+  count = 0
+
+  with metrics.stage('write'):
+    with open_file(output_file, mode) as f:
       wrtr = csv.writer(f, delimiter=delimiter)
-      print("### Writing to new file %s..." %(output_file))
-      print()
-      wrtr.writerow(header)
-      for item in self._sort():
-        # header for terse can be 6 if no device gen, 7 if device gen
-        if len(header) == 6:
-          to_write = list(item)[2:8]
-        elif len(header) == 7:
-          # device gen is in very last column
-          to_write = list(item)[2:8] + [list(item)[-1]]
-        elif len(header) == 8:
-          # serial number is in very last column
-          to_write = list(item)[2:8] + list(item)[-2:]
-        else:
-          to_write = list(item)
-        wrtr.writerow(to_write)
+      if mode == 'a':
+        log("### Appending to file %s..." %(output_file))
+        log()
+      else:
+        log("### Writing to new file %s..." %(output_file))
+        log()
+        wrtr.writerow(header)
+      for item in items:
+        wrtr.writerow(project_row(item, header))
         count += 1
 
-    print("%i non-duplicate records printed to %s." %(count, output_file))
-    print()
+  metrics.count('rows_written', count)
+  return count
 
 def get_header(this_file):
   """Get the header of a Dexcom file."""
 
-  with open(this_file, 'rU', newline='') as f:
+  with open_file(this_file, 'r', newline='') as f:
     rdr = csv.reader(f, delimiter='\t')
     return next(rdr)
 
+def get_dexcom_files(files):
+  """Return only the files that look like Dexcom Studio exports, judging by their headers."""
+
+  dexcom_files = []
+
+  with metrics.stage('header_validation'):
+    for f in files:
+      if get_header(f) != EXPECTED_HEADER:
+        print()
+        print("!!! This file doesn't look like a Dexcom file: \n%s \nI'm skipping it. :(" %(f))
+        print()
+        metrics.count('files_skipped')
+      else:
+        dexcom_files.append(f)
+
+  return dexcom_files
+
 def get_file_list(path = ""):
-  """Get the list of files with .csv or .txt extensions in the target directory."""
+  """Get the list of files with .csv or .txt extensions (optionally followed by .gz, .bz2 or .xz) in the target directory."""
 
   all_files = []
 
-  for root, dirs, files in os.walk(path):
-    # compile a list of all non-OS .txt and .csv files for consideration as possible Dexcom files
-    all_files += [os.path.join(root, f) for f in files if (f.endswith('.txt') or f.endswith('.csv') and not (f.startswith('$') or f.startswith('._')))]
+  with metrics.stage('discovery'):
+    for root, dirs, files in os.walk(path):
+      # compile a list of all non-OS .txt and .csv files for consideration as possible Dexcom files
+      # (compressed or not)
+      all_files += [os.path.join(root, f) for f in files if (strip_compression(f).endswith('.txt') or strip_compression(f).endswith('.csv') and not (f.startswith('$') or f.startswith('._')))]
 
+  metrics.count('files_found', len(all_files))
   return all_files
 
+def merged_rows(dir_path, jobs = 1, memory = None):
+  """Merge the Dexcom files in a directory; return 'terse' rows with device generation and serial number, without writing a file."""
+
+  files = get_file_list(dir_path)
+
+  # non-Dexcom files are skipped as they're read
+  dex = DexcomSet([{
+    'add_generation_info': True,
+    'add_sn_info': True,
+    'file': f
+  } for f in files], jobs, memory)
+
+  header = TERSE_HEADER + ['DeviceGeneration', 'SerialNumber']
+
+  return [project_row(item, header) for item in dex._sort()]
+
+def write_columns(output_file):
+  """Save the typed columns of a 'terse' merged CSV file next to it (see DexcomReadings.save), unless they're up to date."""
+
+  # needs numpy, which nothing else here does
+  from dexcom.readings import read_columns_header, DexcomReadings
+
+  if read_columns_header(output_file) is not None:
+    return
+
+  with metrics.stage('columns'):
+    with open_file(output_file, 'r', newline='') as f:
+      readings = DexcomReadings.from_csv(f)
+    readings.save(output_file)
+
+  log("%i readings saved as columns next to %s." %(len(readings), output_file))
+  log()
+
 def process(args):
 
+  args = dict(args)
+
+  # readings in the database are keyed on serial number, and stored with their device generation
+  if args.get('sqlite'):
+    args['serial'] = True
+    args['device_gen'] = True
+
+  # DexcomJSON reads 'terse' comma-delimited files
+  if args.get('columns'):
+    args['csv'] = True
+    args['terse'] = True
+
+  # progress messages are only printed if asked for
+  set_verbose(args.get('verbose'))
+
+  for stage in args.get('profile') or []:
+    metrics.profile(stage, '%s.prof' %(stage))
+
+  try:
+    _process(args)
+  finally:
+    metrics.dump_profiles()
+    if args.get('metrics'):
+      metrics.write(args['metrics'])
+
+def _process(args):
+
   # first, get the list of files accessible from the given or current path
   if args['dir_path']:
     files = get_file_list(args['dir_path'])
   else:
     files = get_file_list()
 
-  # check each file to see if it might be a Dexcom file; remove those that aren't
-  expected_header = ['PatientInfoField', 'PatientInfoValue', 'GlucoseInternalTime', 'GlucoseDisplayTime', 'GlucoseValue', 'MeterInternalTime', 'MeterDisplayTime', 'MeterValue', 'EventLoggedInternalTime', 'EventLoggedDisplayTime', 'EventTime', 'EventType', 'EventDescription']
-
-  to_remove = []
+  output_file = args['output_file'] or 'merged-dexcom.csv'
+
+  # only look at files that are new or changed since the last incremental run
+  manifest = None
+  if args.get('incremental'):
+    manifest = DexcomManifest(output_file, {
+      'csv': args['csv'],
+      'device_gen': args['device_gen'],
+      'serial': args['serial'],
+      'terse': args['terse']
+    })
+    with metrics.stage('manifest'):
+      files = manifest.changed_files(files)
+
+  # streaming keeps only one pending record per file in memory; output is identical
+  stream = args.get('stream')
+  if stream and (manifest or args.get('sqlite')):
+    print('!!! --stream can\'t be combined with %s; merging in memory instead.' %('--incremental' if manifest else '--sqlite'))
+    stream = False
+  if stream and ((args.get('jobs') or 1) > 1 or args.get('memory')):
+    print('!!! --stream merges in one process without spilling; ignoring --jobs and --memory.')
 
-  for f in files:
-    if get_header(f) != expected_header:
-      print()
-      print("!!! This file doesn't look like a Dexcom file: \n%s \nI'm skipping it. :(" %(f))
-      print()
-      to_remove.append(f)
-
-  [files.remove(f) for f in to_remove]
+  # check each file to see if it might be a Dexcom file; remove those that aren't
+  # (the in-memory merge checks each file's header as it parses it instead)
+  if stream:
+    files = get_dexcom_files(files)
+
+  if manifest and not files:
+    log()
+    log("Nothing new to merge into %s." %(output_file))
+    log()
+    manifest.save()
+    if args.get('columns'):
+      write_columns(output_file)
+    return
 
   # set new header if output format is 'terse'
   if args['terse']:
-    header = ['GlucoseInternalTime', 'GlucoseDisplayTime', 'GlucoseValue', 'MeterInternalTime', 'MeterDisplayTime', 'MeterValue']
+    header = list(TERSE_HEADER)
 
   else:
-    try:
-      header = get_header(files[0])
-    except IndexError:
-      print()
-      print("Sorry, I couldn't find any Dexcom files in this directory. Try giving me a path to the directory where you've stored them.")
-      print()
-      exit(0)
+    # the header of every Dexcom file
+    header = list(EXPECTED_HEADER)
 
   # append a column label for device generation if desired in output
   if args['device_gen']:
@@ -190,25 +822,68 @@ def process(args):
   if args['serial']:
     header.append('SerialNumber')
   # create a DexcomSet instance to merge records
-  print()
-  print('### Merging the following files:')
-  [print(f) for f in files]
-  print()
+  log()
+  log('### Merging the following files:')
+  [log(f) for f in files]
+  log()
 
-  dex = DexcomSet([{
+  files = [{
     'add_generation_info': args['device_gen'],
     'add_sn_info': args['serial'],
     'file': f
-  } for f in files])
+  } for f in files]
+
+  if stream:
+    dex = DexcomStream(files)
+  else:
+    # memory budget in MB
+    dex = DexcomSet(files, args.get('jobs') or 1, args['memory'] << 20 if args.get('memory') else None)
+    if manifest:
+      [manifest.skip(f) for f in dex.skipped]
+
+  if not args['terse'] and not manifest and not (files if stream else dex.counts):
+    print()
+    print("Sorry, I couldn't find any Dexcom files in this directory. Try giving me a path to the directory where you've stored them.")
+    print()
+    exit(0)
 
   # set the delimiter to csv if desired; default is tab
   delimiter = ',' if args['csv'] else '\t'
 
+  # records already sorted for the print function, if any
+  sorted_rows = {}
+  stored = [0]
+  if args.get('sqlite'):
+    store = DexcomStore(args['sqlite'])
+
+    def stored_rows():
+      # the records are upserted a chunk at a time on their way to the output file, so they're only sorted once
+      records = dex._sort()
+      for chunk in iter(lambda: list(islice(records, STORE_CHUNK_SIZE)), []):
+        with metrics.stage('store'):
+          # process makes sure these rows have the serial number the readings are keyed on
+          stored[0] += store.add_rows([project_row(item, TERSE_HEADER + ['DeviceGeneration', 'SerialNumber']) for item in chunk])
+        for item in chunk:
+          yield item
+
+    sorted_rows['rows'] = stored_rows()
+
   # pass the header, delimiter, and output file if provided to the DexcomSet's print function
-  if args['output_file']:
-    dex.print_set(header, delimiter, args['output_file'])
+  if manifest:
+    manifest.print_set(dex, header, delimiter, **sorted_rows)
+  elif args['output_file']:
+    dex.print_set(header, delimiter, args['output_file'], **sorted_rows)
   else:
-    dex.print_set(header, delimiter)
+    dex.print_set(header, delimiter, **sorted_rows)
+
+  if args.get('columns'):
+    write_columns(output_file)
+
+  if args.get('sqlite'):
+    store.close()
+    metrics.count('readings_stored', stored[0])
+    log("%i readings upserted into %s." %(stored[0], args['sqlite']))
+    log()
 
 def main():
 
@@ -216,13 +891,28 @@ def main():
 
   parser.add_argument('-c', '--csv', action='store_true', help='comma- (instead of tab-)delimited output')
   parser.add_argument('-d', '--device-gen', action='store_true', dest='device_gen', help='include a column for device generation information')
-  parser.add_argument('-o', '--output-file', action='store', dest="output_file", help='path and/or name of output file')
-  parser.add_argument('-p', '--path', action='store', dest="dir_path", help='path to the directory where all your Dexcom Studio .csv exports are stored')
+  parser.add_argument('-o', '--output-file', action='store', dest="output_file", help='path and/or name of output file (compressed if it ends in .gz, .bz2 or .xz)')
+  parser.add_argument('-p', '--path', action='store', dest="dir_path", help='path to the directory where all your Dexcom Studio .csv exports are stored (optionally compressed with gzip, bzip2 or xz)')
   parser.add_argument('-s', '--serial-number', action='store_true', dest='serial', help='include a column for device serial number')
   parser.add_argument('-t', '--terse', action='store_true', help='output only glucose and timestamps columns')
+  parser.add_argument('-j', '--jobs', action='store', type=int, default=1, help='number of worker processes to parse the files with')
+  parser.add_argument('-i', '--incremental', action='store_true', help='only merge new or changed files into an existing output file, using a manifest stored next to it')
+  parser.add_argument('-v', '--verbose', action='store_true', help='print progress messages')
+  parser.add_argument('--metrics', action='store', help='write timings and counts for each stage of the run to this JSON file')
+  parser.add_argument('--profile', action='append', metavar='STAGE', help='run cProfile around a stage (e.g. parse, dedup, sort, write), saving the stats to STAGE.prof')
+  parser.add_argument('--stream', action='store_true', help='merge the files as sorted streams instead of in memory (peak memory bounded by the number of files); can\'t be combined with -i, -j, --sqlite or --memory')
+  parser.add_argument('--sqlite', action='store', help='also upsert the merged readings into this SQLite database (implies -s)')
+  parser.add_argument('--memory', action='store', type=int, metavar='MB', help='memory budget for deduplicating records, past which they spill to sorted temporary files')
+  parser.add_argument('--columns', action='store_true', help='also save the merged readings as typed columns in OUTPUT_FILE.columns, which DexcomJSON\'s columnar mode loads instead of parsing the CSV (implies -c and -t)')
 
   args = parser.parse_args()
 
+  # the streaming merge writes a fresh output file, in one process, without a dedup pass to spill from
+  if args.stream:
+    for flag, given in [('-i/--incremental', args.incremental), ('-j/--jobs', args.jobs != 1), ('--sqlite', args.sqlite), ('--memory', args.memory)]:
+      if given:
+        parser.error('--stream can\'t be combined with %s' %(flag))
+
   # force adding of device gen info when adding serial, to keep things simpler
   if args.serial:
     args.device_gen = True
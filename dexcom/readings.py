@@ -0,0 +1,393 @@
+# Copyright (c) 2014, Jana E. Beck
+# Contact: jana.eliz.beck@gmail.com
+# License: GPLv3 (http://www.gnu.org/licenses/gpl-3.0.txt)
+
+from __future__ import print_function
+
+import csv
+from datetime import datetime as dt, timedelta as td
+import json
+import os
+import struct
+
+import numpy as np
+
+from dexcom.convert_to_JSON import Dexcom, DEX_FORMAT
+
+EPOCH = dt(1970, 1, 1)
+
+# codes for the subtype column
+SENSOR = 0
+CALIBRATION = 1
+
+SUBTYPES = ['sensor', 'calibration']
+
+# codes for the out-of-range column
+IN_RANGE = 0
+LOW = 1
+HIGH = 2
+
+# values substituted for 'Low' and 'High', as in Dexcom._set_value
+LOW_VALUE = 39
+HIGH_VALUE = 401
+
+# typed columns saved next to a merged CSV file (see DexcomReadings.save)
+COLUMNS_SUFFIX = '.columns'
+COLUMNS_MAGIC = b'DEXCOLS1'
+
+# columns kept in the sidecar; bloodhound's are made fresh on loading
+STORED_COLUMNS = ['internal', 'internal_ms', 'display', 'display_ms', 'value', 'out_of_range', 'subtype', 'generation', 'serial']
+
+# columns start on multiples of this many bytes, so they can be used straight out of the mmap
+COLUMN_ALIGNMENT = 8
+
+def _stat(this_file):
+  """Return the size and modification time of a file."""
+
+  try:
+    st = os.stat(this_file)
+  except FileNotFoundError:
+    return None
+  return [st.st_size, st.st_mtime]
+
+def read_columns_header(source):
+  """Return the header of the columns sidecar of a merged CSV file, or None if it's missing or stale."""
+
+  try:
+    with open(source + COLUMNS_SUFFIX, 'rb') as f:
+      if f.read(len(COLUMNS_MAGIC)) != COLUMNS_MAGIC:
+        return None
+      size = struct.unpack('<I', f.read(4))[0]
+      header = json.loads(f.read(size).decode('utf-8'))
+  except (FileNotFoundError, struct.error, ValueError):
+    return None
+
+  # the CSV has been rewritten since
+  if header['source'] != _stat(source):
+    return None
+  return header
+
+def format_time(seconds, millis):
+  """Return a Dexcom time and date string from epoch seconds and milliseconds (-1 if there weren't any)."""
+
+  dt_str = (EPOCH + td(seconds=int(seconds))).strftime(DEX_FORMAT)
+  if millis >= 0:
+    # gen 'SevenPlus' date and time info includes milliseconds
+    dt_str += '.%03d' %(millis)
+  return dt_str
+
+def parse_times(dt_strs):
+  """Parse a list of Dexcom time and date strings into int64 epoch seconds and int16 milliseconds (-1 if none)."""
+
+  ms = np.array(dt_strs, dtype='datetime64[ms]').astype(np.int64)
+  seconds = ms // 1000
+  millis = (ms - seconds * 1000).astype(np.int16)
+  # keep track of which strings had milliseconds so they can be written back out the same way
+  millis[np.array([len(s) <= 19 for s in dt_strs], dtype=bool)] = -1
+  return seconds, millis
+
+def parse_values(values):
+  """Parse a list of Dexcom values into int16 values and uint8 out-of-range flags."""
+
+  values = np.array(values)
+  out_of_range = np.zeros(len(values), dtype=np.uint8)
+  out_of_range[values == 'Low'] = LOW
+  out_of_range[values == 'High'] = HIGH
+  values = np.where(out_of_range == LOW, str(LOW_VALUE), np.where(out_of_range == HIGH, str(HIGH_VALUE), values))
+  values = values.astype(np.int16)
+  # calibrations can go below 40 and over 400
+  bad = (out_of_range == IN_RANGE) & ((values < 20) | (values > 600))
+  if bad.any():
+    raise Exception('Dexcom value out of range:', values[bad][0])
+  return values, out_of_range
+
+class DexcomReadings:
+  """Columnar store of Dexcom sensor and calibration readings, most recent first."""
+
+  def __init__(self, columns, generations, serials, index = None):
+    """Wrap the typed columns of a store; index selects (a view of) a subset of the rows."""
+
+    self.columns = columns
+    self.generations = generations
+    self.serials = serials
+    self.index = np.arange(len(columns['internal'])) if index is None else index
+
+  @classmethod
+  def from_csv(cls, csv_file):
+    """Build a store in one pass over a 'terse' CSV file."""
+
+    reader = csv.reader(csv_file)
+    # skip the header
+    next(reader)
+    return cls.from_rows(reader)
+
+  @classmethod
+  def from_rows(cls, reader):
+    """Build a store in one pass over 'terse' rows (without the header)."""
+
+    internal = []
+    display = []
+    values = []
+    subtypes = []
+    gens = []
+    serials = []
+
+    for row in reader:
+      # all rows should have a device generation and a serial
+      gen = row[6] if len(row) > 6 else ''
+      serial = row[7] if len(row) > 7 else ''
+      if row[0] != '':
+        internal.append(row[0])
+        display.append(row[1])
+        values.append(row[2])
+        subtypes.append(SENSOR)
+        gens.append(gen)
+        serials.append(serial)
+      if row[3] != '':
+        internal.append(row[3])
+        display.append(row[4])
+        values.append(row[5])
+        subtypes.append(CALIBRATION)
+        gens.append(gen)
+        serials.append(serial)
+
+    columns = {}
+    columns['internal'], columns['internal_ms'] = parse_times(internal)
+    columns['display'], columns['display_ms'] = parse_times(display)
+    columns['value'], columns['out_of_range'] = parse_values(values)
+    columns['subtype'] = np.array(subtypes, dtype=np.uint8)
+    generations, gen_codes = np.unique(np.array(gens, dtype=str), return_inverse=True)
+    serial_names, serial_codes = np.unique(np.array(serials, dtype=str), return_inverse=True)
+    columns['generation'] = gen_codes.astype(np.uint8)
+    columns['serial'] = serial_codes.astype(np.uint16)
+
+    # make sure all is sorted (most recent first); a stable sort keeps sensor before calibration for ties
+    key = columns['internal'] * 1000 + np.maximum(columns['internal_ms'], 0)
+    order = np.argsort(-key, kind='mergesort')
+    for name in columns:
+      columns[name] = columns[name][order]
+
+    # set by bloodhound
+    columns['display_offset'] = np.zeros(len(order), dtype=np.float64)
+    columns['timezone'] = np.empty(len(order), dtype=object)
+    columns['time'] = np.empty(len(order), dtype=object)
+    columns['time'][:] = ''
+
+    return cls(columns, list(generations), list(serial_names))
+
+  @classmethod
+  def load(cls, source):
+    """Open the columns sidecar of a merged CSV file (see save) via mmap; return None if it's missing or stale."""
+
+    header = read_columns_header(source)
+    if header is None:
+      return None
+
+    blob = np.memmap(source + COLUMNS_SUFFIX, dtype=np.uint8, mode='r')
+    count = header['count']
+    columns = {}
+    for name, dtype, offset in header['columns']:
+      dtype = np.dtype(dtype)
+      columns[name] = blob[offset:offset + count * dtype.itemsize].view(dtype)
+
+    # set by bloodhound
+    columns['display_offset'] = np.zeros(count, dtype=np.float64)
+    columns['timezone'] = np.empty(count, dtype=object)
+    columns['time'] = np.empty(count, dtype=object)
+    columns['time'][:] = ''
+
+    return cls(columns, header['generations'], header['serials'])
+
+  def save(self, source):
+    """Write the typed columns, in order, to a sidecar next to the merged CSV file they were read from.
+
+    The sidecar is a small JSON header (with the CSV's size and modification time,
+    so a rewritten CSV makes it stale) followed by each column's raw bytes.
+    """
+
+    columns = [np.ascontiguousarray(self.columns[name][self.index]) for name in STORED_COLUMNS]
+    header = {
+      'columns': [],
+      'count': len(self.index),
+      'generations': self.generations,
+      'serials': self.serials,
+      'source': _stat(source)
+    }
+
+    # offsets are from the start of the file, so the header has to be sized first
+    size = len(COLUMNS_MAGIC) + 4 + len(json.dumps(header)) + len(STORED_COLUMNS) * 64
+    offset = size
+    for name, column in zip(STORED_COLUMNS, columns):
+      offset += -offset % COLUMN_ALIGNMENT
+      header['columns'].append([name, column.dtype.str, offset])
+      offset += column.nbytes
+    text = json.dumps(header).encode('utf-8')
+    if len(COLUMNS_MAGIC) + 4 + len(text) > size:
+      raise ValueError('Columns header too long.')
+
+    tmp = source + COLUMNS_SUFFIX + '.tmp'
+    with open(tmp, 'wb') as f:
+      f.write(COLUMNS_MAGIC + struct.pack('<I', size - len(COLUMNS_MAGIC) - 4) + text.ljust(size - len(COLUMNS_MAGIC) - 4))
+      for (name, dtype, offset), column in zip(header['columns'], columns):
+        f.write(b'\0' * (offset - f.tell()))
+        f.write(column.tobytes())
+    os.replace(tmp, source + COLUMNS_SUFFIX)
+
+  def insert(self, other):
+    """Insert another store's readings in order, copying each column once; return the positions they end up at."""
+
+    def order_key(store, rows):
+      # as in from_rows, negated so it's ascending
+      return -(store.columns['internal'][rows] * 1000 + np.maximum(store.columns['internal_ms'][rows], 0))
+
+    def bound(key, lo, hi):
+      # like np.searchsorted(..., side='right'), without working out every reading's key
+      while lo < hi:
+        mid = (lo + hi) // 2
+        if order_key(self, self.index[mid]) <= key:
+          lo = mid + 1
+        else:
+          hi = mid
+      return lo
+
+    # after any readings already here at the same time; only the stretch the new readings fall in is searched
+    keys = order_key(other, other.index)
+    lo = bound(keys[0], 0, len(self.index)) if len(keys) else 0
+    hi = bound(keys[-1], lo, len(self.index)) if len(keys) else 0
+    at = lo + np.searchsorted(order_key(self, self.index[lo:hi]), keys, side='right')
+
+    values = dict([(name, other.columns[name][other.index]) for name in self.columns])
+    # the other store's generation and serial codes, recoded as this one's (with any new names added at the end)
+    for names, name in [('generations', 'generation'), ('serials', 'serial')]:
+      mine = getattr(self, names)
+      for code in getattr(other, names):
+        if code not in mine:
+          mine.append(code)
+      recode = np.array([mine.index(code) for code in getattr(other, names)], dtype=self.columns[name].dtype)
+      values[name] = recode[values[name]]
+
+    # views are in order, so one of every row is the whole store as it is
+    whole = len(self.index) == len(self.columns['internal'])
+    for name in self.columns:
+      column = self.columns[name] if whole else self.columns[name][self.index]
+      self.columns[name] = np.insert(column, at, values[name])
+    self.index = np.arange(len(self.columns['internal']))
+
+    return at + np.arange(len(at))
+
+  def __len__(self):
+
+    return len(self.index)
+
+  def __getitem__(self, i):
+
+    # a slice is a view of a run of readings
+    if isinstance(i, slice):
+      return DexcomReadings(self.columns, self.generations, self.serials, self.index[i])
+
+    return DexcomRow(self, self.index[i])
+
+  def __iter__(self):
+
+    for i in self.index:
+      yield DexcomRow(self, i)
+
+  def __reversed__(self):
+
+    for i in self.index[::-1]:
+      yield DexcomRow(self, i)
+
+  def _select(self, mask):
+    """Return a view of the rows where mask is True."""
+
+    return DexcomReadings(self.columns, self.generations, self.serials, self.index[mask[self.index]])
+
+  def sensors(self):
+    """Return all and only sensor readings."""
+
+    return self._select(self.columns['subtype'] == SENSOR)
+
+  def calibrations(self):
+    """Return all and only calibration readings."""
+
+    return self._select(self.columns['subtype'] == CALIBRATION)
+
+class DexcomRow(Dexcom):
+  """A single reading in a DexcomReadings store, usable wherever a Dexcom object is."""
+
+  def __init__(self, store, i):
+
+    self.store = store
+    self.i = i
+
+  def _column(self, name):
+
+    return self.store.columns[name][self.i]
+
+  @property
+  def internal_time(self):
+    return format_time(self._column('internal'), self._column('internal_ms'))
+
+  @property
+  def user_time(self):
+    return format_time(self._column('display'), self._column('display_ms'))
+
+  @property
+  def device_gen(self):
+    return self.store.generations[self._column('generation')]
+
+  @property
+  def serial(self):
+    return self.store.serials[self._column('serial')]
+
+  @property
+  def value(self):
+    return int(self._column('value'))
+
+  @property
+  def type(self):
+    return 'bg'
+
+  @property
+  def subtype(self):
+    return SUBTYPES[self._column('subtype')]
+
+  @property
+  def annotations(self):
+    flag = self._column('out_of_range')
+    if flag == LOW:
+      return [{
+        'code': 'bg/out-of-range',
+        'threshold': 40,
+        'value': 'low'
+      }]
+    elif flag == HIGH:
+      return [{
+        'code': 'bg/out-of-range',
+        'threshold': 400,
+        'value': 'high'
+      }]
+
+  @property
+  def display_offset(self):
+    return self._column('display_offset')
+
+  @display_offset.setter
+  def display_offset(self, offset):
+    self.store.columns['display_offset'][self.i] = offset
+
+  @property
+  def timezone(self):
+    return self._column('timezone')
+
+  @timezone.setter
+  def timezone(self, timezone):
+    self.store.columns['timezone'][self.i] = timezone
+
+  @property
+  def time(self):
+    return self._column('time')
+
+  @time.setter
+  def time(self, time):
+    self.store.columns['time'][self.i] = time
@@ -0,0 +1,105 @@
+# Copyright (c) 2014, Jana E. Beck
+# Contact: jana.eliz.beck@gmail.com
+# License: GPLv3 (http://www.gnu.org/licenses/gpl-3.0.txt)
+
+from __future__ import print_function
+
+import numpy as np
+
+from dexcom.convert_to_JSON import SECONDS_IN_HOUR
+from dexcom.readings import DexcomReadings
+
+# Dexcom sensors read every five minutes
+INTERVAL = 300
+
+# gaps at least this long (in seconds) are flagged, e.g. sensor warmup or a receiver swap
+MIN_GAP = 15 * 60
+
+def utc_readings(dex):
+  """Return the UTC times (datetime64[s]) and values of a DexcomJSON's sensor readings, oldest first.
+
+  Only readings bloodhound could place in time (see enlighten_datetime) are included.
+  """
+
+  sensors = dex.sensors()
+
+  if isinstance(sensors, DexcomReadings):
+    columns = sensors.columns
+    index = sensors.index[columns['time'][sensors.index] != '']
+    display = columns['display'][index]
+    offsets = columns['display_offset'][index]
+    values = columns['value'][index].astype(np.float64)
+  else:
+    sensors = [obj for obj in sensors if obj.time]
+    display = np.array([obj.user_time[:19] for obj in sensors], dtype='datetime64[s]').astype(np.int64)
+    offsets = np.array([obj.display_offset for obj in sensors], dtype=np.float64)
+    values = np.array([obj.value for obj in sensors], dtype=np.float64)
+
+  # the same instant as the `time` attribute, without parsing its ISO string
+  times = (display - np.round(offsets * SECONDS_IN_HOUR).astype(np.int64)).astype('datetime64[s]')
+
+  order = np.argsort(times, kind='mergesort')
+  return times[order], values[order]
+
+def _runs(mask):
+  """Return the start indices and lengths of the runs of True in a boolean array."""
+
+  edges = np.diff(np.concatenate([[0], mask.astype(np.int8), [0]]))
+  starts = np.flatnonzero(edges == 1)
+  return starts, np.flatnonzero(edges == -1) - starts
+
+def resample(times, values, interval = INTERVAL, min_gap = MIN_GAP, interpolate = 0):
+  """Align readings onto a fixed grid in UTC.
+
+  Each reading goes to the nearest grid point; near-simultaneous readings that
+  land on the same point are averaged. Runs of empty grid points at least
+  min_gap seconds long are indexed as gaps, and empty runs of up to
+  interpolate seconds are filled in linearly. Returns a dict of arrays:
+  'start' (UTC time of the first grid point), 'interval', 'values' (float32,
+  NaN where empty), 'counts' (readings per grid point), 'interpolated',
+  'gap_starts' and 'gap_lengths' (in grid points).
+  """
+
+  if not len(times):
+    return None
+
+  seconds = times.astype('datetime64[s]').astype(np.int64)
+  # grid points are multiples of interval since the epoch, and the grid starts on the first one with a reading
+  slot = np.round(seconds / float(interval)).astype(np.int64)
+  start = slot.min() * interval
+  slot -= slot.min()
+  n = slot.max() + 1
+
+  counts = np.bincount(slot, minlength=n)
+  with np.errstate(invalid='ignore', divide='ignore'):
+    grid = (np.bincount(slot, weights=values, minlength=n) / counts).astype(np.float32)
+
+  empty_starts, empty_lengths = _runs(counts == 0)
+  long_gaps = empty_lengths * interval >= min_gap
+
+  interpolated = np.zeros(n, dtype=bool)
+  if interpolate:
+    # every empty run is between two filled points, since the grid starts and ends on readings
+    short = empty_lengths * interval <= interpolate
+    if short.any():
+      lengths = empty_lengths[short]
+      fill = np.repeat(empty_starts[short] - np.cumsum(np.concatenate([[0], lengths[:-1]])), lengths) + np.arange(lengths.sum())
+      filled = np.flatnonzero(counts)
+      grid[fill] = np.interp(fill, filled, grid[filled])
+      interpolated[fill] = True
+
+  return {
+    'counts': counts.astype(np.uint8),
+    'gap_lengths': empty_lengths[long_gaps],
+    'gap_starts': empty_starts[long_gaps],
+    'interpolated': interpolated,
+    'interval': interval,
+    'start': np.datetime64(int(start), 's'),
+    'values': grid
+  }
+
+def sensor_grid(dex, interval = INTERVAL, min_gap = MIN_GAP, interpolate = 0):
+  """Align a DexcomJSON's sensor readings (after bloodhound) onto a fixed grid in UTC; see resample."""
+
+  times, values = utc_readings(dex)
+  return resample(times, values, interval, min_gap, interpolate)
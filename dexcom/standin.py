@@ -0,0 +1,190 @@
+# usage: python -m dexcom.standin [-h] [-p PORT] [--failure-rate FAILURE_RATE]
+#                                 [--latency LATENCY]
+#
+# Run a local stand-in for the data platform's upload endpoint, for trying out
+# and benchmarking dexcom.upload without a live service. It takes batches of
+# Tidepool records POSTed as JSON arrays over keep-alive HTTP/1.1 connections,
+# counts them, and can fail a fraction of requests (with a 503) so that retries
+# get exercised.
+#
+# optional arguments:
+#   -h, --help            show this help message and exit
+#   -p PORT, --port PORT  port to listen on
+#   --failure-rate FAILURE_RATE
+#                         fraction of requests to fail with a 503
+#   --latency LATENCY     seconds to wait before answering each request
+#
+# Copyright (c) 2014, Jana E. Beck
+# Contact: jana.eliz.beck@gmail.com
+# License: GPLv3 (http://www.gnu.org/licenses/gpl-3.0.txt)
+
+from __future__ import print_function
+
+import argparse
+import asyncio
+import json
+import random
+
+REASONS = {
+  200: 'OK',
+  400: 'Bad Request',
+  405: 'Method Not Allowed',
+  503: 'Service Unavailable'
+}
+
+class StandInServer:
+  """A local HTTP server that takes batches of Tidepool records the way the data platform would.
+
+  Every POSTed body has to be a JSON array of records, which are counted (and
+  kept, with keep) before a 200 is sent back, apart from a failure_rate fraction
+  of requests that get a 503 instead. Use it as an async context manager, or
+  start and stop it, inside a running event loop.
+  """
+
+  def __init__(self, host = '127.0.0.1', port = 0, failure_rate = 0, latency = 0, keep = False, seed = 0):
+
+    self.host = host
+    # 0 picks a free port, which is set once the server has started
+    self.port = port
+    self.failure_rate = failure_rate
+    self.latency = latency
+    self.keep = keep
+    # failures are random, but the same from run to run
+    self.random = random.Random(seed)
+
+    self.server = None
+    # the tasks answering open connections, which stop cancels
+    self.handlers = set()
+    self.counts = {
+      'batches': 0,
+      'connections': 0,
+      'failures': 0,
+      'records': 0,
+      'requests': 0
+    }
+    # with keep, every record taken, in the order they arrived
+    self.received = []
+
+  @property
+  def url(self):
+
+    return 'http://%s:%i/data' %(self.host, self.port)
+
+  async def start(self):
+
+    self.server = await asyncio.start_server(self._handle, self.host, self.port)
+    self.port = self.server.sockets[0].getsockname()[1]
+    return self
+
+  async def stop(self):
+
+    self.server.close()
+    # keep-alive connections would otherwise be left for the event loop to cancel on its way out
+    for task in self.handlers:
+      task.cancel()
+    await asyncio.gather(*self.handlers, return_exceptions=True)
+    await self.server.wait_closed()
+
+  async def __aenter__(self):
+
+    return await self.start()
+
+  async def __aexit__(self, *exc_info):
+
+    await self.stop()
+
+  def _respond(self, method, body):
+    """Return the status and JSON reply for a request."""
+
+    self.counts['requests'] += 1
+
+    if method != 'POST':
+      return 405, {'error': 'only POST is supported'}
+
+    if self.failure_rate and self.random.random() < self.failure_rate:
+      self.counts['failures'] += 1
+      return 503, {'error': 'try again later'}
+
+    try:
+      records = json.loads(body.decode('utf-8'))
+      if not isinstance(records, list):
+        raise ValueError('not a JSON array')
+    except ValueError as e:
+      return 400, {'error': str(e)}
+
+    self.counts['batches'] += 1
+    self.counts['records'] += len(records)
+    if self.keep:
+      self.received.extend(records)
+    return 200, {'accepted': len(records)}
+
+  async def _handle(self, reader, writer):
+    """Answer requests on a connection until the client closes it."""
+
+    self.counts['connections'] += 1
+    self.handlers.add(asyncio.current_task())
+
+    try:
+      while True:
+        line = await reader.readline()
+        if not line:
+          break
+        method = line.decode('latin-1').split(' ')[0]
+
+        headers = {}
+        while True:
+          line = await reader.readline()
+          if line in [b'\r\n', b'\n', b'']:
+            break
+          name, value = line.decode('latin-1').split(':', 1)
+          headers[name.strip().lower()] = value.strip()
+        body = await reader.readexactly(int(headers.get('content-length', 0)))
+
+        if self.latency:
+          await asyncio.sleep(self.latency)
+
+        status, reply = self._respond(method, body)
+        reply = json.dumps(reply).encode('utf-8')
+        writer.write(('HTTP/1.1 %i %s\r\nContent-Type: application/json\r\nContent-Length: %i\r\n\r\n' %(status, REASONS[status], len(reply))).encode('latin-1') + reply)
+        await writer.drain()
+
+        if headers.get('connection', '').lower() == 'close':
+          break
+    except (ConnectionError, asyncio.CancelledError, asyncio.IncompleteReadError):
+      # the client went away, or stop was called
+      pass
+    finally:
+      self.handlers.discard(asyncio.current_task())
+      writer.close()
+
+async def serve(args):
+  """Serve until interrupted, then print the counts."""
+
+  async with StandInServer(port=args['port'], failure_rate=args['failure_rate'], latency=args['latency']) as server:
+    print()
+    print('### Taking uploads at %s (Ctrl-C to stop)...' %(server.url))
+    print()
+    try:
+      await asyncio.Event().wait()
+    finally:
+      print()
+      print('### %(records)i records in %(batches)i batches (%(requests)i requests, %(failures)i failed, %(connections)i connections).' %(server.counts))
+      print()
+
+def main():
+
+  parser = argparse.ArgumentParser(description='Run a local stand-in for the data platform\'s upload endpoint.')
+
+  parser.add_argument('-p', '--port', action='store', type=int, default=8080, help='port to listen on')
+  parser.add_argument('--failure-rate', action='store', type=float, default=0, dest='failure_rate', help='fraction of requests to fail with a 503')
+  parser.add_argument('--latency', action='store', type=float, default=0, help='seconds to wait before answering each request')
+
+  args = parser.parse_args()
+
+  try:
+    asyncio.run(serve(args.__dict__))
+  except KeyboardInterrupt:
+    pass
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,197 @@
+# Copyright (c) 2014, Jana E. Beck
+# Contact: jana.eliz.beck@gmail.com
+# License: GPLv3 (http://www.gnu.org/licenses/gpl-3.0.txt)
+
+from __future__ import print_function
+
+from datetime import datetime as dt, timedelta as td
+import sqlite3
+
+from dexcom.convert_to_JSON import parse_datetime, DEX_FORMAT
+
+# values substituted for 'Low' and 'High', as in Dexcom._set_value
+OUT_OF_RANGE = {'Low': (39, 'low'), 'High': (401, 'high')}
+
+# number of readings per executemany
+INSERT_BATCH_SIZE = 10000
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS readings (
+  serial TEXT NOT NULL,
+  subtype TEXT NOT NULL,
+  -- GlucoseInternalTime (or MeterInternalTime) exactly as in the export
+  internal_time TEXT NOT NULL,
+  generation TEXT,
+  display_time TEXT,
+  value INTEGER,
+  out_of_range TEXT,
+  -- set by bloodhound; utc_time is in the same format as internal_time
+  display_offset REAL,
+  timezone TEXT,
+  time TEXT,
+  utc_time TEXT,
+  PRIMARY KEY (serial, subtype, internal_time)
+);
+-- the primary key doubles as the index on serial
+CREATE INDEX IF NOT EXISTS readings_internal_time ON readings (internal_time);
+CREATE INDEX IF NOT EXISTS readings_utc_time ON readings (utc_time);
+CREATE TABLE IF NOT EXISTS segments (
+  -- internal times (ISO format) of the oldest and most recent readings in the segment
+  first_internal_time TEXT NOT NULL,
+  last_internal_time TEXT NOT NULL,
+  display_offset REAL,
+  timezone TEXT,
+  reason TEXT
+);
+CREATE INDEX IF NOT EXISTS segments_last_internal_time ON segments (last_internal_time);
+"""
+
+COLUMNS = ['serial', 'subtype', 'internal_time', 'generation', 'display_time', 'value', 'out_of_range', 'display_offset', 'timezone', 'time', 'utc_time']
+
+# readings from a merged CSV don't know their offsets yet, so they mustn't wipe out ones from bloodhound
+UPSERT = """INSERT INTO readings (%s) VALUES (%s)
+  ON CONFLICT (serial, subtype, internal_time) DO UPDATE SET
+  generation = excluded.generation,
+  display_time = excluded.display_time,
+  value = excluded.value,
+  out_of_range = excluded.out_of_range,
+  display_offset = COALESCE(excluded.display_offset, display_offset),
+  timezone = COALESCE(excluded.timezone, timezone),
+  time = COALESCE(excluded.time, time),
+  utc_time = COALESCE(excluded.utc_time, utc_time)""" %(', '.join(COLUMNS), ', '.join(['?'] * len(COLUMNS)))
+
+SEGMENT_COLUMNS = ['first_internal_time', 'last_internal_time', 'display_offset', 'timezone', 'reason']
+
+def _time_arg(when):
+  """Return a time and date string for a query from a string or a datetime."""
+
+  return when.strftime(DEX_FORMAT) if isinstance(when, dt) else when
+
+def _value(value):
+  """Return the integer value and out-of-range flag of a Dexcom value string."""
+
+  if value in OUT_OF_RANGE:
+    return OUT_OF_RANGE[value]
+  return int(value), None
+
+class DexcomStore:
+  """Readings in a SQLite database, deduplicated by upsert on device serial number, subtype and internal time.
+
+  Readings can come straight from merge_csv ('terse' rows with device generation
+  and serial number) or from a DexcomJSON after bloodhound, which adds their
+  offsets, timezones and UTC times. Queries read from the database as they go.
+  """
+
+  def __init__(self, path):
+
+    self.path = path
+    self.db = sqlite3.connect(path)
+    # bulk inserts don't need to wait on every page hitting the disk
+    self.db.execute('PRAGMA journal_mode = WAL')
+    self.db.execute('PRAGMA synchronous = NORMAL')
+    self.db.executescript(SCHEMA)
+
+  def close(self):
+
+    self.db.close()
+
+  def __len__(self):
+
+    return self.db.execute('SELECT COUNT(*) FROM readings').fetchone()[0]
+
+  def _upsert(self, records):
+    """Insert or update records (tuples in COLUMNS order) in batches, in one transaction; return the count."""
+
+    count = 0
+    batch = []
+    with self.db:
+      for record in records:
+        batch.append(record)
+        if len(batch) == INSERT_BATCH_SIZE:
+          self.db.executemany(UPSERT, batch)
+          count += len(batch)
+          batch = []
+      self.db.executemany(UPSERT, batch)
+    return count + len(batch)
+
+  def add_rows(self, rows):
+    """Add 'terse' rows with device generation and serial number (e.g., from merge_csv.merged_rows); return the number of readings."""
+
+    def records():
+      for row in rows:
+        gen, serial = row[6], row[7]
+        # glucose and meter columns are independent lists, side by side
+        for subtype, i in [('sensor', 0), ('calibration', 3)]:
+          if row[i] != '':
+            value, out_of_range = _value(row[i + 2])
+            yield (serial, subtype, row[i], gen, row[i + 1], value, out_of_range, None, None, None, None)
+
+    return self._upsert(records())
+
+  def add_readings(self, readings):
+    """Add Dexcom objects (e.g., a DexcomJSON's all after bloodhound), with their offsets if they have them; return the count."""
+
+    def records():
+      for obj in readings:
+        out_of_range = obj.annotations[0]['value'] if obj.annotations else None
+        if obj.time:
+          utc = (parse_datetime(obj.user_time) - td(hours=obj.display_offset)).strftime(DEX_FORMAT)
+          offsets = (obj.display_offset, obj.timezone, obj.time, utc)
+        else:
+          offsets = (None, None, None, None)
+        yield (obj.serial, obj.subtype, obj.internal_time, obj.device_gen, obj.user_time, obj.value, out_of_range) + offsets
+
+    return self._upsert(records())
+
+  def add_segments(self, segments):
+    """Add bloodhound's offset segments (see DexcomJSON.segments), replacing any stored ones they overlap."""
+
+    if not segments:
+      return
+    with self.db:
+      self.db.execute('DELETE FROM segments WHERE last_internal_time >= ? AND first_internal_time <= ?',
+        (min(s['first_internal_time'] for s in segments), max(s['last_internal_time'] for s in segments)))
+      self.db.executemany('INSERT INTO segments (%s) VALUES (?, ?, ?, ?, ?)' %(', '.join(SEGMENT_COLUMNS)),
+        [tuple(s[name] for name in SEGMENT_COLUMNS) for s in segments])
+
+  def readings(self, start = None, end = None, serial = None, subtype = None, utc = False):
+    """Yield readings (as dicts) from start up to but not including end, most recent first.
+
+    Times are strings like '2014-08-03 12:00:00' or datetimes, and are internal
+    times unless utc is set, in which case only readings placed in time by
+    bloodhound are included. Either end of the range can be left open, and
+    readings can be limited to one device serial number and/or subtype.
+    """
+
+    column = 'utc_time' if utc else 'internal_time'
+    where, params = [], []
+    if utc:
+      where.append('utc_time IS NOT NULL')
+    if start is not None:
+      where.append('%s >= ?' %(column))
+      params.append(_time_arg(start))
+    if end is not None:
+      where.append('%s < ?' %(column))
+      params.append(_time_arg(end))
+    if serial is not None:
+      where.append('serial = ?')
+      params.append(serial)
+    if subtype is not None:
+      where.append('subtype = ?')
+      params.append(subtype)
+
+    query = 'SELECT %s FROM readings%s ORDER BY %s DESC' %(', '.join(COLUMNS), ' WHERE ' + ' AND '.join(where) if where else '', column)
+    for row in self.db.execute(query, params):
+      yield dict(zip(COLUMNS, row))
+
+  def devices(self):
+    """Return the serial number, generation, number of readings and range of internal times for each device."""
+
+    query = 'SELECT serial, generation, COUNT(*), MIN(internal_time), MAX(internal_time) FROM readings GROUP BY serial ORDER BY MIN(internal_time)'
+    return [dict(zip(['serial', 'generation', 'count', 'first_internal_time', 'last_internal_time'], row)) for row in self.db.execute(query)]
+
+  def segments(self):
+    """Return the stored offset segments, most recent first."""
+
+    query = 'SELECT %s FROM segments ORDER BY last_internal_time DESC' %(', '.join(SEGMENT_COLUMNS))
+    return [dict(zip(SEGMENT_COLUMNS, row)) for row in self.db.execute(query)]
@@ -0,0 +1,153 @@
+# usage: python -m dexcom.synthetic [-h] [-n READINGS] [-e EXPORTS] [--seed SEED]
+#                                   dir_path
+#
+# Write a set of realistic, overlapping synthetic Dexcom Studio exports, for
+# trying out and benchmarking the rest of the package without real data.
+#
+# positional arguments:
+#   dir_path              directory to write the exports to
+#
+# optional arguments:
+#   -h, --help            show this help message and exit
+#   -n READINGS, --readings READINGS
+#                         number of distinct sensor readings across all exports
+#   -e EXPORTS, --exports EXPORTS
+#                         number of exports per device
+#   --seed SEED           random seed
+#
+# Copyright (c) 2014, Jana E. Beck
+# Contact: jana.eliz.beck@gmail.com
+# License: GPLv3 (http://www.gnu.org/licenses/gpl-3.0.txt)
+
+from __future__ import print_function
+
+import argparse
+from datetime import datetime as dt, timedelta as td
+import os
+import random
+
+from dexcom.convert_to_JSON import DEX_FORMAT
+from dexcom.merge_csv import EXPECTED_HEADER
+
+# one Seven Plus receiver, then two G4 Platinum receivers, each covering a third of the data
+DEVICES = [('SevenPlus', '12345678'), ('G4Platinum', 'SM12345678'), ('G4Platinum', 'SM87654321')]
+
+READING_INTERVAL = td(minutes=5)
+
+CALIBRATION_INTERVAL = td(hours=12)
+
+# sensors last a week, then there's a couple of hours of warmup without readings
+SENSOR_LIFE = td(days=7)
+SENSOR_WARMUP = td(hours=2)
+
+# the display time gets moved an hour one way or the other about this often (i.e., DST or travel)
+SHIFT_INTERVAL = td(days=90)
+
+def _format(internal, display, millis):
+  """Return internal and display time and date strings; Seven Plus times include milliseconds."""
+
+  internal, display = internal.strftime(DEX_FORMAT), display.strftime(DEX_FORMAT)
+  if millis:
+    ms = '.%03d' %(random.randint(0, 999))
+    internal, display = internal + ms, display + ms
+  return internal, display
+
+def _device_readings(generation, start, count):
+  """Return count sensor readings and the calibrations that go with them for one device."""
+
+  millis = generation == 'SevenPlus'
+  # internal times on different receivers aren't on the same clock
+  internal = start + td(minutes=random.randint(-30, 30), seconds=random.randint(0, 59))
+  display_offset = td(hours=random.choice([-8, -5, 0]), minutes=random.randint(-5, 5))
+  next_shift = internal + SHIFT_INTERVAL
+  sensor_start = internal
+  next_calibration = internal
+  value = 120.0
+
+  sensors = []
+  calibrations = []
+
+  while len(sensors) < count:
+    if internal >= next_shift:
+      display_offset += td(hours=random.choice([-1, 1]))
+      next_shift += SHIFT_INTERVAL
+    if internal - sensor_start >= SENSOR_LIFE:
+      internal += SENSOR_WARMUP
+      sensor_start = internal
+    value = min(max(value + random.gauss(0, 6) + (120 - value) * 0.02, 20), 450)
+    if value < 40:
+      reading = 'Low'
+    elif value > 400:
+      reading = 'High'
+    else:
+      reading = str(int(value))
+    times = _format(internal, internal + display_offset, millis)
+    sensors.append(times + (reading,))
+    if internal >= next_calibration:
+      calibration = min(max(int(value + random.gauss(0, 15)), 20), 600)
+      calibrations.append(times + (str(calibration),))
+      next_calibration += CALIBRATION_INTERVAL
+    internal += READING_INTERVAL
+
+  return sensors, calibrations, internal
+
+def write_export(path, serial, sensors, calibrations):
+  """Write sensor readings and calibrations to file in the tab-delimited Dexcom Studio layout."""
+
+  info = [('Id', '{%08X-0000-0000-0000-000000000000}' %(random.getrandbits(32))), ('SerialNumber', serial), ('IsDataBlinded', '0'), ('IsKeepPrivate', '1')]
+
+  with open(path, 'w') as f:
+    f.write('\t'.join(EXPECTED_HEADER) + '\n')
+    # glucose and meter columns are independent lists, side by side
+    for i in range(max(len(sensors), len(calibrations), len(info))):
+      row = list(info[i]) if i < len(info) else ['', '']
+      row += list(sensors[i]) if i < len(sensors) else ['', '', '']
+      row += list(calibrations[i]) if i < len(calibrations) else ['', '', '']
+      f.write('\t'.join(row + ['', '', '', '', '']) + '\n')
+
+def generate(dir_path, readings, exports = 4, seed = 0):
+  """Write overlapping exports with `readings` distinct sensor readings in total; return their paths."""
+
+  random.seed(seed)
+
+  if not os.path.isdir(dir_path):
+    os.makedirs(dir_path)
+
+  start = dt(2012, 1, 1)
+  paths = []
+
+  for n, (generation, serial) in enumerate(DEVICES):
+    count = readings // len(DEVICES) + (1 if n < readings % len(DEVICES) else 0)
+    sensors, calibrations, start = _device_readings(generation, start, count)
+
+    # each export holds the receiver's last two export periods of history
+    # so early exports repeat each other exactly and later ones overlap by a period
+    step = max(count // exports, 1)
+    for e in range(exports):
+      first = max((e - 1) * step, 0)
+      last = count if e == exports - 1 else (e + 1) * step
+      if first >= last:
+        continue
+      begin, end = sensors[first][0], sensors[last - 1][0]
+      path = os.path.join(dir_path, '%s-%02d.txt' %(serial, e))
+      write_export(path, serial, sensors[first:last], [c for c in calibrations if begin <= c[0] <= end])
+      paths.append(path)
+
+  return paths
+
+def main():
+
+  parser = argparse.ArgumentParser(description='Write a set of realistic, overlapping synthetic Dexcom Studio exports.')
+
+  parser.add_argument('dir_path', action='store', help='directory to write the exports to')
+  parser.add_argument('-n', '--readings', action='store', type=int, default=100000, help='number of distinct sensor readings across all exports')
+  parser.add_argument('-e', '--exports', action='store', type=int, default=4, help='number of exports per device')
+  parser.add_argument('--seed', action='store', type=int, default=0, help='random seed')
+
+  args = parser.parse_args()
+
+  paths = generate(args.dir_path, args.readings, args.exports, args.seed)
+  print('%i exports written to %s.' %(len(paths), args.dir_path))
+
+if __name__ == '__main__':
+  main()
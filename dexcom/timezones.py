@@ -0,0 +1,104 @@
+# Copyright (c) 2014, Jana E. Beck
+# Contact: jana.eliz.beck@gmail.com
+# License: GPLv3 (http://www.gnu.org/licenses/gpl-3.0.txt)
+
+from __future__ import print_function
+
+from bisect import bisect_right
+from datetime import timedelta as td
+import json
+from pytz import timezone as tz
+
+from dexcom.breakpoints import INFERRED
+from dexcom.convert_to_JSON import get_utc_offset, parse_datetime, timezone_offset
+
+# DST policies for when the schedule doesn't say whether a change was a shift to/from DST
+DST_POLICIES = ['never', 'always', 'infer']
+
+# with the 'infer' policy, how close a DST transition has to be to count
+DST_WINDOW = td(days=14)
+
+class TimezoneResolver:
+  """Answer bloodhound's timezone questions from a schedule instead of prompting.
+
+  The schedule is a JSON file or a list of entries like
+  {"from": "2014-03-01T00:00:00", "timezone": "US/Eastern", "dst": false}
+  (or a mapping of "from" display times to timezone names), each in effect from
+  its display time until the next entry's. The default timezone covers anything
+  before the first entry; without one, such changes are reported as unresolved.
+  """
+
+  def __init__(self, schedule = [], default = None, dst = 'never'):
+
+    if isinstance(schedule, str):
+      with open(schedule, 'r') as f:
+        schedule = json.load(f)
+    if isinstance(schedule, dict):
+      schedule = [{'from': k, 'timezone': v} for k, v in schedule.items()]
+
+    if dst not in DST_POLICIES:
+      raise ValueError('Unknown DST policy: %s' %(dst))
+
+    # fail now, not halfway through a batch
+    for entry in schedule:
+      tz(entry['timezone'])
+    if default:
+      tz(default)
+
+    self.schedule = sorted(schedule, key=lambda x: x['from'])
+    self.starts = [entry['from'] for entry in self.schedule]
+    self.default = default
+    self.dst = dst
+
+    # changes that couldn't be resolved, for reporting at the end of the run
+    self.unresolved = []
+
+  def _entry(self, display_time):
+    """Return the schedule entry in effect at an ISO-format display time, if any."""
+
+    i = bisect_right(self.starts, display_time)
+    if i:
+      return self.schedule[i - 1]
+    elif self.default:
+      return {'timezone': self.default}
+
+  def _infer_dst(self, timezone, when):
+    """Guess whether a change near this (naive) datetime was the device being set to/from DST."""
+
+    return get_utc_offset(timezone, when - DST_WINDOW) != get_utc_offset(timezone, when + DST_WINDOW)
+
+  def resolve(self, obj, change_type):
+    """Return the timezone, offset from UTC and type of change for a Dexcom object, like _get_timezone."""
+
+    when = parse_datetime(obj.user_time)
+    entry = self._entry(when.isoformat())
+
+    if entry is None:
+      self.unresolved.append({
+        'display_time': when.isoformat(),
+        'internal_time': parse_datetime(obj.internal_time).isoformat(),
+        'reason': change_type,
+        'serial': obj.serial
+      })
+      return {
+        'timezone': None,
+        'offset': None,
+        'type': change_type
+      }
+
+    if 'dst' in entry:
+      dst = entry['dst']
+    elif self.dst == 'infer':
+      # only a change the bloodhound sniffed out could be the user resetting the clock
+      dst = change_type == INFERRED and self._infer_dst(entry['timezone'], when)
+    else:
+      dst = self.dst == 'always'
+
+    return timezone_offset(obj.user_time, change_type, entry['timezone'], dst)
+
+  def printable_unresolved(self, change):
+    """Return a multiline string describing a change that couldn't be resolved."""
+
+    return """UNRESOLVED change at internal time %s, display time %s:
+\tDevice serial = %s
+\tType of change = %s\n""" %(change['internal_time'], change['display_time'], change['serial'], change['reason'])
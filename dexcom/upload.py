@@ -0,0 +1,368 @@
+# usage: python -m dexcom.upload [-h] [-b BATCH_SIZE] [-n CONNECTIONS]
+#                                [--retries RETRIES] [--backoff BACKOFF]
+#                                [--checkpoint CHECKPOINT] [-z TIMEZONE]
+#                                [--dst {never,always,infer}]
+#                                [--deterministic-guids]
+#                                csv url
+#
+# Upload the Tidepool records for a 'terse' merged CSV file (see merge_csv.py
+# -c -t) to the data platform, oldest first. Records are posted in batches, as
+# JSON arrays, over a pool of keep-alive HTTP connections. A batch that fails
+# with a connection error or a 408/429/5xx is retried with exponential backoff.
+# With a checkpoint file, an interrupted upload picks up where it left off, and
+# a later one only sends what's newer (by internal time). Try it out against
+# python -m dexcom.standin.
+#
+# positional arguments:
+#   csv                   'terse' merged CSV file to upload the records of
+#   url                   URL to POST each batch of records to
+#
+# optional arguments:
+#   -h, --help            show this help message and exit
+#   -b BATCH_SIZE, --batch-size BATCH_SIZE
+#                         number of records per request
+#   -n CONNECTIONS, --connections CONNECTIONS
+#                         number of keep-alive connections (and requests in
+#                         flight)
+#   --retries RETRIES     number of times to retry a failed batch
+#   --backoff BACKOFF     seconds to wait before the first retry, doubling with
+#                         each one after
+#   --checkpoint CHECKPOINT
+#                         file recording how far the upload has got, to resume
+#                         from
+#   -z TIMEZONE, --timezone TIMEZONE
+#                         timezone to assume for bloodhound's offset changes
+#   --dst {never,always,infer}
+#                         whether to treat offset changes as shifts to/from DST
+#   --deterministic-guids
+#                         derive each record's GUID from its device serial
+#                         number and internal time, so that a retried batch the
+#                         platform did get can be recognized
+#
+# Copyright (c) 2014, Jana E. Beck
+# Contact: jana.eliz.beck@gmail.com
+# License: GPLv3 (http://www.gnu.org/licenses/gpl-3.0.txt)
+
+from __future__ import print_function
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import time
+from urllib.parse import urlsplit
+
+from dexcom.convert_to_JSON import json_format, TidepoolSerializer
+from dexcom.instrument import log, metrics
+
+# HTTP statuses that are worth trying again after a while
+RETRY_STATUSES = [408, 429, 500, 502, 503, 504]
+
+class UploadError(Exception):
+  """A batch of records the data platform didn't take, even after retrying."""
+
+class Connection:
+  """A keep-alive HTTP/1.1 connection for POSTing JSON, opened when first used and reopened after any error."""
+
+  def __init__(self, host, port, ssl = False, timeout = 30):
+
+    self.host = host
+    self.port = port
+    self.ssl = ssl
+    self.timeout = timeout
+    self.reader = None
+    self.writer = None
+
+  def close(self):
+
+    if self.writer is not None:
+      self.writer.close()
+    self.reader = None
+    self.writer = None
+
+  async def post(self, path, body, headers = {}):
+    """POST a body; return the response's status, headers (with lowercase names) and body."""
+
+    try:
+      return await asyncio.wait_for(self._post(path, body, headers), self.timeout)
+    except BaseException:
+      # whatever state the connection was left in, start over with a new one
+      self.close()
+      raise
+
+  async def _post(self, path, body, headers):
+
+    if self.writer is None:
+      self.reader, self.writer = await asyncio.open_connection(self.host, self.port, ssl=self.ssl or None)
+
+    request = ['POST %s HTTP/1.1' %(path), 'Host: %s' %(self.host), 'Content-Type: application/json', 'Content-Length: %i' %(len(body)), 'Connection: keep-alive']
+    request += ['%s: %s' %(name, value) for name, value in sorted(headers.items())]
+    self.writer.write(('\r\n'.join(request) + '\r\n\r\n').encode('latin-1') + body)
+    await self.writer.drain()
+
+    line = await self.reader.readline()
+    if not line:
+      raise ConnectionResetError('Connection closed by %s:%i.' %(self.host, self.port))
+    status = int(line.split()[1])
+
+    response_headers = {}
+    while True:
+      line = await self.reader.readline()
+      if line in [b'\r\n', b'\n', b'']:
+        break
+      name, value = line.decode('latin-1').split(':', 1)
+      response_headers[name.strip().lower()] = value.strip()
+
+    if response_headers.get('transfer-encoding', '').lower() == 'chunked':
+      chunks = []
+      while True:
+        size = int((await self.reader.readline()).split(b';')[0], 16)
+        chunks.append(await self.reader.readexactly(size + 2))
+        if not size:
+          break
+      response = b''.join([chunk[:-2] for chunk in chunks])
+    elif 'content-length' in response_headers:
+      response = await self.reader.readexactly(int(response_headers['content-length']))
+    else:
+      # the body runs until the server closes the connection
+      response = await self.reader.read()
+      response_headers['connection'] = 'close'
+
+    if response_headers.get('connection', '').lower() == 'close':
+      self.close()
+
+    return status, response_headers, response
+
+class TidepoolUploader:
+  """Post Dexcom objects' Tidepool records to the data platform in batches over a pool of keep-alive connections.
+
+  Records are serialized as they're needed (by TidepoolSerializer, so they're the
+  same as print_JSON's) and batches are only made as fast as connections free up
+  to send them. Records should come oldest first: with a checkpoint file,
+  progress is recorded as the internal time of the most recent record up to
+  which every batch has been taken, and records up to there are skipped next time.
+  """
+
+  def __init__(self, url, batch_size = 500, connections = 4, retries = 5, backoff = 0.5, checkpoint = None, deterministic = False, timeout = 30, headers = {}):
+
+    parts = urlsplit(url)
+    self.url = url
+    self.host = parts.hostname
+    self.ssl = parts.scheme == 'https'
+    self.port = parts.port or (443 if self.ssl else 80)
+    self.path = (parts.path or '/') + ('?' + parts.query if parts.query else '')
+    self.headers = headers
+
+    self.batch_size = batch_size
+    self.connections = connections
+    self.retries = retries
+    self.backoff = backoff
+    self.timeout = timeout
+    self.checkpoint = checkpoint
+
+    # compact, as a batch's records go in a JSON array
+    self.dumps = TidepoolSerializer(deterministic).dumper(json_format('array', False)[0])
+
+  def _load_checkpoint(self):
+    """Return the checkpoint for this URL, if there is one."""
+
+    if not self.checkpoint:
+      return None
+    try:
+      with open(self.checkpoint, 'r') as f:
+        checkpoint = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+      return None
+    # a checkpoint for somewhere else doesn't count
+    return checkpoint if checkpoint.get('url') == self.url else None
+
+  def _save_checkpoint(self, key):
+
+    if not self.checkpoint:
+      return
+    tmp = self.checkpoint + '.tmp'
+    with open(tmp, 'w') as f:
+      print(json.dumps({
+        'at': key[1],
+        'internal_time': key[0],
+        'records': self.total,
+        'url': self.url
+      }, indent=2, separators=(',', ': '), sort_keys=True), file=f)
+    os.replace(tmp, self.checkpoint)
+
+  def _batches(self, records, checkpoint):
+    """Yield batches of serialized records, skipping those the checkpoint says have been taken already."""
+
+    # records sharing an internal time are told apart by their order, which is the same from run to run
+    done_time, done_at = (checkpoint['internal_time'], checkpoint['at']) if checkpoint else (None, 0)
+    internal_time, at = None, 0
+    texts = []
+
+    for obj in records:
+      at = at + 1 if obj.internal_time == internal_time else 1
+      internal_time = obj.internal_time
+      if done_time is not None and (internal_time < done_time or (internal_time == done_time and at <= done_at)):
+        self.skipped += 1
+        continue
+      texts.append(self.dumps(obj))
+      if len(texts) == self.batch_size:
+        yield self._batch(texts, internal_time, at)
+        texts = []
+
+    if texts:
+      yield self._batch(texts, internal_time, at)
+
+  def _batch(self, texts, internal_time, at):
+
+    self.made += 1
+    return {
+      'body': ('[' + ','.join(texts) + ']').encode('utf-8'),
+      'count': len(texts),
+      # where a checkpoint goes once this and every batch before it have been taken
+      'key': [internal_time, at],
+      'number': self.made
+    }
+
+  async def _post(self, connection, batch):
+    """Post a batch, retrying with backoff until it's taken or there are no retries left."""
+
+    for attempt in range(self.retries + 1):
+      wait = None
+      try:
+        status, headers, response = await connection.post(self.path, batch['body'], self.headers)
+      except (OSError, asyncio.IncompleteReadError, asyncio.TimeoutError, ValueError, IndexError) as e:
+        error = '%s: %s' %(type(e).__name__, e)
+      else:
+        if 200 <= status < 300:
+          return
+        error = 'HTTP %i: %s' %(status, response[:200].decode('utf-8', 'replace'))
+        if status not in RETRY_STATUSES:
+          raise UploadError('Batch of %i records rejected with %s' %(batch['count'], error))
+        if headers.get('retry-after', '').isdigit():
+          wait = int(headers['retry-after'])
+
+      if attempt < self.retries:
+        self.retried += 1
+        metrics.count('upload_retries')
+        log('Retrying batch %i after %s' %(batch['number'], error))
+        # jittered, so batches that failed together don't all come back at once
+        await asyncio.sleep(wait if wait is not None else self.backoff * 2 ** attempt * random.uniform(0.5, 1))
+
+    raise UploadError('Batch of %i records failed after %i attempts; last error was %s' %(batch['count'], self.retries + 1, error))
+
+  def _taken(self, batch):
+    """Note a batch as taken, moving the checkpoint past every batch taken so far without a gap."""
+
+    self.finished[batch['number']] = batch
+    while self.taken + 1 in self.finished:
+      self.taken += 1
+      batch = self.finished.pop(self.taken)
+      self.total += batch['count']
+      self.uploaded += batch['count']
+      self._save_checkpoint(batch['key'])
+
+  async def _worker(self, connection, queue):
+    """Post batches from the queue over one connection until told to stop."""
+
+    while True:
+      batch = await queue.get()
+      if batch is None:
+        return
+      # after a failure, just empty the queue so the producer isn't left waiting
+      if self.error is not None:
+        continue
+      try:
+        await self._post(connection, batch)
+      except Exception as e:
+        self.error = e
+        continue
+      self._taken(batch)
+
+  async def upload(self, records):
+    """Post the records of Dexcom objects (oldest first) in batches; return a summary of how it went."""
+
+    start = time.time()
+    checkpoint = self._load_checkpoint()
+
+    self.error = None
+    self.made = 0
+    self.taken = 0
+    self.finished = {}
+    self.retried = 0
+    self.skipped = 0
+    self.uploaded = 0
+    self.total = checkpoint['records'] if checkpoint else 0
+
+    # one batch waiting per connection, at most
+    queue = asyncio.Queue(self.connections)
+    pool = [Connection(self.host, self.port, self.ssl, self.timeout) for i in range(self.connections)]
+    workers = [asyncio.ensure_future(self._worker(connection, queue)) for connection in pool]
+
+    try:
+      for batch in self._batches(records, checkpoint):
+        if self.error is not None:
+          break
+        await queue.put(batch)
+      for worker in workers:
+        await queue.put(None)
+      await asyncio.gather(*workers)
+    finally:
+      for worker in workers:
+        worker.cancel()
+      for connection in pool:
+        connection.close()
+
+    if self.error is not None:
+      raise self.error
+
+    self.summary = {
+      'batches': self.made,
+      'records': self.uploaded,
+      'retries': self.retried,
+      'seconds': time.time() - start,
+      'skipped': self.skipped
+    }
+    return self.summary
+
+  def run(self, records):
+    """Upload records from outside an event loop; return the summary."""
+
+    return asyncio.run(self.upload(records))
+
+def main():
+
+  from dexcom.convert_to_JSON import DexcomJSON
+  from dexcom.timezones import DST_POLICIES, TimezoneResolver
+
+  parser = argparse.ArgumentParser(description='Upload the Tidepool records for a \'terse\' merged CSV file to the data platform, oldest first.')
+
+  parser.add_argument('csv', action='store', help='\'terse\' merged CSV file to upload the records of')
+  parser.add_argument('url', action='store', help='URL to POST each batch of records to')
+  parser.add_argument('-b', '--batch-size', action='store', type=int, default=500, dest='batch_size', help='number of records per request')
+  parser.add_argument('-n', '--connections', action='store', type=int, default=4, help='number of keep-alive connections (and requests in flight)')
+  parser.add_argument('--retries', action='store', type=int, default=5, help='number of times to retry a failed batch')
+  parser.add_argument('--backoff', action='store', type=float, default=0.5, help='seconds to wait before the first retry, doubling with each one after')
+  parser.add_argument('--checkpoint', action='store', help='file recording how far the upload has got, to resume from')
+  parser.add_argument('-z', '--timezone', action='store', help='timezone to assume for bloodhound\'s offset changes')
+  parser.add_argument('--dst', action='store', choices=DST_POLICIES, default='never', help='whether to treat offset changes as shifts to/from DST')
+  parser.add_argument('--deterministic-guids', action='store_true', dest='deterministic_guids', help='derive each record\'s GUID from its device serial number and internal time, so that a retried batch the platform did get can be recognized')
+
+  args = parser.parse_args()
+
+  with open(args.csv, 'r') as f:
+    dex = DexcomJSON(f, {
+      'columnar': True,
+      'format': 'tidepool',
+      'resolver': TimezoneResolver([], args.timezone, args.dst)
+    })
+
+  uploader = TidepoolUploader(args.url, args.batch_size, args.connections, args.retries, args.backoff, args.checkpoint, args.deterministic_guids)
+  summary = dex.bloodhound('').upload(uploader).upload_summary
+
+  print()
+  print('### %(records)i records uploaded in %(batches)i batches (%(retries)i retries, %(skipped)i already uploaded) in %(seconds).1f s.' %(summary))
+  print()
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,227 @@
+# usage: python -m dexcom.watch [-h] [-o OUTPUT_DIR] [-n INTERVAL]
+#                               [--settle SETTLE] [-z TIMEZONE]
+#                               [--dst {never,always,infer}] [--compact]
+#                               [--ndjson] [--deterministic-guids]
+#                               [--sqlite SQLITE] [--once] [-v]
+#                               path
+#
+# Watch a directory for new Dexcom Studio exports and fold them into merged
+# output as they arrive. The directory is polled, so this works on any
+# filesystem (no inotify needed). Only readings that aren't already in the
+# merged CSV are sniffed by bloodhound, against the readings either side of
+# them (picking up from the offset changes in OUTPUT_DIR/bloodhound.json after
+# a restart), and their JSON records are appended to the ones already written
+# (each batch most recent first). Everything goes to
+# OUTPUT_DIR: merged-dexcom.csv ('terse', with device generation and serial
+# number, plus its incremental manifest and index), dexcom.json or
+# dexcom.ndjson, and bloodhound.log/bloodhound.json.
+#
+# positional arguments:
+#   path                  directory the Dexcom Studio exports arrive in
+#
+# optional arguments:
+#   -h, --help            show this help message and exit
+#   -o OUTPUT_DIR, --output-dir OUTPUT_DIR
+#                         directory to write the merged CSV and JSON to
+#   -n INTERVAL, --interval INTERVAL
+#                         seconds between polls
+#   --settle SETTLE       seconds a file has to go unmodified before it's read,
+#                         so half-uploaded files wait for the next poll
+#   -z TIMEZONE, --timezone TIMEZONE
+#                         timezone to assume where there's no timezones.json
+#                         schedule in the watched directory
+#   --dst {never,always,infer}
+#                         whether to treat offset changes as shifts to/from DST
+#                         when the schedule doesn't say
+#   --compact             write JSON without indentation
+#   --ndjson              write newline-delimited JSON
+#   --deterministic-guids
+#                         derive each record's GUID from its device serial
+#                         number and internal time, so rerunning gives the same
+#                         GUIDs
+#   --sqlite SQLITE       SQLite database (see dexcom.store) to upsert the
+#                         readings, with their offsets and UTC times, and
+#                         bloodhound's offset segments into as they arrive
+#   --once                poll once and exit (e.g., from cron)
+#   -v, --verbose         print merge progress messages
+#
+# Copyright (c) 2014, Jana E. Beck
+# Contact: jana.eliz.beck@gmail.com
+# License: GPLv3 (http://www.gnu.org/licenses/gpl-3.0.txt)
+
+from __future__ import print_function
+
+import argparse
+import os
+import time
+
+from dexcom import merge_csv
+from dexcom.convert_to_JSON import append_JSON, DexcomJSON, TidepoolSerializer
+from dexcom.instrument import metrics, set_verbose
+from dexcom.timezones import DST_POLICIES, TimezoneResolver
+
+# the merged dataset is what DexcomJSON reads: 'terse' rows with device generation and serial number
+MERGED_FILE = 'merged-dexcom.csv'
+MERGED_HEADER = merge_csv.TERSE_HEADER + ['DeviceGeneration', 'SerialNumber']
+MERGED_OPTIONS = {
+  'csv': True,
+  'device_gen': True,
+  'serial': True,
+  'terse': True
+}
+
+# optional timezone schedule, in the watched directory (see TimezoneResolver)
+SCHEDULE_FILE = 'timezones.json'
+
+class DexcomWatcher:
+  """Fold new Dexcom Studio exports in a directory into merged CSV and JSON output, one poll at a time."""
+
+  def __init__(self, args):
+
+    self.args = args
+    self.output_dir = args['output_dir']
+    if not os.path.isdir(self.output_dir):
+      os.makedirs(self.output_dir)
+
+    self.merged = os.path.join(self.output_dir, MERGED_FILE)
+    self.json = os.path.join(self.output_dir, 'dexcom.ndjson' if args['ndjson'] else 'dexcom.json')
+
+    # without the JSON there's nothing to append to, so everything is merged again from scratch
+    if not os.path.exists(self.json) and os.path.exists(self.merged + '.manifest.json'):
+      os.remove(self.merged + '.manifest.json')
+
+    # kept between polls, along with its dedup index
+    self.manifest = merge_csv.DexcomManifest(self.merged, MERGED_OPTIONS)
+
+    # the readings merged so far, after bloodhound, which new readings are appended to (see DexcomJSON.append)
+    self.dex = None
+
+  def _options(self, resolver):
+    """Return the DexcomJSON output options for the watched readings."""
+
+    return {
+      # offset changes already found cover the readings before them
+      'bloodhound': os.path.join(self.output_dir, 'bloodhound.json'),
+      'bloodhound_dir': self.output_dir,
+      'deterministic_guids': self.args['deterministic_guids'],
+      'file': self.json,
+      'format': 'tidepool',
+      'layout': 'ndjson' if self.args['ndjson'] else 'array',
+      'pretty': not (self.args['ndjson'] or self.args['compact']),
+      'resolver': resolver,
+      'sqlite': self.args.get('sqlite')
+    }
+
+  def poll(self):
+    """Merge any new or changed exports and write JSON for their new readings; return the number of readings."""
+
+    start = time.time()
+
+    # files still being written wait for the next poll
+    files = [f for f in merge_csv.get_file_list(self.args['path']) if start - os.path.getmtime(f) >= self.args['settle']]
+    with metrics.stage('manifest'):
+      files = self.manifest.changed_files(files)
+
+    if not files:
+      return 0
+
+    schedule = os.path.join(self.args['path'], SCHEDULE_FILE)
+    resolver = TimezoneResolver(schedule if os.path.exists(schedule) else [], self.args['timezone'], self.args['dst'])
+
+    if self.dex is None and self.manifest.index:
+      # picking up from an earlier run, so new readings are sniffed against the ones merged then
+      with open(self.merged, 'r') as f:
+        self.dex = DexcomJSON(f, self._options(resolver)).bloodhound('')
+
+    try:
+      # non-Dexcom files are skipped as they're read, and not checked again until they change
+      dex = merge_csv.DexcomSet([{
+        'add_generation_info': True,
+        'add_sn_info': True,
+        'file': f
+      } for f in files])
+      [self.manifest.skip(f) for f in dex.skipped]
+      new = self.manifest.print_set(dex, MERGED_HEADER, ',')
+    except Exception:
+      # so the files are tried again next time
+      self.manifest.pending = {}
+      raise
+
+    if not new:
+      print('%s: no new readings in %i changed files.' %(time.strftime('%H:%M:%S'), len(files)))
+      return 0
+
+    rows = [merge_csv.project_row(item, MERGED_HEADER) for item in new]
+
+    if self.dex is None:
+      # a merged CSV started over gets a new JSON file too
+      options = self._options(resolver)
+      options['rows'] = rows
+      self.dex = DexcomJSON(None, options).bloodhound('').print_JSON()
+      count = len(self.dex.all)
+    else:
+      # only true new offset breakpoints are resolved, the rest carry on from the readings either side
+      self.dex.resolver = resolver
+      self.dex.append(rows)
+      count = len(self.dex.appended)
+      # and only the new readings' records are added to the JSON
+      appended = [self.dex.all[i] for i in self.dex.appended if self.dex.all[i].time]
+      with metrics.stage('serialization'):
+        written = append_JSON(appended, self.json, self.dex.output['layout'], self.dex.output['pretty'], TidepoolSerializer(self.args['deterministic_guids']))
+      metrics.count('records_written', written)
+
+    print('%s: %i new readings from %i files in %.1f s.' %(time.strftime('%H:%M:%S'), count, len(files), time.time() - start))
+    if resolver.unresolved:
+      print("!!! %i offset changes couldn't be resolved." %(len(resolver.unresolved)))
+
+    return count
+
+  def watch(self):
+    """Poll until interrupted."""
+
+    print()
+    print('### Watching %s for new Dexcom exports every %s s (Ctrl-C to stop)...' %(self.args['path'], self.args['interval']))
+    print()
+
+    try:
+      while True:
+        try:
+          self.poll()
+        except Exception as e:
+          # keep watching; the files will be tried again on the next poll
+          print('!!! %s: %s: %s' %(time.strftime('%H:%M:%S'), type(e).__name__, e))
+        time.sleep(self.args['interval'])
+    except KeyboardInterrupt:
+      print()
+      print('### Stopped watching %s.' %(self.args['path']))
+      print()
+
+def main():
+
+  parser = argparse.ArgumentParser(description='Watch a directory for new Dexcom Studio exports and fold them into merged output as they arrive.')
+
+  parser.add_argument('path', action='store', help='directory the Dexcom Studio exports arrive in')
+  parser.add_argument('-o', '--output-dir', action='store', dest='output_dir', default='output', help='directory to write the merged CSV and JSON to')
+  parser.add_argument('-n', '--interval', action='store', type=float, default=2, help='seconds between polls')
+  parser.add_argument('--settle', action='store', type=float, default=1, help='seconds a file has to go unmodified before it\'s read, so half-uploaded files wait for the next poll')
+  parser.add_argument('-z', '--timezone', action='store', help='timezone to assume where there\'s no %s schedule in the watched directory' %(SCHEDULE_FILE))
+  parser.add_argument('--dst', action='store', choices=DST_POLICIES, default='never', help='whether to treat offset changes as shifts to/from DST when the schedule doesn\'t say')
+  parser.add_argument('--compact', action='store_true', help='write JSON without indentation')
+  parser.add_argument('--ndjson', action='store_true', help='write newline-delimited JSON')
+  parser.add_argument('--deterministic-guids', action='store_true', dest='deterministic_guids', help='derive each record\'s GUID from its device serial number and internal time, so rerunning gives the same GUIDs')
+  parser.add_argument('--sqlite', action='store', help='SQLite database (see dexcom.store) to upsert the readings, with their offsets and UTC times, and bloodhound\'s offset segments into as they arrive')
+  parser.add_argument('--once', action='store_true', help='poll once and exit (e.g., from cron)')
+  parser.add_argument('-v', '--verbose', action='store_true', help='print merge progress messages')
+
+  args = parser.parse_args()
+
+  set_verbose(args.verbose)
+
+  watcher = DexcomWatcher(args.__dict__)
+  if args.once:
+    watcher.poll()
+  else:
+    watcher.watch()
+
+if __name__ == '__main__':
+  main()
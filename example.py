@@ -19,12 +19,14 @@ def main():
     # change me to the proper path to the directory where your Dexcom files are stored
     'dir_path': '',
     'serial': True,
-    'terse': True
+    'terse': True,
+    # print progress messages
+    'verbose': True
   }
 
   merge_csv.process(args)
 
-  with open(example_output, 'rU') as f:
+  with open(example_output, 'r') as f:
     dex = DexcomJSON(f, {
       'format': 'tidepool',
       'file': 'example-output.json'
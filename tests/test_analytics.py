@@ -0,0 +1,40 @@
+# Copyright (c) 2014, Jana E. Beck
+# Contact: jana.eliz.beck@gmail.com
+# License: GPLv3 (http://www.gnu.org/licenses/gpl-3.0.txt)
+
+from __future__ import print_function
+
+import numpy as np
+
+from dexcom import analytics
+
+def sensor_series(days = 10, seed = 0):
+  """Return a few days of 5-minute readings (oldest first) that swing up and down, with a day missing."""
+
+  rng = np.random.RandomState(seed)
+  times = np.datetime64('2014-08-01T00:00:00') + np.arange(days * 288) * np.timedelta64(5, 'm')
+  values = 140 + 60 * np.sin(np.arange(days * 288) / 20.0) + rng.normal(0, 10, days * 288)
+  keep = times.astype('datetime64[D]') != np.datetime64('2014-08-04')
+  return times[keep], np.round(values[keep])
+
+def test_rolling_mage_over_one_day_matches_daily():
+
+  times, values = sensor_series()
+  daily = analytics.daily(times, values)
+  rolling = analytics.rolling(times, values, window=1)
+
+  with_data = np.searchsorted(rolling['day'], daily['day'])
+  assert np.allclose(rolling['mage'][with_data], daily['mage'], equal_nan=True)
+  # a window without readings has no excursions
+  assert np.isnan(rolling['mage'][3])
+
+def test_rolling_mage_only_counts_swings_in_the_window():
+
+  times, values = sensor_series()
+  rolling = analytics.rolling(times, values, window=3)
+
+  # the last window's excursions are the ones starting in its three days, compared with its SD
+  days, amplitudes = analytics._day_excursions((times.astype('datetime64[D]') - times[0].astype('datetime64[D]')).astype(np.int64), values)
+  last = len(rolling['day']) - 1
+  swings = amplitudes[(days > last - 3) & (days <= last)]
+  assert np.isclose(rolling['mage'][-1], swings[swings > rolling['sd'][-1]].mean())
@@ -0,0 +1,47 @@
+# Copyright (c) 2014, Jana E. Beck
+# Contact: jana.eliz.beck@gmail.com
+# License: GPLv3 (http://www.gnu.org/licenses/gpl-3.0.txt)
+
+from __future__ import print_function
+
+import json
+import os
+
+from dexcom import batch, synthetic
+
+def patient_task(tmp_path):
+  """Generate one patient's exports and return the task batch.process would make for them."""
+
+  synthetic.generate(str(tmp_path / 'input' / 'patient'), 20000)
+  return {
+    'columnar': False,
+    'deterministic_guids': True,
+    'dst': 'never',
+    'input': str(tmp_path / 'input' / 'patient'),
+    'layout': 'array',
+    'output': str(tmp_path / 'output' / 'patient'),
+    'output_file': 'dexcom.json',
+    'patient': 'patient',
+    'pretty': False,
+    'timezone': 'US/Pacific'
+  }
+
+def test_second_run_reuses_bloodhound_json(tmp_path):
+
+  task = patient_task(tmp_path)
+  archive = os.path.join(task['output'], 'bloodhound.json')
+
+  first = batch.run_patient(task)
+  assert first['error'] is None
+  with open(archive, 'r') as f:
+    changes = json.load(f)
+  # so there's something to reuse
+  assert changes
+  assert first['metrics']['counters']['timezone_questions'] == len(changes) + 1
+
+  second = batch.run_patient(task)
+  assert second['error'] is None
+  # the archived changes cover everything but the most recent readings, whose timezone is the only question
+  assert second['metrics']['counters']['timezone_questions'] == 1
+  with open(archive, 'r') as f:
+    assert json.load(f) == changes
@@ -0,0 +1,97 @@
+# Copyright (c) 2014, Jana E. Beck
+# Contact: jana.eliz.beck@gmail.com
+# License: GPLv3 (http://www.gnu.org/licenses/gpl-3.0.txt)
+
+from __future__ import print_function
+
+import json
+import os
+
+from dexcom import merge_csv, synthetic
+from dexcom.convert_to_JSON import datetime_difference, enlighten_datetime, parse_datetime, DexcomJSON, SECONDS_IN_HOUR
+from dexcom.timezones import TimezoneResolver
+
+def dexcom_json(tmp_path, rows, name, **opts):
+  """Return a DexcomJSON of rows that writes its bloodhound files to its own directory."""
+
+  os.makedirs(str(tmp_path / name))
+  output = {
+    'bloodhound_dir': str(tmp_path / name),
+    'format': 'tidepool',
+    'resolver': TimezoneResolver([], 'US/Arizona'),
+    'rows': rows
+  }
+  output.update(opts)
+  return DexcomJSON(None, output)
+
+def walk(dex):
+  """Sniff out offset changes one object at a time, as bloodhound did before find_segments."""
+
+  initial_difference = ''
+
+  effective_ats = [offset['effective_at']['internal_time'] for offset in dex.offset_changes]
+  current_effective_at = ''
+
+  for obj in dex.all:
+    if parse_datetime(obj.internal_time).isoformat() in effective_ats:
+      current_effective_at = obj.internal_time
+      change = dex.offset_index.get(parse_datetime(obj.internal_time).isoformat())
+      offsets = (change['display_offset'], change['timezone'])
+    elif obj.internal_time < current_effective_at:
+      change = dex.offset_index.get(parse_datetime(current_effective_at).isoformat())
+      offsets = (change['display_offset'], change['timezone'])
+    else:
+      diff = {'timedelta': datetime_difference(parse_datetime(obj.user_time), parse_datetime(obj.internal_time))}
+      diff['hours'] = round(-diff['timedelta'].seconds/SECONDS_IN_HOUR)
+
+      if not initial_difference:
+        offsets = dex._add_offset_change(diff['hours'], obj, 'input by user')
+        initial_difference = diff
+        current_difference = initial_difference
+      elif obj.serial != last_obj.serial and obj.device_gen == 'G4Platinum':
+        offsets = dex._add_offset_change(diff['hours'], obj, 'changed G4 Platinum device', True)
+        current_difference = diff
+      elif obj.device_gen != last_obj.device_gen:
+        offsets = dex._add_offset_change(diff['hours'], obj, 'changed to Seven Plus device', True)
+        current_difference = diff
+      elif diff['hours'] != current_difference['hours']:
+        offsets = dex._add_offset_change(diff['hours'], obj, 'inferred via bloodhound protocol', True)
+        current_difference = diff
+
+    if offsets:
+      obj.display_offset = offsets[0]
+      obj.timezone = offsets[1]
+      enlighten_datetime(obj)
+
+    last_obj = obj
+
+  return dex
+
+def offsets(dex):
+  """Return what bloodhound set on each object."""
+
+  return [(obj.internal_time, obj.subtype, obj.display_offset, obj.timezone, obj.time) for obj in dex.all]
+
+def test_find_segments_matches_walking_every_object(tmp_path):
+
+  # enough for each receiver's display time to be shifted at least once
+  synthetic.generate(str(tmp_path / 'exports'), 100000)
+  rows = merge_csv.merged_rows(str(tmp_path / 'exports'))
+
+  walked = walk(dexcom_json(tmp_path, rows, 'walked'))
+  found = dexcom_json(tmp_path, rows, 'found').bloodhound('')
+
+  # device changes and shifts in the display time, both
+  assert set(change['reason'] for change in found.offset_changes) == set(['changed G4 Platinum device', 'changed to Seven Plus device', 'inferred via bloodhound protocol'])
+  assert found.offset_changes == walked.offset_changes
+  assert offsets(found) == offsets(walked)
+
+  # and again, going on the changes found the first time
+  bloodhound = str(tmp_path / 'found' / 'bloodhound.json')
+  walked = walk(dexcom_json(tmp_path, rows, 'walked-again', bloodhound=bloodhound))
+  found = dexcom_json(tmp_path, rows, 'found-again', bloodhound=bloodhound).bloodhound('')
+
+  with open(bloodhound, 'r') as f:
+    assert len(found.offset_changes) == len(json.load(f))
+  assert found.offset_changes == walked.offset_changes
+  assert offsets(found) == offsets(walked)
@@ -0,0 +1,80 @@
+# Copyright (c) 2014, Jana E. Beck
+# Contact: jana.eliz.beck@gmail.com
+# License: GPLv3 (http://www.gnu.org/licenses/gpl-3.0.txt)
+
+from __future__ import print_function
+
+import io
+import json
+import uuid
+
+from dexcom import merge_csv, synthetic
+from dexcom.convert_to_JSON import json_format, write_JSON, DexcomJSON, TidepoolSerializer
+from dexcom.timezones import TimezoneResolver
+
+def sniffed(tmp_path, columnar = False):
+  """Return a DexcomJSON of synthetic exports (both generations, calibrations, 'Low' and 'High') after bloodhound."""
+
+  synthetic.generate(str(tmp_path / 'exports'), 20000)
+  rows = merge_csv.merged_rows(str(tmp_path / 'exports'))
+  # the synthetic readings hardly ever go that high
+  for gen in ['SevenPlus', 'G4Platinum']:
+    [row for row in rows if row[6] == gen][100][2] = 'High'
+
+  return DexcomJSON(None, {
+    'bloodhound_dir': str(tmp_path),
+    'columnar': columnar,
+    'format': 'tidepool',
+    'resolver': TimezoneResolver([], 'US/Pacific'),
+    'rows': rows
+  }).bloodhound('')
+
+def test_serializer_writes_what_dumping_as_tidepool_does(tmp_path):
+
+  objs = [obj for obj in sniffed(tmp_path).all if obj.time]
+  # so every kind of template gets made
+  assert set(obj.subtype for obj in objs) == set(['sensor', 'calibration'])
+  assert set(obj.device_gen for obj in objs) == set(['SevenPlus', 'G4Platinum'])
+  assert set(obj.annotations[0]['value'] for obj in objs if obj.annotations) == set(['low', 'high'])
+
+  for layout, pretty in [('array', True), ('array', False), ('ndjson', False)]:
+    dumps = json_format(layout, pretty)[0]
+    serialize = TidepoolSerializer(deterministic=True).dumper(dumps)
+    for obj in objs:
+      assert serialize(obj) == dumps(obj.as_tidepool(deterministic=True))
+
+def test_write_JSON_with_serializer_matches_dumping_records(tmp_path):
+
+  objs = [obj for obj in sniffed(tmp_path).all if obj.time]
+
+  for layout, pretty in [('array', True), ('array', False), ('ndjson', False)]:
+    # as print_JSON did before there was a serializer
+    records = io.StringIO()
+    write_JSON([obj.as_tidepool(deterministic=True) for obj in objs], records, layout, pretty)
+    serialized = io.StringIO()
+    write_JSON(objs, serialized, layout, pretty, TidepoolSerializer(deterministic=True))
+    assert serialized.getvalue() == records.getvalue()
+
+def test_serializer_gives_random_guids_unless_deterministic(tmp_path):
+
+  objs = [obj for obj in sniffed(tmp_path).all if obj.time][:500]
+  dumps = json_format('array', False)[0]
+  serialize = TidepoolSerializer().dumper(dumps)
+
+  guids = set()
+  for obj in objs:
+    record = json.loads(serialize(obj))
+    expected = obj.as_tidepool()
+    assert uuid.UUID(record.pop('guid')).version == 4
+    guids.add(expected.pop('guid'))
+    assert record == expected
+  assert len(guids) == len(objs)
+
+def test_serializer_writes_columnar_readings_like_objects(tmp_path):
+
+  objs = [obj for obj in sniffed(tmp_path / 'objects').all if obj.time]
+  readings = sniffed(tmp_path / 'columnar', columnar=True).all
+  rows = readings._select(readings.columns['time'] != '')
+
+  dumps = json_format('array', False)[0]
+  assert list(map(TidepoolSerializer(deterministic=True).dumper(dumps), rows)) == list(map(TidepoolSerializer(deterministic=True).dumper(dumps), objs))
@@ -0,0 +1,158 @@
+# Copyright (c) 2014, Jana E. Beck
+# Contact: jana.eliz.beck@gmail.com
+# License: GPLv3 (http://www.gnu.org/licenses/gpl-3.0.txt)
+
+from __future__ import print_function
+
+import bz2
+import csv
+import gzip
+import lzma
+import os
+import shutil
+
+from dexcom import merge_csv, synthetic
+from dexcom.compressed import open_file
+
+# each export is compressed with one of these in turn
+COMPRESSORS = [gzip, bz2, lzma]
+EXTENSIONS = ['.gz', '.bz2', '.xz']
+
+def exports(tmp_path, readings = 20000):
+  """Generate a set of overlapping exports; return their paths."""
+
+  path = tmp_path / 'exports'
+  synthetic.generate(str(path), readings)
+  return sorted(str(path / f) for f in os.listdir(str(path)))
+
+def merge(dir_path, output_file, **options):
+  """Merge the exports in a directory the way merge_csv -c -t -s does; return the lines of the output file."""
+
+  args = {
+    'csv': True,
+    'device_gen': True,
+    'dir_path': dir_path,
+    'output_file': output_file,
+    'serial': True,
+    'terse': True
+  }
+  args.update(options)
+  merge_csv.process(args)
+
+  with open_file(output_file, 'r') as f:
+    return f.read().splitlines()
+
+def test_incremental_merges_match_merging_everything(tmp_path):
+
+  files = exports(tmp_path)
+  full = merge(os.path.dirname(files[0]), str(tmp_path / 'full.csv'))
+
+  watched = tmp_path / 'watched'
+  os.makedirs(str(watched))
+  output_file = str(tmp_path / 'incremental.csv')
+
+  # the first run has nothing to go on, so it's the same as merging everything there is
+  [shutil.copy(f, str(watched)) for f in files[0::3]]
+  assert merge(str(watched), output_file, incremental=True) == merge(str(watched), str(tmp_path / 'first.csv'))
+
+  [shutil.copy(f, str(watched)) for f in files[1::3] + files[2::3]]
+  lines = merge(str(watched), output_file, incremental=True)
+
+  # the new rows are appended, so only the order differs
+  assert lines[0] == full[0]
+  assert sorted(lines[1:]) == sorted(full[1:])
+
+  # nothing new, nothing written
+  assert merge(str(watched), output_file, incremental=True) == lines
+
+def test_incremental_merge_starts_over_when_the_options_change(tmp_path):
+
+  files = exports(tmp_path)
+  dir_path = os.path.dirname(files[0])
+  output_file = str(tmp_path / 'incremental.csv')
+
+  merge(dir_path, output_file, incremental=True)
+  assert merge(dir_path, output_file, incremental=True, serial=False) == merge(dir_path, str(tmp_path / 'full.csv'), serial=False)
+
+def test_incremental_merge_rebuilds_a_corrupt_manifest(tmp_path):
+
+  files = exports(tmp_path)
+  dir_path = os.path.dirname(files[0])
+  output_file = str(tmp_path / 'incremental.csv')
+
+  lines = merge(dir_path, output_file, incremental=True)
+  with open(output_file + '.manifest.json', 'w') as f:
+    f.write('{"files": ')
+  assert merge(dir_path, output_file, incremental=True) == lines
+
+def test_compressed_exports_merge_like_plain_ones(tmp_path):
+
+  files = exports(tmp_path)
+  plain = merge(os.path.dirname(files[0]), str(tmp_path / 'plain.csv'))
+
+  compressed = tmp_path / 'compressed'
+  os.makedirs(str(compressed))
+  for i, f in enumerate(files):
+    with open(f, 'rb') as src:
+      with COMPRESSORS[i % len(COMPRESSORS)].open(str(compressed / os.path.basename(f)) + EXTENSIONS[i % len(COMPRESSORS)], 'wb') as dst:
+        shutil.copyfileobj(src, dst)
+
+  assert merge(str(compressed), str(tmp_path / 'merged.csv')) == plain
+  assert merge(str(compressed), str(tmp_path / 'streamed.csv'), stream=True) == plain
+
+  # and compressed on the way out
+  assert merge(str(compressed), str(tmp_path / 'merged.csv.gz')) == plain
+  with gzip.open(str(tmp_path / 'merged.csv.gz'), 'rt') as f:
+    assert f.read().splitlines() == plain
+
+def csv_reader_batch(this_file):
+  """Parse a Dexcom file the way DexcomSet did before read_file: csv.reader, with the first two columns blanked."""
+
+  rows, serial = [], ''
+  with open(this_file, 'r') as f:
+    rdr = csv.reader(f, delimiter='\t')
+    next(rdr)
+    for row in rdr:
+      if row[0] == 'SerialNumber':
+        serial = row[1]
+      rows.append(tuple(['', ''] + row[2:]))
+  return rows, serial
+
+def test_read_file_parses_like_csv_reader(tmp_path):
+
+  files = exports(tmp_path, 5000)
+  variants = tmp_path / 'variants'
+  os.makedirs(str(variants))
+
+  with open(files[0], 'r', newline='') as f:
+    text = f.read()
+  lines = text.splitlines()
+  # Windows line endings, a quoted field, no newline at the end, and the serial number row further down
+  for name, variant in [
+    ('crlf.txt', '\r\n'.join(lines) + '\r\n'),
+    ('quoted.txt', '\n'.join(lines[:5] + ['\t\t"%s"' %(lines[5][2:].split('\t')[0])] + lines[5:]) + '\n'),
+    ('unterminated.txt', '\n'.join(lines)),
+    ('serial.txt', '\n'.join(lines[:1] + [line for line in lines[1:] if not line.startswith('SerialNumber')] + [line for line in lines if line.startswith('SerialNumber')]) + '\n')
+  ]:
+    with open(str(variants / name), 'w', newline='') as f:
+      f.write(variant)
+
+  for this_file in files + sorted(str(variants / name) for name in os.listdir(str(variants))):
+    batch = merge_csv.read_file(this_file)
+    rows, serial = csv_reader_batch(this_file)
+    assert list(merge_csv.unpack_rows(batch['rows'])) == rows, this_file
+    assert batch['serial'] == serial
+    assert batch['generation'] == merge_csv.get_generation(serial)
+
+  # and anything else is skipped
+  with open(str(tmp_path / 'notes.txt'), 'w') as f:
+    f.write('not\ta\tDexcom\texport\n')
+  assert merge_csv.read_file(str(tmp_path / 'notes.txt')) is None
+
+def test_in_memory_merge_matches_streaming_csv_reader_merge(tmp_path):
+
+  files = exports(tmp_path)
+  dir_path = os.path.dirname(files[0])
+  # the streaming merge still reads files with csv.reader
+  assert merge(dir_path, str(tmp_path / 'merged.csv')) == merge(dir_path, str(tmp_path / 'streamed.csv'), stream=True)
+  assert merge(dir_path, str(tmp_path / 'merged-jobs.csv'), jobs=2) == merge(dir_path, str(tmp_path / 'streamed.csv'), stream=True)
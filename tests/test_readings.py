@@ -0,0 +1,92 @@
+# Copyright (c) 2014, Jana E. Beck
+# Contact: jana.eliz.beck@gmail.com
+# License: GPLv3 (http://www.gnu.org/licenses/gpl-3.0.txt)
+
+from __future__ import print_function
+
+import os
+
+import numpy as np
+
+from dexcom import merge_csv, synthetic
+from dexcom.convert_to_JSON import DexcomJSON
+from dexcom.readings import DexcomReadings, COLUMNS_SUFFIX, STORED_COLUMNS
+from dexcom.timezones import TimezoneResolver
+
+def merged(tmp_path):
+  """Merge synthetic exports the way merge_csv -s -p --columns does; return the path of the merged CSV."""
+
+  synthetic.generate(str(tmp_path / 'exports'), 20000)
+  output_file = str(tmp_path / 'merged.csv')
+  merge_csv.process({
+    'columns': True,
+    'device_gen': True,
+    'dir_path': str(tmp_path / 'exports'),
+    'output_file': output_file,
+    'serial': True
+  })
+  return output_file
+
+def converted(csv_path, json_path, columnar):
+  """Convert a merged CSV to Tidepool JSON with deterministic GUIDs; return the JSON."""
+
+  os.makedirs(json_path)
+  with open(csv_path, 'r') as f:
+    DexcomJSON(f, {
+      'bloodhound_dir': json_path,
+      'columnar': columnar,
+      'deterministic_guids': True,
+      'file': os.path.join(json_path, 'dexcom.json'),
+      'format': 'tidepool',
+      'resolver': TimezoneResolver([], 'US/Arizona')
+    }).bloodhound('').print_JSON()
+
+  with open(os.path.join(json_path, 'dexcom.json'), 'r') as f:
+    return f.read()
+
+def stored(readings):
+  """Return the columns a sidecar keeps, in order."""
+
+  return [readings.columns[name][readings.index] for name in STORED_COLUMNS]
+
+def test_sidecar_holds_what_parsing_the_csv_does(tmp_path):
+
+  csv_path = merged(tmp_path)
+  assert os.path.exists(csv_path + COLUMNS_SUFFIX)
+
+  loaded = DexcomReadings.load(csv_path)
+  with open(csv_path, 'r') as f:
+    parsed = DexcomReadings.from_csv(f)
+
+  assert isinstance(loaded.columns['internal'], np.memmap)
+  assert (loaded.generations, loaded.serials) == (parsed.generations, parsed.serials)
+  for name, loaded_column, parsed_column in zip(STORED_COLUMNS, stored(loaded), stored(parsed)):
+    assert np.array_equal(loaded_column, parsed_column), name
+
+def test_columnar_json_from_sidecar_matches_parsing_the_csv(tmp_path):
+
+  csv_path = merged(tmp_path)
+  eager = converted(csv_path, str(tmp_path / 'eager'), False)
+  assert converted(csv_path, str(tmp_path / 'sidecar'), True) == eager
+
+  # without the sidecar, the CSV is parsed
+  os.rename(csv_path + COLUMNS_SUFFIX, csv_path + '.moved')
+  assert converted(csv_path, str(tmp_path / 'parsed'), True) == eager
+
+def test_stale_sidecar_is_ignored(tmp_path):
+
+  csv_path = merged(tmp_path)
+
+  # the CSV changes after the sidecar was written
+  with open(csv_path, 'r') as f:
+    lines = f.readlines()
+  with open(csv_path, 'w') as f:
+    f.writelines(lines[:-1000])
+
+  assert DexcomReadings.load(csv_path) is None
+  assert converted(csv_path, str(tmp_path / 'columnar'), True) == converted(csv_path, str(tmp_path / 'eager'), False)
+
+  # until it's brought up to date
+  merge_csv.write_columns(csv_path)
+  with open(csv_path, 'r') as f:
+    assert len(DexcomReadings.load(csv_path)) == len(DexcomReadings.from_csv(f))
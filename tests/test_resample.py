@@ -0,0 +1,23 @@
+# Copyright (c) 2014, Jana E. Beck
+# Contact: jana.eliz.beck@gmail.com
+# License: GPLv3 (http://www.gnu.org/licenses/gpl-3.0.txt)
+
+from __future__ import print_function
+
+import numpy as np
+
+from dexcom import resample
+
+def test_first_reading_past_half_an_interval_fills_the_first_grid_point():
+
+  # 3 minutes past a 5-minute grid point, so every reading rounds up to the next one
+  times = np.datetime64('2014-08-01T12:03:00') + np.array([0, 1, 4, 5]) * np.timedelta64(5, 'm')
+  values = np.array([100., 110., 130., 140.])
+  grid = resample.resample(times, values, interpolate=10 * 60)
+
+  assert grid['start'] == np.datetime64('2014-08-01T12:05:00')
+  assert grid['counts'][0] == 1
+  assert grid['values'][0] == 100
+  # only the empty stretch between readings is filled in
+  assert grid['interpolated'].tolist() == [False, False, True, True, False, False]
+  assert np.all(grid['counts'][~grid['interpolated']] == 1)
@@ -0,0 +1,125 @@
+# Copyright (c) 2014, Jana E. Beck
+# Contact: jana.eliz.beck@gmail.com
+# License: GPLv3 (http://www.gnu.org/licenses/gpl-3.0.txt)
+
+from __future__ import print_function
+
+from datetime import datetime as dt
+
+from dexcom.convert_to_JSON import DexcomJSON
+from dexcom.store import DexcomStore
+from dexcom.timezones import TimezoneResolver
+
+def terse_rows():
+  """Return 'terse' rows with device generation and serial number for two receivers, one with a calibration."""
+
+  return [
+    ['2014-08-01 12:00:00', '2014-08-01 05:00:00', '100', '', '', '', 'G4Platinum', 'SM11111111'],
+    ['2014-08-01 12:05:00', '2014-08-01 05:05:00', 'Low', '2014-08-01 12:06:00', '2014-08-01 05:06:00', '80', 'G4Platinum', 'SM11111111'],
+    ['2014-08-01 12:10:00', '2014-08-01 05:10:00', '120', '', '', '', 'G4Platinum', 'SM11111111'],
+    ['2014-08-01 12:02:00', '2014-08-01 05:02:00', 'High', '', '', '', 'G4Platinum', 'SM22222222'],
+    ['2014-08-01 12:07:00', '2014-08-01 05:07:00', '300', '', '', '', 'G4Platinum', 'SM22222222']
+  ]
+
+def sniffed(tmp_path, rows):
+  """Return a DexcomJSON of rows after bloodhound, everything in US/Arizona (UTC-7)."""
+
+  return DexcomJSON(None, {
+    'bloodhound_dir': str(tmp_path),
+    'format': 'tidepool',
+    'resolver': TimezoneResolver([], 'US/Arizona'),
+    'rows': rows
+  }).bloodhound('')
+
+def test_upsert_dedups_on_serial_subtype_and_internal_time(tmp_path):
+
+  store = DexcomStore(str(tmp_path / 'dexcom.sqlite'))
+  assert store.add_rows(terse_rows()) == 6
+  assert len(store) == 6
+
+  # the same readings again, one with a new value
+  rows = terse_rows()
+  rows[0][2] = '105'
+  store.add_rows(rows)
+  assert len(store) == 6
+  assert [r['value'] for r in store.readings(serial='SM11111111', subtype='sensor')] == [120, 39, 105]
+
+  # the same internal time on another receiver is another reading
+  store.add_rows([['2014-08-01 12:00:00', '2014-08-01 05:00:00', '90', '', '', '', 'G4Platinum', 'SM22222222']])
+  assert len(store) == 7
+  store.close()
+
+def test_rows_dont_wipe_out_offsets_from_bloodhound(tmp_path):
+
+  store = DexcomStore(str(tmp_path / 'dexcom.sqlite'))
+  store.add_readings(sniffed(tmp_path, terse_rows()).all)
+  store.add_rows(terse_rows())
+
+  readings = list(store.readings())
+  assert len(readings) == 6
+  assert all(r['display_offset'] == -7 and r['timezone'] == 'US/Arizona' for r in readings)
+  low = [r for r in readings if r['internal_time'] == '2014-08-01 12:05:00' and r['subtype'] == 'sensor'][0]
+  assert (low['value'], low['out_of_range'], low['utc_time']) == (39, 'low', '2014-08-01 12:05:00')
+  store.close()
+
+def test_readings_filters(tmp_path):
+
+  store = DexcomStore(str(tmp_path / 'dexcom.sqlite'))
+  store.add_rows(terse_rows())
+
+  def times(**kwargs):
+    return [r['internal_time'] for r in store.readings(**kwargs)]
+
+  # most recent first, from start up to but not including end, as strings or datetimes
+  assert times(start='2014-08-01 12:02:00', end='2014-08-01 12:07:00') == ['2014-08-01 12:06:00', '2014-08-01 12:05:00', '2014-08-01 12:02:00']
+  assert times(start=dt(2014, 8, 1, 12, 2), end=dt(2014, 8, 1, 12, 7)) == times(start='2014-08-01 12:02:00', end='2014-08-01 12:07:00')
+  assert times(end='2014-08-01 12:02:00') == ['2014-08-01 12:00:00']
+  assert times(start='2014-08-01 12:07:00') == ['2014-08-01 12:10:00', '2014-08-01 12:07:00']
+  assert times(serial='SM22222222') == ['2014-08-01 12:07:00', '2014-08-01 12:02:00']
+  assert times(subtype='calibration') == ['2014-08-01 12:06:00']
+  assert times(serial='SM22222222', subtype='calibration') == []
+
+  # readings bloodhound hasn't placed in time have no UTC time yet
+  assert times(utc=True) == []
+  rows = terse_rows()[3:]
+  store.add_readings(sniffed(tmp_path, rows).all)
+  assert times(utc=True) == ['2014-08-01 12:07:00', '2014-08-01 12:02:00']
+  assert [r['utc_time'] for r in store.readings(start='2014-08-01 12:05:00', utc=True)] == ['2014-08-01 12:07:00']
+  store.close()
+
+def test_segments_round_trip(tmp_path):
+
+  dex = sniffed(tmp_path, terse_rows())
+  assert dex.segments
+
+  store = DexcomStore(str(tmp_path / 'dexcom.sqlite'))
+  store.add_segments(dex.segments)
+  assert store.segments() == dex.segments
+
+  # storing them again replaces the ones they overlap instead of adding to them
+  store.add_segments(dex.segments)
+  assert store.segments() == dex.segments
+  store.close()
+
+  # and they're still there the next time the database is opened
+  store = DexcomStore(str(tmp_path / 'dexcom.sqlite'))
+  assert store.segments() == dex.segments
+  store.close()
+
+def test_dexcom_json_stores_readings_and_segments_after_bloodhound(tmp_path):
+
+  path = str(tmp_path / 'dexcom.sqlite')
+  rows = terse_rows()
+  dex = DexcomJSON(None, {
+    'bloodhound_dir': str(tmp_path),
+    'format': 'tidepool',
+    'resolver': TimezoneResolver([], 'US/Arizona'),
+    'rows': rows[:3],
+    'sqlite': path
+  }).bloodhound('')
+  dex.append(rows[3:])
+
+  store = DexcomStore(path)
+  assert len(list(store.readings(utc=True))) == 6
+  assert store.segments() == dex.segments
+  store.close()
@@ -0,0 +1,147 @@
+# Copyright (c) 2014, Jana E. Beck
+# Contact: jana.eliz.beck@gmail.com
+# License: GPLv3 (http://www.gnu.org/licenses/gpl-3.0.txt)
+
+from __future__ import print_function
+
+import asyncio
+from datetime import datetime as dt, timedelta as td
+import json
+
+from dexcom import merge_csv, synthetic
+from dexcom.convert_to_JSON import DexcomJSON, DEX_FORMAT
+from dexcom.standin import StandInServer
+from dexcom.timezones import TimezoneResolver
+from dexcom.upload import TidepoolUploader, UploadError
+
+def records(tmp_path, count = 1000):
+  """Return count sensor readings from one receiver, after bloodhound, oldest first (as the uploader takes them)."""
+
+  start = dt(2014, 8, 1, 12)
+  rows = []
+  for i in range(count):
+    internal = start + td(minutes=5 * i)
+    rows.append([internal.strftime(DEX_FORMAT), (internal - td(hours=7)).strftime(DEX_FORMAT), str(100 + i % 200), '', '', '', 'G4Platinum', 'SM11111111'])
+
+  dex = DexcomJSON(None, {
+    'bloodhound_dir': str(tmp_path),
+    'format': 'tidepool',
+    'resolver': TimezoneResolver([], 'US/Arizona'),
+    'rows': rows
+  }).bloodhound('')
+  return list(reversed(dex.all))
+
+class BatchSizeServer(StandInServer):
+  """A stand-in server that also notes the number of records in each batch it takes."""
+
+  def __init__(self, **kwargs):
+
+    StandInServer.__init__(self, **kwargs)
+    self.batch_sizes = []
+
+  def _respond(self, method, body):
+
+    status, reply = StandInServer._respond(self, method, body)
+    if status == 200:
+      self.batch_sizes.append(reply['accepted'])
+    return status, reply
+
+def upload(server_opts, records, **uploader_opts):
+  """Upload records to a stand-in server that keeps them; return the summary (or error) and the (stopped) server."""
+
+  async def run():
+    async with BatchSizeServer(keep=True, **server_opts) as server:
+      uploader = TidepoolUploader(server.url, backoff=0.001, deterministic=True, **uploader_opts)
+      try:
+        result = await uploader.upload(records)
+      except UploadError as e:
+        result = e
+      return result, server
+
+  return asyncio.run(run())
+
+def expected(records):
+  """Return the Tidepool records the uploader should post for Dexcom objects, with deterministic GUIDs."""
+
+  dumps = TidepoolUploader('http://127.0.0.1/', deterministic=True).dumps
+  return [json.loads(dumps(obj)) for obj in records]
+
+def test_retries_recover_failed_batches(tmp_path):
+
+  readings = records(tmp_path)
+  summary, server = upload({'failure_rate': 0.3}, readings, batch_size=50, connections=1, retries=20)
+
+  assert server.counts['failures'] > 0
+  assert summary['retries'] == server.counts['failures']
+  assert summary['records'] == len(readings)
+  # one connection, so the batches arrive in order
+  assert server.received == expected(readings)
+
+def test_upload_error_once_retries_run_out(tmp_path):
+
+  readings = records(tmp_path, 100)
+  error, server = upload({'failure_rate': 1}, readings, batch_size=50, connections=1, retries=2)
+
+  assert isinstance(error, UploadError)
+  assert server.counts['failures'] == 3
+  assert server.received == []
+
+def test_second_run_with_checkpoint_posts_only_the_rest(tmp_path):
+
+  readings = records(tmp_path)
+  checkpoint = str(tmp_path / 'checkpoint.json')
+
+  summary, server = upload({}, readings[:600], batch_size=100, connections=3, checkpoint=checkpoint)
+  assert summary['records'] == 600
+
+  # checkpoints are for one URL, so it's the same server again
+  summary, server = upload({'port': server.port}, readings, batch_size=100, connections=3, checkpoint=checkpoint)
+  assert summary['skipped'] == 600
+  assert summary['records'] == 400
+  assert sorted(server.received, key=lambda record: record['guid']) == sorted(expected(readings[600:]), key=lambda record: record['guid'])
+
+def test_batch_sizes(tmp_path):
+
+  readings = records(tmp_path)
+  for batch_size in [1, 128, 1000, 5000]:
+    summary, server = upload({}, readings, batch_size=batch_size, connections=2)
+    assert summary['batches'] == server.counts['batches']
+    # full batches, apart from whatever's left over at the end
+    assert sorted(server.batch_sizes, reverse=True) == [batch_size] * (len(readings) // batch_size) + ([len(readings) % batch_size] if len(readings) % batch_size else [])
+
+class RecordingUploader:
+  """Takes records the way TidepoolUploader.run does, noting what they were and how they came."""
+
+  def run(self, records):
+
+    self.streamed = not isinstance(records, (list, tuple))
+    self.records = [(obj.internal_time, obj.subtype, obj.serial, obj.time) for obj in records]
+    return {'records': len(self.records)}
+
+def test_dexcom_json_streams_its_records_oldest_first(tmp_path):
+
+  synthetic.generate(str(tmp_path / 'exports'), 5000)
+  rows = merge_csv.merged_rows(str(tmp_path / 'exports'))
+
+  uploaded = {}
+  for mode in ['eager', 'columnar', 'lazy']:
+    dex = DexcomJSON(None, {
+      'bloodhound_dir': str(tmp_path),
+      'columnar': mode == 'columnar',
+      'format': 'tidepool',
+      'lazy': mode == 'lazy',
+      'resolver': TimezoneResolver([], 'US/Arizona'),
+      'rows': rows
+    }).bloodhound('')
+    if mode == 'eager':
+      # what upload used to hand over, all at once
+      expected_records = [(obj.internal_time, obj.subtype, obj.serial, obj.time) for obj in reversed([obj for obj in dex.all if obj.time])]
+
+    uploader = RecordingUploader()
+    dex.upload(uploader)
+    assert uploader.streamed
+    uploaded[mode] = uploader.records
+
+  assert uploaded['eager'] == expected_records
+  assert uploaded['columnar'] == expected_records
+  assert uploaded['lazy'] == expected_records
@@ -0,0 +1,65 @@
+# Copyright (c) 2014, Jana E. Beck
+# Contact: jana.eliz.beck@gmail.com
+# License: GPLv3 (http://www.gnu.org/licenses/gpl-3.0.txt)
+
+from __future__ import print_function
+
+import json
+import os
+import shutil
+
+from dexcom import synthetic
+from dexcom.watch import DexcomWatcher
+
+def watcher_args(path, output_dir):
+  """Return the arguments dexcom.watch's main would pass for a run with --once."""
+
+  return {
+    'compact': True,
+    'deterministic_guids': True,
+    'dst': 'never',
+    'interval': 1,
+    'ndjson': False,
+    'once': True,
+    'output_dir': output_dir,
+    'path': path,
+    'settle': 0,
+    # no DST, so the most recent readings' offset doesn't depend on which poll first asked about them
+    'timezone': 'US/Arizona',
+    'verbose': False
+  }
+
+def watched_output(tmp_path, name, arrivals, restart = False):
+  """Poll once after each set of exports arrives; return the JSON records (sorted) and offset changes written."""
+
+  watched = tmp_path / name / 'input'
+  output = tmp_path / name / 'output'
+  os.makedirs(str(watched))
+
+  watcher = DexcomWatcher(watcher_args(str(watched), str(output)))
+  for files in arrivals:
+    [shutil.copy(f, str(watched)) for f in files]
+    if restart:
+      watcher = DexcomWatcher(watcher_args(str(watched), str(output)))
+    assert watcher.poll()
+  assert watcher.poll() == 0
+
+  with open(str(output / 'dexcom.json'), 'r') as f:
+    records = sorted(json.dumps(record, sort_keys=True) for record in json.load(f))
+  with open(str(output / 'bloodhound.json'), 'r') as f:
+    changes = json.load(f)
+  return records, changes
+
+def test_polls_match_one_run_over_everything(tmp_path):
+
+  exports = tmp_path / 'exports'
+  synthetic.generate(str(exports), 20000)
+  files = sorted(str(exports / f) for f in os.listdir(str(exports)))
+  arrivals = [files[0::3], files[1::3], files[2::3]]
+
+  records, changes = watched_output(tmp_path, 'full', [files])
+  # so there are offset changes to get wrong
+  assert len(changes) > 1
+
+  assert watched_output(tmp_path, 'polls', arrivals) == (records, changes)
+  assert watched_output(tmp_path, 'restarts', arrivals, restart=True) == (records, changes)